@@ -0,0 +1,377 @@
+"""
+Load test: simulated players against the whole app, offline.
+
+Builds the app with ``create_app`` on an in-memory stand-in for MongoDB and
+serves it with the aiohttp test server. Login is stubbed, every player is a
+user with a few characters and sends a mix of page views and edits for one
+of them as fast as the app answers. Reports throughput, latency percentiles
+per kind of request and Mongo round trips per request.
+
+    $ python benchmarks/load.py
+    $ python benchmarks/load.py --players 50 --requests 400 --latency 0.002
+"""
+import os
+import sys
+import json
+import math
+import base64
+import random
+import asyncio
+import argparse
+import tempfile
+from time import perf_counter
+from pathlib import Path
+from datetime import datetime
+from urllib.parse import quote
+
+import uvloop
+import aiohttp_login.decorators
+from aiohttp import TCPConnector
+from aiohttp.test_utils import TestServer, TestClient
+from bson import ObjectId
+
+from dnd import DndConfiguration, create_app
+from dnd.character import ABILITIES, BACKGROUND_FIELDS, COINS
+from memorydb import MemoryDatabase
+from stats import class_mixes, generate
+
+USER_HEADER = 'X-Load-User'
+
+CONFIGURATION = """
+[server]
+session_secret = {secret}
+[authentication]
+csrf_secret = load test
+smtp_host = localhost
+[rate_limit]
+actions = 1000000
+[writes]
+enabled = {buffering}
+[metrics]
+enabled = {metrics}
+[cache]
+characters = {characters}
+"""
+
+def configuration(directory, buffering, metrics, characters):
+    """DndConfiguration for the load test, ignoring the user's own files."""
+    with open(os.path.join(directory, 'config.cfg'), 'w') as stream:
+        stream.write(CONFIGURATION.format(
+            secret=base64.urlsafe_b64encode(os.urandom(32)).decode(),
+            buffering=buffering,
+            metrics=metrics,
+            characters=characters))
+    return DndConfiguration(
+        global_path=Path(directory), user_path=Path(directory), cli=False)
+
+def stub_login(db):
+    """Make the X-Load-User header say who is logged in."""
+    async def current_user(request):
+        user_id = request.headers.get(USER_HEADER)
+        if user_id is None:
+            return None
+        return await db.users.find_one({'_id': ObjectId(user_id)})
+    aiohttp_login.decorators.get_cur_user = current_user
+
+class Player:
+
+    """A user playing one of their characters."""
+
+    def __init__(self, number, characters, rng):
+        self.user = {
+            '_id': ObjectId(),
+            'email': 'player{}@example.com'.format(number),
+            'name': 'player {}'.format(number)}
+        for character in characters:
+            character['user_id'] = self.user['_id']
+        self.characters = characters
+        self.character = characters[0]
+        self.rng = rng
+        # hashes of the fragments the page has, as the page script keeps them
+        self.hashes = {}
+
+    @property
+    def api(self):
+        """Prefix of the edit URLs of the played character."""
+        return '/api/{}/'.format(self.character['_id'])
+
+async def seed(db, players, characters, seed_value):
+    """Insert users and their characters, return the players."""
+    rng = random.Random(seed_value)
+    mixes = class_mixes()
+    result = []
+    for number in range(players):
+        documents = []
+        for index in range(characters):
+            document = generate(
+                rng.randint(1, 20), rng.choice(mixes),
+                rng.choice(['Bastard', 'Orphan', 'Truman', 'Spellborn']),
+                seed_value, inventory_size=20, paragraphs=5)
+            document['name'] = 'hero {} of {}'.format(index + 1, number)
+            document['created_at'] = datetime.now()
+            documents.append(document)
+        player = Player(number, documents, random.Random(rng.random()))
+        await db.users.insert_one(dict(player.user))
+        await db.characters.insert_many(documents)
+        result.append(player)
+    return result
+
+def _page(player):
+    player.hashes = {}
+    return 'GET', '/{}/{}/'.format(
+        player.character['_id'], quote(player.character['name'])), None
+
+def _index(_player):
+    return 'GET', '/', None
+
+def _hp_fields(player):
+    fields = {
+        str(level): hitpoints for level, hitpoints in enumerate(
+            player.character['hitpoints_per_level'], 1)}
+    fields['temp-hp'] = player.rng.randint(0, 5)
+    fields['damage'] = player.rng.randint(0, 10)
+    return fields
+
+def _hp(player):
+    return 'POST', player.api + 'hp/', _hp_fields(player)
+
+def _inventory(player):
+    action = player.rng.choice(['increment', 'increment', 'decrement'])
+    name = player.rng.choice(sorted(player.character['inventory']))
+    return 'POST', '{}inventory/{}/'.format(player.api, action), {'name': name}
+
+def _coin_fields(player):
+    fields = {coin: 0 for coin in COINS}
+    fields['oros'] = player.rng.randint(-5, 20)
+    return fields
+
+def _coin(player):
+    return 'POST', player.api + 'coin/', _coin_fields(player)
+
+def _prepare(player):
+    for kind in ('spell', 'prayer'):
+        prepared = sorted(player.character['prepared_{}s'.format(kind)])
+        if len(prepared) > 0:
+            action = player.rng.choice(['prepare', 'cast'])
+            return 'POST', '{}prepare_{}/{}/'.format(
+                player.api, kind, action), {
+                    'name': player.rng.choice(prepared)}
+    return _rest(player)
+
+def _rest(player):
+    return 'POST', player.api + 'rest/', {}
+
+def _ability(player):
+    ability = player.rng.choice(ABILITIES)
+    return 'POST', '{}ability/{}/'.format(player.api, ability), {
+        'base-{}'.format(ability): player.rng.randint(8, 18),
+        'level-{}'.format(ability): 0,
+        'temp-{}'.format(ability): player.rng.randint(-2, 2)}
+
+def _xp(player):
+    player.character['xp'] += player.rng.randint(0, 50)
+    return 'POST', player.api + 'xp/', {'xp': player.character['xp']}
+
+def _background(player):
+    field = player.rng.choice(BACKGROUND_FIELDS)
+    return 'POST', '{}background/{}/'.format(player.api, field), {
+        'text': "## Session {}\n\nThe party *{}*.".format(
+            player.rng.randint(1, 100),
+            player.rng.choice(['won', 'fled', 'rested', 'argued']))}
+
+def _batch(player):
+    return 'POST', player.api + 'batch/', [
+        {'attribute': 'hp', 'fields': _hp_fields(player)},
+        {'attribute': 'coin', 'fields': _coin_fields(player)}]
+
+# (kind, weight, request maker), the mix of a session at the table
+MIX = (
+    ('character page', 20, _page),
+    ('index', 5, _index),
+    ('hp', 20, _hp),
+    ('inventory', 15, _inventory),
+    ('coin', 10, _coin),
+    ('prepare', 10, _prepare),
+    ('ability', 5, _ability),
+    ('xp', 4, _xp),
+    ('background', 3, _background),
+    ('rest', 3, _rest),
+    ('batch', 5, _batch),
+)
+
+async def play(client, player, requests, samples):
+    """Send `requests` requests for `player`, append (kind, seconds, outcome)."""
+    kinds = [kind for kind, _, _ in MIX]
+    weights = [weight for _, weight, _ in MIX]
+    makers = {kind: maker for kind, _, maker in MIX}
+    for _ in range(requests):
+        kind = player.rng.choices(kinds, weights)[0]
+        method, path, payload = makers[kind](player)
+        headers = {USER_HEADER: str(player.user['_id'])}
+        if method == 'GET':
+            start = perf_counter()
+            async with client.get(path, headers=headers) as response:
+                await response.read()
+                seconds = perf_counter() - start
+                outcome = 'ok' if response.status == 200 else 'failed'
+            samples.append((kind, seconds, outcome))
+            continue
+        headers['X-Fragment-Hashes'] = json.dumps(player.hashes)
+        if isinstance(payload, list):
+            options = {'json': payload}
+        else:
+            options = {'data': {key: str(value) for key, value in payload.items()}}
+        start = perf_counter()
+        async with client.post(path, headers=headers, **options) as response:
+            # 429 carries the rate limit error
+            data = await response.json() if response.status in (200, 429) \
+                else None
+            seconds = perf_counter() - start
+        if data is None:
+            outcome = 'failed'
+        elif 'errors' in data:
+            outcome = 'rejected'
+        else:
+            outcome = 'ok'
+            for selector, entry in data.items():
+                if isinstance(entry, dict) and 'hash' in entry:
+                    player.hashes[selector] = entry['hash']
+        samples.append((kind, seconds, outcome))
+
+def percentile(ordered, fraction):
+    """Nearest rank percentile of the sorted list `ordered`."""
+    if len(ordered) == 0:
+        return 0.0
+    return ordered[max(0, int(math.ceil(fraction * len(ordered))) - 1)]
+
+def summarize(samples):
+    """Counts and latency percentiles in milliseconds of `samples`."""
+    seconds = sorted(sample[1] for sample in samples)
+    return {
+        'requests': len(samples),
+        'rejected': sum(1 for sample in samples if sample[2] == 'rejected'),
+        'failed': sum(1 for sample in samples if sample[2] == 'failed'),
+        'p50_ms': percentile(seconds, 0.50) * 1000,
+        'p95_ms': percentile(seconds, 0.95) * 1000,
+        'p99_ms': percentile(seconds, 0.99) * 1000}
+
+async def load(args):
+    """Run the load test, return the results."""
+    db = MemoryDatabase(args.latency)
+    with tempfile.TemporaryDirectory() as directory:
+        app = create_app(
+            configuration(
+                directory, not args.no_buffering, args.metrics is not None,
+                args.character_cache),
+            database=db)
+    stub_login(db)
+    players = await seed(db, args.players, args.characters, args.seed)
+    client = TestClient(TestServer(app), connector=TCPConnector(limit=0))
+    await client.start_server()
+    try:
+        # warm the summaries and templates, as a running server would be
+        for player in players:
+            await play(client, player, 1, [])
+        before = db.round_trips_per_collection()
+        samples = []
+        start = perf_counter()
+        await asyncio.gather(*(
+            play(client, player, args.requests, samples)
+            for player in players))
+        elapsed = perf_counter() - start
+        if args.metrics is not None:
+            async with client.get('/metrics') as response:
+                with open(args.metrics, 'w') as stream:
+                    stream.write(await response.text())
+    finally:
+        await client.close()
+    after = db.round_trips_per_collection()
+    round_trips = {
+        name: count - before.get(name, 0) for name, count in after.items()
+        if count > before.get(name, 0)}
+    result = {
+        'players': args.players,
+        'seconds': elapsed,
+        'throughput': len(samples) / elapsed,
+        'round_trips_per_request': sum(round_trips.values()) / len(samples),
+        'round_trips': round_trips,
+        'total': summarize(samples),
+        'kinds': {
+            kind: summarize([sample for sample in samples if sample[0] == kind])
+            for kind, _, _ in MIX}}
+    coalescer = app.get('write_coalescer')
+    if coalescer is not None:
+        result['coalescer'] = {
+            'flushes': coalescer.flushes,
+            'mean_batch_size': coalescer.mean_batch_size,
+            'mean_latency_ms': coalescer.mean_latency * 1000}
+    cache = app.get('character_cache')
+    if cache is not None:
+        result['character_cache'] = {
+            'entries': len(cache),
+            'hit_ratio': cache.hit_ratio}
+    return result
+
+def report(result):
+    """Print the results of a run."""
+    total = result['total']
+    print("{} players, {} requests in {:.1f} s: {:.0f} requests/s".format(
+        result['players'], total['requests'], result['seconds'],
+        result['throughput']))
+    print("{:.2f} Mongo round trips per request ({})".format(
+        result['round_trips_per_request'], ", ".join(
+            "{} {}".format(name, count)
+            for name, count in result['round_trips'].items())))
+    if 'coalescer' in result:
+        print("{flushes} coalesced writes, {mean_batch_size:.2f} edits "
+              "each, {mean_latency_ms:.1f} ms buffered".format(
+                  **result['coalescer']))
+    if 'character_cache' in result:
+        print("character cache: {entries} entries, {hit_ratio:.0%} hits".format(
+            **result['character_cache']))
+    print("{:>8} {:>8} {:>8} {:>9} {:>9} {:>9}  {}".format(
+        "count", "rejected", "failed", "p50 [ms]", "p95 [ms]", "p99 [ms]",
+        "kind"))
+    for kind, summary in list(result['kinds'].items()) + [('all', total)]:
+        print("{requests:8d} {rejected:8d} {failed:8d} {p50_ms:9.2f} "
+              "{p95_ms:9.2f} {p99_ms:9.2f}  {kind}".format(
+                  kind=kind, **summary))
+
+def main():
+    """Run the load test and print a report."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--players', type=int, default=20)
+    parser.add_argument(
+        '--requests', type=int, default=200, help="requests per player")
+    parser.add_argument(
+        '--characters', type=int, default=3, help="characters per player")
+    parser.add_argument(
+        '--latency', type=float, default=0.001,
+        help="seconds per Mongo round trip (default: 0.001)")
+    parser.add_argument(
+        '--no-buffering', action='store_true',
+        help="write every edit on its own")
+    parser.add_argument(
+        '--character-cache', type=int, default=256,
+        help="characters to cache, 0 disables the cache (default: 256)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="write the results to this JSON file")
+    parser.add_argument(
+        '--metrics', help="enable /metrics and save it to this file at the end")
+    args = parser.parse_args()
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        result = loop.run_until_complete(load(args))
+    finally:
+        loop.close()
+    report(result)
+    if args.output:
+        with open(args.output, 'w') as stream:
+            json.dump(result, stream, indent=1, sort_keys=True)
+    if result['total']['failed'] > 0:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
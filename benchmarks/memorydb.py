@@ -0,0 +1,381 @@
+"""
+In-memory stand-in for the parts of Motor the app uses.
+
+Supports the queries, update operators and cursor methods of dnd, unique
+indexes, and counts round trips per collection. Every round trip sleeps for
+`latency` seconds so that requests interleave as they would against a
+server.
+"""
+import copy
+import asyncio
+from bson import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+_MISSING = object()
+
+def _get(document, path):
+    value = document
+    for part in path.split('.'):
+        if isinstance(value, dict) and part in value:
+            value = value[part]
+        elif isinstance(value, list) and part.isdigit() and \
+                int(part) < len(value):
+            value = value[int(part)]
+        else:
+            return _MISSING
+    return value
+
+# query and update operators the handlers use
+QUERY_OPERATORS = {'$exists', '$ne', '$in', '$gt', '$gte', '$lt', '$lte'}
+UPDATE_OPERATORS = {'$set', '$unset', '$inc', '$push', '$pull'}
+
+def _compare(value, operator, operand):
+    if operator not in QUERY_OPERATORS:
+        raise ValueError(
+            "query operator {} is not supported by the in-memory "
+            "database".format(operator))
+    if operator == '$exists':
+        return (value is not _MISSING) == bool(operand)
+    if operator == '$ne':
+        return value != operand
+    if operator == '$in':
+        return value in operand
+    if value is _MISSING:
+        return False
+    if operator == '$gt':
+        return value > operand
+    if operator == '$gte':
+        return value >= operand
+    if operator == '$lt':
+        return value < operand
+    return value <= operand
+
+def _matches_value(value, condition):
+    if isinstance(condition, dict) and \
+            any(key.startswith('$') for key in condition):
+        return all(
+            _compare(value, operator, operand)
+            for operator, operand in condition.items())
+    if isinstance(value, list) and not isinstance(condition, list):
+        return condition in value
+    return (None if value is _MISSING else value) == condition
+
+def matches(document, query):
+    """Whether `document` matches the Mongo `query`."""
+    for key, condition in (query or {}).items():
+        if key == '$or':
+            if not any(matches(document, part) for part in condition):
+                return False
+        elif not _matches_value(_get(document, key), condition):
+            return False
+    return True
+
+def project(document, projection):
+    """Copy of `document` with only, or without, the fields in `projection`."""
+    if projection is None:
+        return copy.deepcopy(document)
+    if not any(include for path, include in projection.items() if path != '_id'):
+        result = copy.deepcopy(document)
+        for path in projection:
+            result.pop(path, None)
+        return result
+    result = {'_id': document['_id']} if projection.get('_id', True) else {}
+    for path, include in projection.items():
+        if path == '_id' or not include:
+            continue
+        value = _get(document, path)
+        if value is _MISSING:
+            continue
+        target = result
+        parts = path.split('.')
+        for part in parts[:-1]:
+            target = target.setdefault(part, {})
+        target[parts[-1]] = copy.deepcopy(value)
+    return result
+
+def _children(container, part, array_filters):
+    if part.startswith('$[') and part.endswith(']'):
+        identifier = part[2:-1]
+        conditions = {}
+        for array_filter in array_filters:
+            for key, value in array_filter.items():
+                if key.split('.')[0] == identifier:
+                    conditions[key[len(identifier) + 1:]] = value
+        return [item for item in container if matches(item, conditions)]
+    if isinstance(container, list):
+        return [container[int(part)]]
+    return [container.setdefault(part, {})]
+
+def _targets(document, path, array_filters):
+    """(container, key) pairs addressed by `path`."""
+    parts = path.split('.')
+    containers = [document]
+    for part in parts[:-1]:
+        containers = [
+            child for container in containers
+            for child in _children(container, part, array_filters)]
+    key = parts[-1]
+    return [
+        (container, int(key) if isinstance(container, list) else key)
+        for container in containers]
+
+def apply_update(document, update, array_filters=()):
+    """Apply the update operators in `update` to `document` in place."""
+    for operator, fields in update.items():
+        if operator not in UPDATE_OPERATORS:
+            raise ValueError(
+                "update operator {} is not supported by the in-memory "
+                "database".format(operator))
+        for path, value in fields.items():
+            for container, key in _targets(document, path, array_filters):
+                if operator == '$set':
+                    container[key] = copy.deepcopy(value)
+                elif operator == '$unset':
+                    container.pop(key, None)
+                elif operator == '$inc':
+                    container[key] = container.get(key, 0) + value
+                elif operator == '$push':
+                    container.setdefault(key, []).append(copy.deepcopy(value))
+                else:
+                    container[key] = [
+                        item for item in container.get(key, [])
+                        if not matches(item, value)]
+
+class _Result:
+
+    acknowledged = True
+
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+class MemoryCursor:
+
+    """Result of `find`, costs a round trip when it is read."""
+
+    def __init__(self, collection, query, projection):
+        self._collection = collection
+        self._query = query
+        self._projection = projection
+        self._documents = None
+        self._sort = None
+
+    def sort(self, key_or_list, direction=1):
+        """Order the results, as in Motor."""
+        if isinstance(key_or_list, str):
+            key_or_list = [(key_or_list, direction)]
+        self._sort = key_or_list
+        return self
+
+    def batch_size(self, _size):
+        """Accepted and ignored."""
+        return self
+
+    async def _fetch(self):
+        if self._documents is None:
+            found = await self._collection.find_documents(
+                self._query, self._sort)
+            self._documents = [
+                project(document, self._projection) for document in found]
+        return self._documents
+
+    async def to_list(self, length=None):
+        """All results, or the first `length`."""
+        documents = await self._fetch()
+        return documents[:length] if length else list(documents)
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for document in await self._fetch():
+            yield document
+
+class MemoryCollection:
+
+    """A collection of documents kept in a dict by _id."""
+
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+        self.documents = {}
+        self.round_trips = 0
+        self._unique = []
+
+    async def _round_trip(self):
+        self.round_trips += 1
+        self.database.round_trips += 1
+        await asyncio.sleep(self.database.latency)
+
+    def _check_unique(self, document, ignore=None):
+        for keys in self._unique:
+            values = [_get(document, key) for key in keys]
+            for other in self.documents.values():
+                if other is not ignore and \
+                        [_get(other, key) for key in keys] == values:
+                    raise DuplicateKeyError(
+                        "E11000 duplicate key error collection: {}".format(
+                            self.name), 11000)
+
+    def _find(self, query, sort=None):
+        found = [
+            document for document in self.documents.values()
+            if matches(document, query)]
+        for key, direction in reversed(sort or []):
+            found.sort(
+                key=lambda document, key=key: _get(document, key),
+                reverse=direction < 0)
+        return found
+
+    async def find_documents(self, query, sort=None):
+        """Matching documents themselves, for cursors."""
+        await self._round_trip()
+        return self._find(query, sort)
+
+    def find(self, query=None, projection=None, **_options):
+        """Cursor over the matches of `query`."""
+        return MemoryCursor(self, query, projection)
+
+    async def find_one(self, query=None, projection=None, sort=None, **_options):
+        """First match of `query` or None."""
+        await self._round_trip()
+        if query is not None and not isinstance(query, dict):
+            query = {'_id': query}
+        found = self._find(query, sort)
+        return project(found[0], projection) if found else None
+
+    async def count_documents(self, query):
+        """Number of matches of `query`."""
+        await self._round_trip()
+        return len(self._find(query))
+
+    async def insert_one(self, document):
+        """Insert `document`, setting its _id."""
+        await self._round_trip()
+        document.setdefault('_id', ObjectId())
+        self._check_unique(document)
+        self.documents[document['_id']] = copy.deepcopy(document)
+        return _Result(inserted_id=document['_id'])
+
+    async def insert_many(self, documents, ordered=True):
+        """Insert `documents` with a single round trip."""
+        await self._round_trip()
+        for document in documents:
+            document.setdefault('_id', ObjectId())
+            self._check_unique(document)
+            self.documents[document['_id']] = copy.deepcopy(document)
+        return _Result(
+            inserted_ids=[document['_id'] for document in documents])
+
+    def _update(self, document, update, array_filters):
+        changed = copy.deepcopy(document)
+        apply_update(changed, update, array_filters or ())
+        self._check_unique(changed, ignore=document)
+        self.documents[document['_id']] = changed
+        return changed
+
+    async def update_one(self, query, update, upsert=False, array_filters=None):
+        """Update the first match of `query`."""
+        await self._round_trip()
+        found = self._find(query)
+        if len(found) == 0 and upsert:
+            document = {
+                key: value for key, value in query.items()
+                if not key.startswith('$')}
+            document.setdefault('_id', ObjectId())
+            self.documents[document['_id']] = document
+            found = [document]
+        for document in found[:1]:
+            self._update(document, update, array_filters)
+        return _Result(
+            matched_count=len(found[:1]), modified_count=len(found[:1]))
+
+    async def update_many(self, query, update, upsert=False):
+        """Update every match of `query`."""
+        await self._round_trip()
+        found = self._find(query)
+        for document in found:
+            self._update(document, update, None)
+        return _Result(matched_count=len(found), modified_count=len(found))
+
+    async def replace_one(self, query, replacement, upsert=False):
+        """Replace the first match of `query`."""
+        await self._round_trip()
+        found = self._find(query)
+        if len(found) == 0 and not upsert:
+            return _Result(matched_count=0, modified_count=0)
+        replacement = copy.deepcopy(replacement)
+        if len(found) > 0:
+            del self.documents[found[0]['_id']]
+            replacement.setdefault('_id', found[0]['_id'])
+        replacement.setdefault('_id', ObjectId())
+        self.documents[replacement['_id']] = replacement
+        return _Result(matched_count=len(found[:1]), modified_count=1)
+
+    async def find_one_and_update(
+            self, query, update, projection=None, upsert=False,
+            return_document=ReturnDocument.BEFORE, array_filters=None):
+        """Update the first match of `query` and return it."""
+        await self._round_trip()
+        found = self._find(query)
+        if len(found) == 0:
+            return None
+        changed = self._update(found[0], update, array_filters)
+        if return_document == ReturnDocument.AFTER:
+            return project(changed, projection)
+        return project(found[0], projection)
+
+    async def bulk_write(self, requests, ordered=True):
+        """Apply pymongo UpdateOne requests with a single round trip."""
+        await self._round_trip()
+        modified = 0
+        for request in requests:
+            for document in self._find(request._filter)[:1]:
+                self._update(
+                    document, request._doc,
+                    getattr(request, '_array_filters', None))
+                modified += 1
+        return _Result(modified_count=modified)
+
+    async def delete_many(self, query):
+        """Delete every match of `query`."""
+        await self._round_trip()
+        found = self._find(query)
+        for document in found:
+            del self.documents[document['_id']]
+        return _Result(deleted_count=len(found))
+
+    async def create_index(self, keys, unique=False, **_options):
+        """Record the index, unique ones are enforced."""
+        await self._round_trip()
+        if isinstance(keys, str):
+            keys = [(keys, 1)]
+        if unique:
+            self._unique.append([key for key, _ in keys])
+        return '_'.join('{}_{}'.format(key, direction) for key, direction in keys)
+
+class MemoryDatabase:
+
+    """Collections by name, created on first use, as in Motor."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.round_trips = 0
+        self._collections = {}
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    def __getitem__(self, name):
+        if name not in self._collections:
+            self._collections[name] = MemoryCollection(self, name)
+        return self._collections[name]
+
+    def round_trips_per_collection(self):
+        """{collection name: round trips}, busiest first."""
+        return dict(sorted(
+            ((name, collection.round_trips)
+             for name, collection in self._collections.items()),
+            key=lambda item: -item[1]))
@@ -0,0 +1,66 @@
+"""
+Startup benchmark: import time per module.
+
+Runs ``python -X importtime`` in fresh interpreters and reports, per module,
+the fastest self and cumulative import time over all runs.
+
+    $ python benchmarks/startup.py
+    $ python benchmarks/startup.py --target dnd.views.character --top 40
+"""
+import sys
+import re
+import argparse
+import subprocess
+
+IMPORT_TIME = re.compile(
+    r"^import time:\s+(?P<self>\d+)\s+\|\s+(?P<cumulative>\d+)\s+\|"
+    r"(?P<indent>\s+)(?P<module>\S+)$")
+
+def measure(target):
+    """Import `target` in a fresh interpreter, return {module: (self, cumulative)}."""
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import {}'.format(target)],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True)
+    timings = {}
+    for line in process.stderr.splitlines():
+        match = IMPORT_TIME.match(line)
+        if match is not None:
+            timings[match.group('module')] = (
+                int(match.group('self')), int(match.group('cumulative')))
+    return timings
+
+def main():
+    """Run the benchmark and print a report."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument(
+        '--target', action='append',
+        help="module to import, may be repeated (default: dnd, "
+             "dnd.character and dnd.views.character)")
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=25)
+    args = parser.parse_args()
+    targets = args.target or ['dnd', 'dnd.character', 'dnd.views.character']
+    for target in targets:
+        best = {}
+        for _ in range(args.runs):
+            for module, (self_us, cumulative_us) in measure(target).items():
+                if module not in best:
+                    best[module] = (self_us, cumulative_us)
+                else:
+                    best[module] = (
+                        min(best[module][0], self_us),
+                        min(best[module][1], cumulative_us))
+        print("import {} ({} runs, best of each)".format(target, args.runs))
+        print("{:>12} {:>12}  {}".format("self [ms]", "total [ms]", "module"))
+        ranking = sorted(best.items(), key=lambda item: -item[1][1])
+        for module, (self_us, cumulative_us) in ranking[:args.top]:
+            print("{:12.1f} {:12.1f}  {}".format(
+                self_us / 1000, cumulative_us / 1000, module))
+        print("{} modules, {:.1f} ms self time in total\n".format(
+            len(best), sum(timing[0] for timing in best.values()) / 1000))
+
+if __name__ == '__main__':
+    main()
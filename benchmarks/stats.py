@@ -0,0 +1,280 @@
+"""
+Stats engine benchmark: calculate_stats and each of its steps.
+
+Times ``calculate_stats`` and every ``_character_*`` step on synthetic
+characters. Characters are generated deterministically for levels 1 to 20,
+every mix of classes and every race. Priests get the spheres that grant the
+most prayers, and everyone gets a large inventory and long markdown
+backgrounds. Allocations are measured per step with tracemalloc, in a
+separate pass so they do not distort the timings.
+
+    $ python benchmarks/stats.py --output before.json
+    $ python benchmarks/stats.py --output after.json --compare before.json
+"""
+import sys
+import copy
+import json
+import random
+import argparse
+import platform
+import statistics
+import tracemalloc
+from itertools import combinations
+from time import perf_counter
+
+from dnd.catalog import catalog_hash
+from dnd.character import (
+    ABILITIES,
+    CLASSES,
+    RACES,
+    SKILLS,
+    SPELLS,
+    PRAYERS,
+    POWERS,
+    BACKGROUND_FIELDS,
+    calculate_stats,
+    markdown_hash,
+    _dependency_graph)
+
+LEVELS = (1, 5, 10, 15, 20)
+
+def xp_for_level(level):
+    """Least xp needed for `level`."""
+    return 50 * level * (level - 1)
+
+def class_mixes():
+    """Every non-empty combination of classes, in catalog order."""
+    names = list(CLASSES)
+    return [
+        mix for size in range(1, len(names) + 1)
+        for mix in combinations(names, size)]
+
+def richest_spheres(count=3):
+    """The spheres, besides 'all', that grant the most prayers."""
+    sizes = {}
+    for prayer in PRAYERS.values():
+        if prayer['sphere'] != 'all':
+            sizes[prayer['sphere']] = sizes.get(prayer['sphere'], 0) + 1
+    return sorted(sizes, key=lambda sphere: (-sizes[sphere], sphere))[:count]
+
+def _markdown(rng, paragraphs):
+    words = [
+        'dragon', 'sword', 'tavern', 'oath', 'ruin', 'storm', 'harvest',
+        'shadow', 'crown', 'river', 'debt', 'wolf', 'temple', 'ash']
+    lines = []
+    for number in range(paragraphs):
+        lines.append("## Chapter {}".format(number + 1))
+        lines.append(" ".join(rng.choice(words) for _ in range(80)))
+        lines.append("* **{}** and _{}_".format(
+            rng.choice(words), rng.choice(words)))
+        lines.append("")
+    return "\n".join(lines)
+
+def generate(level, mix, race, seed, inventory_size=200, paragraphs=40):
+    """A stored character document, the same for the same arguments."""
+    rng = random.Random("{}-{}-{}-{}".format(level, mix, race, seed))
+    document = {
+        'name': "{} {}".format(race, "/".join(mix)),
+        'xp': xp_for_level(level),
+        'race_name': race,
+        'classes': [mix[index % len(mix)] for index in range(level)],
+        'hitpoints_per_level': [rng.randint(1, 6) for _ in range(level)],
+        'temp_hp': rng.randint(0, 3),
+        'damage': rng.randint(0, 5),
+        'skill_names': rng.sample(sorted(SKILLS), 12),
+        'power_names': rng.sample(sorted(POWERS), 3) \
+            if 'warlock' in mix else [],
+        'spell_names': sorted(
+            spell for spell in SPELLS
+            if SPELLS[spell]['circle'] <= 6) if 'wizard' in mix else [],
+        'prayer_spheres': ['all'] + richest_spheres(),
+        'prepared_spells': {},
+        'prepared_prayers': {},
+        'oros': rng.randint(0, 100000),
+        'inventory': {
+            'item {}'.format(number): {
+                'amount': rng.randint(1, 20),
+                'extra': '',
+                'description_unsafe': _markdown(rng, 1)}
+            for number in range(inventory_size)},
+        'weapons': [],
+        'armour': []}
+    for stat in ABILITIES:
+        document['{}_base'.format(stat)] = rng.randint(8, 18)
+    for field in BACKGROUND_FIELDS:
+        document['{}_unsafe'.format(field)] = _markdown(rng, paragraphs)
+    # store the rendered markdown, as the app does
+    calculated = copy.deepcopy(document)
+    calculate_stats(calculated)
+    for field in BACKGROUND_FIELDS:
+        document['{}_safe'.format(field)] = calculated['{}_safe'.format(field)]
+        document['{}_hash'.format(field)] = markdown_hash(
+            document['{}_unsafe'.format(field)])
+    document['inventory'] = calculated['inventory']
+    # fill the lower slots, so the slot accounting has work to do
+    for spell in document['spell_names'][:10]:
+        document['prepared_spells'][spell] = {'prepared': 1, 'cast': 0}
+    for prayer in sorted(calculated['prayers'])[:10]:
+        document['prepared_prayers'][prayer] = {'prepared': 1, 'cast': 0}
+    return document
+
+def profiles(levels, seed):
+    """(name, document) for every level and class mix, cycling races."""
+    races = list(RACES)
+    for level in levels:
+        for index, mix in enumerate(class_mixes()):
+            race = races[(index + level) % len(races)]
+            yield (
+                "level {:2d} {} ({})".format(level, "+".join(mix), race),
+                generate(level, mix, race, seed))
+
+def _step_name(step):
+    return step.__name__
+
+def time_profile(document, repeats):
+    """Microseconds for calculate_stats and each step, min and median."""
+    totals = []
+    steps = {_step_name(step): [] for step, _, _ in _dependency_graph()}
+    for _ in range(repeats):
+        character = copy.deepcopy(document)
+        start = perf_counter()
+        calculate_stats(character)
+        totals.append(perf_counter() - start)
+        character = copy.deepcopy(document)
+        for step, _, _ in _dependency_graph():
+            start = perf_counter()
+            step(character)
+            steps[_step_name(step)].append(perf_counter() - start)
+    def summary(samples):
+        return {
+            'min_us': min(samples) * 1e6,
+            'median_us': statistics.median(samples) * 1e6}
+    return summary(totals), {
+        name: summary(samples) for name, samples in steps.items()}
+
+def allocations(document):
+    """Peak and retained bytes allocated by each step."""
+    character = copy.deepcopy(document)
+    result = {}
+    tracemalloc.start()
+    try:
+        for step, _, _ in _dependency_graph():
+            tracemalloc.clear_traces()
+            step(character)
+            retained, peak = tracemalloc.get_traced_memory()
+            result[_step_name(step)] = {
+                'peak_bytes': peak, 'retained_bytes': retained}
+    finally:
+        tracemalloc.stop()
+    return result
+
+def run(levels, repeats, seed):
+    """Benchmark every profile, the result is what --output writes."""
+    results = {}
+    for name, document in profiles(levels, seed):
+        total, steps = time_profile(document, repeats)
+        results[name] = {
+            'calculate_stats': total,
+            'steps': steps,
+            'allocations': allocations(document)}
+    return {
+        'meta': {
+            'python': platform.python_version(),
+            'catalog_hash': catalog_hash(),
+            'levels': list(levels),
+            'repeats': repeats,
+            'seed': seed},
+        'results': results}
+
+def report(run_result):
+    """Print the steps summed over all profiles, and the slowest profiles."""
+    results = run_result['results']
+    print("{} profiles, {} repeats".format(
+        len(results), run_result['meta']['repeats']))
+    print("{:>12} {:>12} {:>12}  {}".format(
+        "median [ms]", "peak [kB]", "kept [kB]", "step (sum over profiles)"))
+    names = list(next(iter(results.values()))['steps'])
+    for name in names:
+        print("{:12.2f} {:12.1f} {:12.1f}  {}".format(
+            sum(result['steps'][name]['median_us']
+                for result in results.values()) / 1000,
+            max(result['allocations'][name]['peak_bytes']
+                for result in results.values()) / 1024,
+            sum(result['allocations'][name]['retained_bytes']
+                for result in results.values()) / 1024,
+            name))
+    print("{:12.2f} {:>12} {:>12}  calculate_stats".format(
+        sum(result['calculate_stats']['median_us']
+            for result in results.values()) / 1000, '', ''))
+    print("\nslowest profiles")
+    ranking = sorted(
+        results.items(),
+        key=lambda item: -item[1]['calculate_stats']['median_us'])
+    for name, result in ranking[:5]:
+        print("{:12.3f} ms  {}".format(
+            result['calculate_stats']['median_us'] / 1000, name))
+
+def compare(old, new, threshold, floor):
+    """
+    Print timings that got slower by more than `threshold`, return them.
+
+    Steps take from under a microsecond to a few hundred, so a slowdown
+    only counts if it is also more than `floor` microseconds.
+    """
+    regressions = []
+    for name, result in new['results'].items():
+        if name not in old['results']:
+            continue
+        before = old['results'][name]
+        pairs = [('calculate_stats', before['calculate_stats'],
+                  result['calculate_stats'])]
+        pairs.extend(
+            (step, before['steps'][step], timing)
+            for step, timing in result['steps'].items()
+            if step in before['steps'])
+        for step, then, now in pairs:
+            ratio = now['median_us'] / max(then['median_us'], 1e-3)
+            if ratio > 1 + threshold and \
+                    now['median_us'] - then['median_us'] > floor:
+                regressions.append((name, step, then['median_us'], now['median_us']))
+    if old['meta'].get('catalog_hash') != new['meta']['catalog_hash']:
+        print("note: the catalogs differ between the runs")
+    for name, step, then, now in regressions:
+        print("slower: {} {} {:.1f} -> {:.1f} us".format(name, step, then, now))
+    print("{} regressions over {:.0%} and {:g} us".format(
+        len(regressions), threshold, floor))
+    return regressions
+
+def main():
+    """Run the benchmark, print a report and optionally compare."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument(
+        '--level', type=int, action='append',
+        help="character level, may be repeated (default: {})".format(
+            ", ".join(str(level) for level in LEVELS)))
+    parser.add_argument('--repeats', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="write the results to this JSON file")
+    parser.add_argument(
+        '--compare', help="JSON file of an earlier run to compare with")
+    parser.add_argument(
+        '--threshold', type=float, default=0.1,
+        help="slowdown that counts as a regression (default: 0.1)")
+    parser.add_argument(
+        '--floor', type=float, default=5.0,
+        help="microseconds a regression has to add at least (default: 5)")
+    args = parser.parse_args()
+    result = run(args.level or LEVELS, args.repeats, args.seed)
+    report(result)
+    if args.output:
+        with open(args.output, 'w') as stream:
+            json.dump(result, stream, indent=1, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as stream:
+            old = json.load(stream)
+        print()
+        if compare(old, result, args.threshold, args.floor):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
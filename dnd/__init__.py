@@ -1,23 +1,10 @@
 """Dungeons & Dragons character sheet app."""
-from pathlib import Path
-import asyncio
-from pkg_resources import resource_filename, Requirement, cleanup_resources
-import uvloop
-from aiohttp import web
-import aiohttp_jinja2
-import jinja2
-from motor.motor_asyncio import AsyncIOMotorClient
-import aiohttp_session
-from aiohttp_session.cookie_storage import EncryptedCookieStorage
-import aiohttp_login
-from aiohttp_login.motor_storage import MotorStorage
-
+import sys
+from importlib import import_module
 from user_config import (
-    Config, Section, StringOption, IntegerOption, BooleanOption)
-from roman import toRoman
+    Config, Section, StringOption, IntegerOption, FloatOption, BooleanOption)
 
-from dnd.views.index import index_handler, new_character_data_handler
-from dnd.views.character import character_handler, data_handler
+from dnd.common import resource_path
 
 class DndConfiguration(Config):
 
@@ -191,21 +178,227 @@ class DndConfiguration(Config):
 
     authentication = AuthenticationSection()
 
+    class DatabaseSection(Section):
+
+        """MongoDB connection."""
+
+        uri = StringOption(
+            doc="MongoDB connection string",
+            default='mongodb://localhost:27017')
+        name = StringOption(doc="name of the database", default='dnd')
+        min_pool_size = IntegerOption(
+            doc="connections to keep open per server",
+            default=0)
+        max_pool_size = IntegerOption(
+            doc="maximum number of connections per server",
+            default=100)
+        server_selection_timeout = FloatOption(
+            doc="seconds to wait for a suitable server before failing",
+            default=10.0)
+        connect_timeout = FloatOption(
+            doc="seconds to wait for a new connection",
+            default=10.0)
+        socket_timeout = FloatOption(
+            doc="seconds to wait for a reply, 0 waits forever",
+            default=20.0)
+        compressors = StringOption(
+            doc=("comma separated wire compressors to offer the server, "
+                 "in order of preference: zstd, snappy or zlib, "
+                 "empty disables compression"),
+            default='zlib')
+        read_preference = StringOption(
+            doc=("primary, primaryPreferred, secondary, secondaryPreferred "
+                 "or nearest, reading from secondaries can return edits "
+                 "that are not yet visible"),
+            default='primary')
+
+    database = DatabaseSection()
+
+    class RateLimitSection(Section):
+
+        """Limits on character edits per user."""
+
+        backend = StringOption(
+            doc=("where to keep track of edits: memory (single process) "
+                 "or mongo (shared by all workers)"),
+            default='memory')
+        actions = IntegerOption(
+            doc=("number of character writes allowed per window, edits "
+                 "buffered into one write count once"),
+            default=8)
+        window = FloatOption(
+            doc="length of the window in seconds",
+            default=1.0)
+        batch_operations = IntegerOption(
+            doc="operations allowed in one batch edit",
+            default=8)
+
+    rate_limit = RateLimitSection()
+
+    class CacheSection(Section):
+
+        """Sizes of the in-process caches."""
+
+        fragments = IntegerOption(
+            doc=("number of rendered HTML fragments to keep, "
+                 "not used in debug mode"),
+            default=512)
+        characters = IntegerOption(
+            doc=("number of characters to keep with their statistics, "
+                 "0 disables the cache; with several processes, only use "
+                 "it if they forward invalidations to each other"),
+            default=256)
+        summaries = IntegerOption(
+            doc=("number of users to keep the character summaries of the "
+                 "navigation bar for, 0 disables the cache; with several "
+                 "processes, only use it if they forward invalidations to "
+                 "each other"),
+            default=1024)
+
+    cache = CacheSection()
+
+    class WritesSection(Section):
+
+        """Buffering of character edits."""
+
+        # metrics has an enabled option as well, they need distinct flags
+        enabled = BooleanOption(
+            doc=("collect the edits to a character that arrive while it is "
+                 "being written and write them with a single update"),
+            default=True,
+            long_name='--writes_enabled')
+        max_edits = IntegerOption(
+            doc=("edits to a character to collect during one write, "
+                 "further ones are refused as if rate limited"),
+            default=32)
+
+    writes = WritesSection()
+
+    class MetricsSection(Section):
+
+        """Prometheus metrics."""
+
+        enabled = BooleanOption(
+            doc=("serve metrics at /metrics, without access control: "
+                 "block it at the proxy"),
+            default=False)
+        loop_lag_interval = FloatOption(
+            doc="seconds between measurements of the event loop lag",
+            default=1.0)
+
+    metrics = MetricsSection()
+
+    class ProfilingSection(Section):
+
+        """Profiles of single requests, see `dnd profiles`."""
+
+        enabled = BooleanOption(
+            doc=("profile requests that carry the token in the X-Profile "
+                 "header or the profile query parameter"),
+            default=False,
+            long_name='--profiling_enabled')
+        token = StringOption(
+            doc="secret that asks for a profile, share it with admins only",
+            required=False)
+        directory = StringOption(
+            doc="where to store profiles, defaults to the user cache directory",
+            required=False)
+        keep = IntegerOption(
+            doc="number of profiles to keep, older ones are removed",
+            default=100)
+
+    profiling = ProfilingSection()
+
+    class StatsSection(Section):
+
+        """Statistics stored with characters for listings."""
+
+        refresh_batch_size = IntegerOption(
+            doc=("characters to recalculate at a time when the statistics "
+                 "engine or catalogs changed, 0 disables recalculation"),
+            default=100)
+        refresh_pause = FloatOption(
+            doc="seconds to wait between batches of recalculations",
+            default=1.0)
+
+    stats = StatsSection()
+
 def _cutoff_dict_filter(dictionary, cutoff):
     return {
         key: dictionary[key] for key in dictionary if dictionary[key] < cutoff}
 
-def start():
-    """Start Web server."""
-    config = DndConfiguration()
-    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+# maintenance commands, `dnd <command> --help` describes their options
+COMMANDS = {
+    'migrate': 'dnd.migrations:main',
+    'profiles': 'dnd.profiling:main',
+    'recalc': 'dnd.recalc:main',
+    'export': 'dnd.transfer:export_main',
+    'import': 'dnd.transfer:import_main',
+}
+
+def main():
+    """Run a maintenance command, or start the Web server."""
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        module_name, function_name = COMMANDS[sys.argv.pop(1)].split(':')
+        return getattr(import_module(module_name), function_name)()
+    return start()
+
+def create_app(config, database=None):
+    """
+    Build the Web application for `config`.
+
+    Connects to the MongoDB server in the configuration, unless a
+    `database` with the Motor interface is passed in.
+    """
+    # the server stack is imported only now, so that generating a
+    # configuration file does not pay for it
+    from aiohttp import web
+    import aiohttp_jinja2
+    import jinja2
+    import aiohttp_session
+    from aiohttp_session.cookie_storage import EncryptedCookieStorage
+    import aiohttp_login
+    from aiohttp_login.motor_storage import MotorStorage
+    from roman import toRoman
+    from dnd.views.index import index_handler, new_character_data_handler
+    from dnd.views.export import export_handler
+    from dnd.views.character import (
+        ATTRIBUTE_FUNCTIONS,
+        character_handler,
+        data_handler,
+        batch_handler,
+        live_handler)
+    from dnd.cache import LRUCache, CharacterCache
+    from dnd.coalesce import WriteCoalescer
+    from dnd.live import LiveHub
+    from dnd.character import MARKDOWN_CACHE
+    from dnd.database import connect, ensure_indexes_on_startup
+    from dnd.migrations import migrate_on_startup
+    from dnd.refresh import stale_stats_refresher
+    from dnd.ratelimit import create_rate_limiter, setup_rate_limiter
+    from dnd import metrics
+    from dnd.profiling import profiling_middleware, profile_directory
+
     app = web.Application(debug=config.server.debug)
     aiohttp_jinja2.setup(
         app,
-        loader=jinja2.FileSystemLoader(resource_filename(
-            Requirement.parse('dnd'), 'dnd/templates')),
+        loader=jinja2.FileSystemLoader(str(resource_path("templates"))),
         auto_reload=config.server.debug,
         context_processors=[aiohttp_login.flash.context_processor])
+    listeners = []
+    if config.metrics.enabled:
+        app['metrics'] = metrics.Metrics(ATTRIBUTE_FUNCTIONS)
+        metrics.instrument_templates(aiohttp_jinja2.get_env(app), app['metrics'])
+        listeners.append(metrics.MongoListener(app['metrics']))
+        # first, so that it times the other middlewares as well
+        app.middlewares.append(metrics.metrics_middleware)
+    if config.profiling.enabled:
+        if not config.profiling.token:
+            raise ValueError("profiling is enabled without a token")
+        app.middlewares.append(profiling_middleware(
+            profile_directory(config.profiling),
+            config.profiling.token,
+            config.profiling.keep))
     aiohttp_session.setup(app, EncryptedCookieStorage(
         config.server.session_secret,
         max_age=config.server.session_max_age))
@@ -214,23 +407,70 @@ def start():
     aiohttp_jinja2.get_env(app).filters['cutoff_dict'] = _cutoff_dict_filter
     app.middlewares.append(aiohttp_login.flash.middleware)
 
-    app['db_client'] = AsyncIOMotorClient()
-    app['db'] = app['db_client'].dnd
+    if database is None:
+        app['db_client'], app['db'] = connect(config, listeners)
+    else:
+        app['db'] = database
+    if config.cache.summaries > 0:
+        app['summary_cache'] = LRUCache(config.cache.summaries)
+    if config.cache.characters > 0:
+        app['character_cache'] = CharacterCache(config.cache.characters)
+    app['rate_limiter'] = create_rate_limiter(config.rate_limit, app['db'])
+    app['max_batch_operations'] = config.rate_limit.batch_operations
+    if not config.server.debug:
+        # templates are reloaded in debug mode, rendered fragments could go stale
+        app['fragment_cache'] = LRUCache(config.cache.fragments)
+    if config.writes.enabled:
+        app['write_coalescer'] = WriteCoalescer(config.writes.max_edits)
+    app['live_hub'] = LiveHub()
+    if config.metrics.enabled:
+        metrics.add_app_gauges(app, {
+            'summaries': app.get('summary_cache'),
+            'characters': app.get('character_cache'),
+            'fragments': app.get('fragment_cache'),
+            'markdown': MARKDOWN_CACHE})
+        start_watcher, stop_watcher = metrics.loop_lag_watcher(
+            config.metrics.loop_lag_interval)
+        app.on_startup.append(start_watcher)
+        app.on_cleanup.append(stop_watcher)
 
     auth_settings = {}
     for setting in config.authentication:
         auth_settings[setting.upper()] = config.authentication[setting]
     aiohttp_login.setup(app, MotorStorage(app['db']), auth_settings)
 
+    app.on_startup.append(migrate_on_startup)
+    app.on_startup.append(ensure_indexes_on_startup)
+    app.on_startup.append(setup_rate_limiter)
+    if config.stats.refresh_batch_size > 0:
+        start_refresher, stop_refresher = stale_stats_refresher(
+            config.stats.refresh_batch_size, config.stats.refresh_pause)
+        app.on_startup.append(start_refresher)
+        app.on_cleanup.append(stop_refresher)
+
     app.router.add_static(
         "/static/",
-        path=Path(__file__) / ".." / "static",
+        path=resource_path("static"),
         name="static")
     app.router.add_get("/", index_handler)
+    if config.metrics.enabled:
+        app.router.add_get("/metrics", metrics.metrics_handler)
     app.router.add_post("/api/new-character/", new_character_data_handler)
+    app.router.add_get("/api/export/", export_handler)
+    app.router.add_get("/ws/{id}/", live_handler)
     app.router.add_get("/{id}/{name}/", character_handler)
+    app.router.add_post("/api/{id}/batch/", batch_handler)
     app.router.add_post(
         "/api/{id}/{attribute}/{extra}/", data_handler)
     app.router.add_post("/api/{id}/{attribute}/", data_handler)
-    web.run_app(app, host=config.server.ip, port=config.server.port)
-    cleanup_resources()
+    return app
+
+def start():
+    """Start Web server."""
+    config = DndConfiguration()
+    import asyncio
+    import uvloop
+    from aiohttp import web
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    web.run_app(
+        create_app(config), host=config.server.ip, port=config.server.port)
@@ -0,0 +1,129 @@
+"""In-process caches."""
+from collections import OrderedDict
+
+class LRUCache:
+
+    """Bounded mapping that evicts the least recently used entry."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        """Look up `key`, counting the hit or miss."""
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def peek(self, key, default=None):
+        """Look up `key` without counting it or marking it as used."""
+        return self._data.get(key, default)
+
+    def put(self, key, value):
+        """Store `value`, evicting old entries if the cache is full."""
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """Remove `key` from the cache."""
+        return self._data.pop(key, default)
+
+    def clear(self):
+        """Remove all entries."""
+        self._data.clear()
+
+    @property
+    def hit_ratio(self):
+        """Fraction of lookups that were hits."""
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0.0
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+def _copy(value):
+    # frozen catalog entries and scalars are shared, containers are not
+    if isinstance(value, dict):
+        return {key: _copy(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_copy(item) for item in value]
+    return value
+
+class CharacterCache:
+
+    """
+    Characters with their statistics calculated, by id.
+
+    Every write to a character increments its `version`, entries are
+    replaced by newer versions only. Callers get their own copy, so they
+    can alter it freely. Listeners are called with the id and version of
+    every character this process writes, to tell other processes to
+    `invalidate` their copy.
+    """
+
+    def __init__(self, maxsize):
+        self._entries = LRUCache(maxsize)
+        self._listeners = []
+
+    def get(self, character_id):
+        """Copy of the cached character, or None."""
+        character = self._entries.get(str(character_id))
+        return None if character is None else _copy(character)
+
+    def put(self, character):
+        """Cache a copy of `character`, unless a newer version is cached."""
+        key = str(character['_id'])
+        cached = self._entries.peek(key)
+        if cached is not None and \
+                cached.get('version', 0) > character.get('version', 0):
+            return
+        self._entries.put(key, _copy(character))
+
+    def invalidate(self, character_id, version=None):
+        """Forget the character, if it is older than `version`."""
+        key = str(character_id)
+        cached = self._entries.peek(key)
+        if cached is not None and version is not None and \
+                cached.get('version', 0) >= version:
+            return
+        self._entries.pop(key)
+
+    def written(self, character):
+        """Cache `character` as written by this process and tell listeners."""
+        self.put(character)
+        for listener in self._listeners:
+            listener(character['_id'], character.get('version', 0))
+
+    def add_listener(self, listener):
+        """Call `listener(character_id, version)` after every local write."""
+        self._listeners.append(listener)
+
+    @property
+    def hits(self):
+        """Lookups that found the character."""
+        return self._entries.hits
+
+    @property
+    def misses(self):
+        """Lookups that did not find the character."""
+        return self._entries.misses
+
+    @property
+    def hit_ratio(self):
+        """Fraction of lookups that found the character."""
+        return self._entries.hit_ratio
+
+    def __len__(self):
+        return len(self._entries)
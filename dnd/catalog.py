@@ -0,0 +1,197 @@
+"""Precompiled game data catalogs."""
+import sys
+import os
+import marshal
+import hashlib
+from collections.abc import Mapping, Set
+from functools import lru_cache
+from types import MappingProxyType
+from pathlib import Path
+from appdirs import AppDirs
+from dnd.common import resource_path
+
+CONFIG_PATH = resource_path("config")
+
+CATALOG_FILES = (
+    ('races', 'races.yaml'),
+    ('skills', 'skills.yaml'),
+    ('spells', 'spells.yaml'),
+    ('prayers', 'prayers.yaml'),
+    ('weapons', 'weapons.yaml'),
+    ('armour', 'armour.yaml'),
+    ('powers', 'powers.yaml'),
+    ('classes', 'classes.yaml'))
+
+# bump when the layout of the compiled bundle changes
+BUNDLE_FORMAT = 1
+
+def catalog_hash():
+    """Hash the catalog sources, the bundle format and the marshal format."""
+    digest = hashlib.sha256()
+    digest.update("{}-{}-{}".format(
+        BUNDLE_FORMAT,
+        marshal.version,
+        "{}.{}".format(*sys.version_info[:2])).encode())
+    for _, file_name in CATALOG_FILES:
+        digest.update(file_name.encode())
+        digest.update((CONFIG_PATH / file_name).read_bytes())
+    return digest.hexdigest()
+
+@lru_cache(maxsize=None)
+def sources_hash():
+    """Hash of the catalog sources only, which character statistics depend on."""
+    digest = hashlib.sha256()
+    for _, file_name in CATALOG_FILES:
+        digest.update(file_name.encode())
+        digest.update((CONFIG_PATH / file_name).read_bytes())
+    return digest.hexdigest()
+
+def bundle_path(content_hash):
+    """Location of the compiled bundle for a given catalog hash."""
+    return Path(AppDirs('dnd', 'nihlaeth').user_cache_dir) / \
+        "catalogs-{}.marshal".format(content_hash[:16])
+
+def _parse(file_name, lower=True):
+    # yaml is only needed when the bundle has to be (re)built
+    from yaml import load_all
+    try:
+        from yaml import CSafeLoader as Loader
+    except ImportError:
+        from yaml import SafeLoader as Loader
+    with (CONFIG_PATH / file_name).open('rb') as stream:
+        return {
+            entry['name'].lower() if lower else entry['name']: entry
+            for entry in load_all(stream, Loader=Loader)
+            if entry is not None}
+
+def compile_catalogs():
+    """Parse the yaml catalogs and compute the derived sets."""
+    catalogs = {
+        name: _parse(file_name, lower=name != 'races')
+        for name, file_name in CATALOG_FILES}
+    prayers = catalogs['prayers']
+    weapons = catalogs['weapons']
+    armour = catalogs['armour']
+    catalogs['prayer_spheres'] = {
+        prayers[prayer]['sphere'] for prayer in prayers}
+    catalogs['weapon_categories'] = {
+        weapons[weapon]['weapon_category'] for weapon in weapons}
+    catalogs['weapon_sizes'] = {
+        size for weapon in weapons for size in weapons[weapon]['size']}
+    catalogs['weapon_ages'] = {
+        age for weapon in weapons \
+        for size in weapons[weapon]['size'] \
+        for age in weapons[weapon]['size'][size]['time_period']}
+    catalogs['armour_ages'] = {
+        age for item in armour for age in armour[item]['time_period']}
+    return catalogs
+
+def write_bundle(catalogs, content_hash):
+    """Store compiled catalogs, replacing bundles of older catalog versions."""
+    path = bundle_path(content_hash)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temporary_path = path.with_suffix('.{}.tmp'.format(os.getpid()))
+    with temporary_path.open('wb') as stream:
+        marshal.dump(catalogs, stream)
+    os.replace(str(temporary_path), str(path))
+    for old_bundle in path.parent.glob('catalogs-*.marshal'):
+        if old_bundle != path:
+            try:
+                old_bundle.unlink()
+            except OSError:
+                pass
+    return path
+
+def load_catalogs():
+    """
+    Load the compiled catalogs, rebuilding the bundle if the yaml changed.
+
+    If the cache directory is not writable the catalogs are parsed in
+    process, exactly as they would be compiled.
+    """
+    content_hash = catalog_hash()
+    try:
+        with bundle_path(content_hash).open('rb') as stream:
+            return marshal.load(stream)
+    except (OSError, EOFError, ValueError, TypeError):
+        pass
+    catalogs = compile_catalogs()
+    try:
+        write_bundle(catalogs, content_hash)
+    except OSError:
+        pass
+    return catalogs
+
+def freeze(value):
+    """Deep read-only view of catalog data."""
+    if isinstance(value, dict):
+        return MappingProxyType({
+            key: freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze(item) for item in value)
+    if isinstance(value, set):
+        return frozenset(value)
+    return value
+
+@lru_cache(maxsize=None)
+def catalogs():
+    """
+    Catalogs of this process, loaded once.
+
+    Entries are frozen, so characters can refer to them directly instead
+    of working on copies.
+    """
+    return freeze(load_catalogs())
+
+class LazyCatalog(Mapping):
+
+    """Read-only view on a catalog that is loaded on first access."""
+
+    def __init__(self, name):
+        self._name = name
+        self._data = None
+
+    def _load(self):
+        if self._data is None:
+            self._data = catalogs()[self._name]
+        return self._data
+
+    def __getitem__(self, key):
+        return self._load()[key]
+
+    def __contains__(self, key):
+        return key in self._load()
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def __len__(self):
+        return len(self._load())
+
+    def __repr__(self):
+        return "{}({!r})".format(self.__class__.__name__, self._name)
+
+class LazySet(Set):
+
+    """Read-only view on a derived catalog set that is loaded on first access."""
+
+    def __init__(self, name):
+        self._name = name
+        self._data = None
+
+    def _load(self):
+        if self._data is None:
+            self._data = catalogs()[self._name]
+        return self._data
+
+    def __contains__(self, item):
+        return item in self._load()
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def __len__(self):
+        return len(self._load())
+
+    def __repr__(self):
+        return "{}({!r})".format(self.__class__.__name__, self._name)
@@ -1,55 +1,36 @@
 """Character tools."""
 import copy
+import hashlib
 from collections import OrderedDict
-from pkg_resources import resource_stream, Requirement
+from functools import lru_cache
 from markupsafe import escape
-from markdown import markdown
-from yaml import load_all
-try:
-    from yaml import CSafeLoader as Loader
-except ImportError:
-    from yaml import SafeLoader as Loader
+from markdown import markdown, __version__ as markdown_version
+from dnd.catalog import LazyCatalog, LazySet, catalogs, sources_hash
+from dnd.cache import LRUCache
 
-RACES = {race['name']: race for race in load_all(
-    resource_stream(Requirement.parse('dnd'), 'dnd/config/races.yaml'),
-    Loader=Loader) if race is not None}
+RACES = LazyCatalog('races')
 
-SKILLS = {skill['name'].lower(): skill for skill in load_all(
-    resource_stream(Requirement.parse('dnd'), 'dnd/config/skills.yaml'),
-    Loader=Loader) if skill is not None}
+SKILLS = LazyCatalog('skills')
 
-SPELLS = {spell['name'].lower(): spell for spell in load_all(
-    resource_stream(Requirement.parse('dnd'), 'dnd/config/spells.yaml'),
-    Loader=Loader) if spell is not None}
+SPELLS = LazyCatalog('spells')
 
-PRAYERS = {prayer['name'].lower(): prayer for prayer in load_all(
-    resource_stream(Requirement.parse('dnd'), 'dnd/config/prayers.yaml'),
-    Loader=Loader) if prayer is not None}
+PRAYERS = LazyCatalog('prayers')
 
-PRAYER_SPHERES = {PRAYERS[prayer]['sphere'] for prayer in PRAYERS}
+PRAYER_SPHERES = LazySet('prayer_spheres')
 
-WEAPONS = {weapon['name'].lower(): weapon for weapon in load_all(
-    resource_stream(Requirement.parse('dnd'), 'dnd/config/weapons.yaml'),
-    Loader=Loader) if weapon is not None}
+WEAPONS = LazyCatalog('weapons')
 
-WEAPON_CATEGORIES = {WEAPONS[weapon]['weapon_category'] for weapon in WEAPONS}
+WEAPON_CATEGORIES = LazySet('weapon_categories')
 
-WEAPON_SIZES = {size for weapon in WEAPONS for size in WEAPONS[weapon]['size']}
+WEAPON_SIZES = LazySet('weapon_sizes')
 
-WEAPON_AGES = {
-    age for weapon in WEAPONS \
-    for size in WEAPONS[weapon]['size'] \
-    for age in WEAPONS[weapon]['size'][size]['time_period']}
+WEAPON_AGES = LazySet('weapon_ages')
 
-ARMOUR = {armour['name'].lower(): armour for armour in load_all(
-    resource_stream(Requirement.parse('dnd'), 'dnd/config/armour.yaml'),
-    Loader=Loader) if armour is not None}
+ARMOUR = LazyCatalog('armour')
 
-ARMOUR_AGES = {age for armour in ARMOUR for age in ARMOUR[armour]['time_period']}
+ARMOUR_AGES = LazySet('armour_ages')
 
-POWERS = {power['name'].lower(): power for power in load_all(
-    resource_stream(Requirement.parse('dnd'), 'dnd/config/powers.yaml'),
-    Loader=Loader) if power is not None}
+POWERS = LazyCatalog('powers')
 
 ABILITIES = [
     'strength',
@@ -60,6 +41,15 @@ ABILITIES = [
     'charisma',
     'perception']
 
+# the score itself has no suffix
+ABILITY_PARTS = ('base', 'temp', 'level', 'bonus', '', 'modifier')
+
+# keys of the parts of every ability, in the order of ABILITY_PARTS, built
+# once so the stats engine does not format and hash them per character
+ABILITY_KEYS = [
+    tuple('{}_{}'.format(stat, part) if part else stat for part in ABILITY_PARTS)
+    for stat in ABILITIES]
+
 COINS = OrderedDict([
     ('oros', 1),
     ('dies', 24),
@@ -67,9 +57,17 @@ COINS = OrderedDict([
     ('mensis', 24 * 6 * 5),
     ('annum', 24 * 6 * 5 * 12)])
 
-CLASSES = {class_['name'].lower(): class_ for class_ in load_all(
-    resource_stream(Requirement.parse('dnd'), 'dnd/config/classes.yaml'),
-    Loader=Loader) if class_ is not None}
+CLASSES = LazyCatalog('classes')
+
+BACKGROUND_FIELDS = ['appearance', 'character', 'history']
+
+# rendered markdown that is not (yet) stored with its source text
+MARKDOWN_CACHE = LRUCache(1024)
+
+@lru_cache(maxsize=None)
+def class_names():
+    """Names of the classes, iterating the catalog itself is slower."""
+    return tuple(CLASSES)
 
 def convert_coins(coins):
     """
@@ -89,21 +87,179 @@ def convert_coins(coins):
             oros += COINS[coin] * coins[coin]
         return int(oros)
 
-def calculate_stats(character):
-    """Calculate and set characters statistics."""
+def markdown_hash(text):
+    """Hash of user supplied markdown text and the renderer that renders it."""
+    return hashlib.sha1('markdown {}\n{}'.format(
+        markdown_version, text).encode()).hexdigest()
+
+def render_markdown(text, digest=None):
+    """Render user supplied markdown to HTML, escaping any HTML in it."""
+    if digest is None:
+        digest = markdown_hash(text)
+    html = MARKDOWN_CACHE.get(digest)
+    if html is None:
+        html = markdown(escape(text))
+        MARKDOWN_CACHE.put(digest, html)
+    return html
+
+SUMMARY_FIELDS = [
+    'name',
+    'created_at',
+    'current_campaign_name',
+    'xp',
+    'classes',
+    'race_name',
+    'hitpoints_per_level',
+    'temp_hp',
+    'damage',
+    'constitution_base',
+    'constitution_temp',
+    'constitution_level',
+    'computed']
+
+# bump when a calculation changes, so stored statistics are recalculated
+STATS_VERSION = 1
+
+COMPUTED_FIELDS = [
+    'level',
+    'unspent_ability_points',
+    'power_skill_slots',
+    'unspent_skill_slots',
+    'spell_slots',
+    'leftover_spell_slots',
+    'invalid_prepared_spells',
+    'prayer_slots',
+    'leftover_prayer_slots',
+    'invalid_prepared_prayers',
+    'max_hp',
+    'hp']
+
+@lru_cache(maxsize=None)
+def stats_stamp():
+    """Identifies the statistics engine and catalogs stored statistics came from."""
+    return '{}-{}'.format(STATS_VERSION, sources_hash()[:16])
+
+def computed_stats(character):
+    """
+    Statistics of a calculated `character` to store with it.
+
+    Only plain values are kept, the catalog entries that the full sheet
+    needs are looked up again when it is shown.
+    """
+    computed = {'stamp': stats_stamp()}
+    for field in COMPUTED_FIELDS:
+        value = character[field]
+        computed[field] = list(value) if isinstance(value, tuple) else value
+    for class_ in CLASSES:
+        computed[class_] = character[class_]
+    for keys in ABILITY_KEYS:
+        for field in keys[3:]:
+            computed[field] = character[field]
+    return computed
+
+def calculate_summary(character):
+    """
+    Calculate the statistics shown in character listings.
+
+    Only needs the `SUMMARY_FIELDS` of a character and sets level, classes
+    and hit points. Statistics stored with the character are used as they
+    are, unless they were calculated by another engine or catalog version.
+    """
+    computed = character.get('computed')
+    if computed is not None and computed.get('stamp') == stats_stamp():
+        character.update(computed)
+        return
     _character_level(character)
     _character_classes(character)
     _character_race(character)
     _character_abilities(character)
-    _character_powers(character)
-    _character_skills(character)
     _character_hit_points(character)
-    _character_background(character)
-    _character_spells(character)
-    _character_prayers(character)
-    _character_money(character)
-    _character_inventory(character)
-    _character_equipment(character)
+
+def calculate_stats(character):
+    """Calculate and set characters statistics."""
+    for step, _, _ in _dependency_graph():
+        step(character)
+
+_MISSING = object()
+
+def recalculate(character, changed_fields):
+    """
+    Recalculate only the statistics that depend on `changed_fields`.
+
+    `character` must have been through `calculate_stats` before its stored
+    fields in `changed_fields` were altered. Returns the set of changed
+    fields: `changed_fields` plus every derived field whose value differs
+    from before.
+    """
+    dirty = set(changed_fields)
+    changed = set(changed_fields)
+    for step, reads, writes in _dependency_graph():
+        if dirty.isdisjoint(reads):
+            continue
+        before = {
+            field: _snapshot(character.get(field, _MISSING))
+            for field in writes}
+        step(character)
+        for field in writes:
+            if character.get(field, _MISSING) != before[field]:
+                changed.add(field)
+                dirty.add(field)
+    return changed
+
+def _snapshot(value):
+    # steps extend lists and fill dicts in place, catalog entries are frozen
+    if isinstance(value, (list, dict)):
+        return copy.copy(value)
+    return value
+
+@lru_cache(maxsize=None)
+def _dependency_graph():
+    """Stats steps in evaluation order, with the fields they read and write."""
+    class_fields = frozenset(CLASSES)
+    ability_inputs = frozenset(key for keys in ABILITY_KEYS for key in keys[:3])
+    ability_outputs = frozenset(
+        key for keys in ABILITY_KEYS for key in keys) | {
+            'unspent_ability_points'}
+    return (
+        (_character_level, {'xp'}, {'xp', 'level'}),
+        (_character_classes, {'classes', 'level'}, {'classes'} | class_fields),
+        (_character_race, {'race_name'}, {'race_name', 'race'}),
+        (_character_abilities, {'level', 'race'} | ability_inputs, ability_outputs),
+        (_character_powers, {'power_names'}, {'powers', 'power_skill_slots'}),
+        (
+            _character_skills,
+            {'skill_names', 'classes', 'race', 'power_skill_slots'} | \
+            class_fields | ability_outputs,
+            {'skills', 'skill_checks', 'unspent_skill_slots'}),
+        (
+            _character_hit_points,
+            {
+                'hitpoints_per_level', 'level', 'classes',
+                'constitution_modifier', 'temp_hp', 'damage'},
+            {'hitpoints_per_level', 'max_hp', 'temp_hp', 'damage', 'hp'}),
+        (
+            _character_background,
+            {
+                '{}_{}'.format(field, part) for field in BACKGROUND_FIELDS
+                for part in ('unsafe', 'safe', 'hash')},
+            {'{}_safe'.format(field) for field in BACKGROUND_FIELDS}),
+        (
+            _character_spells,
+            {'spell_names', 'wizard', 'prepared_spells'},
+            {
+                'spells', 'spell_slots', 'invalid_prepared_spells',
+                'leftover_spell_slots', 'prepared_spells'}),
+        (
+            _character_prayers,
+            {
+                'prayer_names', 'prayer_spheres', 'priest',
+                'wisdom_modifier', 'prepared_prayers'},
+            {
+                'prayers', 'prayer_slots', 'invalid_prepared_prayers',
+                'leftover_prayer_slots', 'prepared_prayers'}),
+        (_character_money, {'oros'}, {'oros', 'coins'}),
+        (_character_inventory, {'inventory'}, {'inventory'}),
+        (_character_equipment, {'weapons', 'armour'}, {'weapons', 'armour'}))
 
 def _character_level(character):
     xp = character.get('xp', 0)
@@ -116,8 +272,6 @@ def _character_level(character):
     character['level'] = level
 
 def _character_classes(character):
-    for class_ in CLASSES:
-        character[class_] = 0
     classes = character.get('classes', [])
     missing = character['level'] - len(classes)
     default_class = 'fighter' if len(classes) == 0 else classes[0]
@@ -126,9 +280,10 @@ def _character_classes(character):
     elif missing < 0:
         classes = classes[:character['level']]
     character['classes'] = classes
-    for i, class_ in enumerate(classes):
-        if i < character['level']:
-            character[class_] += 1
+    for class_ in class_names():
+        character[class_] = 0
+    for class_ in classes[:character['level']]:
+        character[class_] += 1
 
 def _character_race(character):
     race_name = character.get('race_name', 'Truman')
@@ -138,20 +293,17 @@ def _character_race(character):
 def _character_abilities(character):
     ability_points_to_spend = int(character['level'] / 4)
     spent_ability_points = 0
-    for stat in ABILITIES:
-        base_stat = '{}_base'.format(stat)
+    race_bonus = character['race']['bonus']
+    for keys in ABILITY_KEYS:
+        base_stat, temp_stat, level_stat, bonus_stat, stat, modifier_stat = keys
         base = character.get(base_stat, 0)
         character[base_stat] = base
-        temp_stat = '{}_temp'.format(stat)
         temp = character.get(temp_stat, 0)
         character[temp_stat] = temp
-        level_stat = '{}_level'.format(stat)
         level = character.get(level_stat, 0)
         spent_ability_points += abs(level)
         character[level_stat] = level
-        # calculate bonus
-        bonus_stat = '{}_bonus'.format(stat)
-        bonus = character['race']['bonus'].get(stat, 0)
+        bonus = race_bonus.get(stat, 0)
         character[bonus_stat] = bonus
 
         value = base + temp + level + bonus
@@ -161,7 +313,6 @@ def _character_abilities(character):
             value = 1
         character[stat] = value
 
-        modifier_stat = '{}_modifier'.format(stat)
         modifier = int((value - 10) // 3)
         if modifier < -3:
             modifier = -3
@@ -174,29 +325,32 @@ def _character_powers(character):
     power_names = character.get('power_names', [])
     character['powers'] = {}
     character['power_skill_slots'] = 0
+    powers = catalogs()['powers']
     for power in power_names:
         character['power_skill_slots'] += 2
-        if power in POWERS:
-            character['powers'][power] = copy.deepcopy(POWERS[power])
+        if power in powers:
+            character['powers'][power] = powers[power]
 
 def _character_skill_check(character, skill):
-    if character['skills'][skill]['skill_check'] is None:
-        character['skills'][skill]['skill_check_text'] = '-'
-        character['skills'][skill]['skill_check_value'] = None
+    skill_check = character['skills'][skill]['skill_check']
+    if skill_check is None:
+        character['skill_checks'][skill] = {'text': '-', 'value': None}
         return
-    character['skills'][skill]['skill_check_text'] = ' + '.join([
-        str(element) if not str(element).endswith(
-            '_modifier') else "[{}]".format(
-                element[0:-9]) for element in character['skills'][skill]['skill_check']])
-    character['skills'][skill]['skill_check_value'] = sum([
-        character[element]  if isinstance(
-            element,
-            str) else element for element in character['skills'][skill]['skill_check']])
+    character['skill_checks'][skill] = {
+        'text': ' + '.join([
+            str(element) if not str(element).endswith(
+                '_modifier') else "[{}]".format(
+                    element[0:-9]) for element in skill_check]),
+        'value': sum([
+            character[element]  if isinstance(
+                element,
+                str) else element for element in skill_check])}
 
 def _character_skill_slots(character):
     class_skill_slots = 0
-    for class_ in CLASSES:
-        class_skill_slots += CLASSES[class_]['skill_slots'] * character[class_]
+    classes = catalogs()['classes']
+    for class_ in classes:
+        class_skill_slots += classes[class_]['skill_slots'] * character[class_]
     skill_slots = 5 + class_skill_slots + character['intelligence_modifier']
     skill_slots -= character['power_skill_slots']
     if character['classes'][0] == "warlock":
@@ -221,19 +375,22 @@ def _character_skill_slots(character):
 def _character_skills(character):
     skill_names = character.get('skill_names', [])
     character['skills'] = {}
+    character['skill_checks'] = {}
+    skills = catalogs()['skills']
     for skill in skill_names:
-        if skill in SKILLS:
-            character['skills'][skill] = copy.deepcopy(SKILLS[skill])
+        if skill in skills:
+            character['skills'][skill] = skills[skill]
             _character_skill_check(character, skill)
     _character_skill_slots(character)
 
 def _character_spells(character):
     spell_names = character.get('spell_names', [])
     character['spells'] = {}
+    spells = catalogs()['spells']
     for spell in spell_names:
         spell = spell.lower()
-        if spell in SPELLS:
-            character['spells'][spell] = copy.deepcopy(SPELLS[spell])
+        if spell in spells:
+            character['spells'][spell] = spells[spell]
     spell_slots = (
         tuple(),
         (2,),
@@ -257,16 +414,15 @@ def _character_spells(character):
         (6, 5, 4, 3, 2),
         (6, 5, 4, 3, 2, 1))
     character['spell_slots'] = spell_slots[character['wizard']]
-    character['invalid_prepared_spells'] = character.get(
-        'invalid_prepared_spells', 0)
+    character['invalid_prepared_spells'] = 0
     leftover_spell_slots = list(character['spell_slots'])
     prepared_spells = character.get('prepared_spells', {})
     character['prepared_spells'] = prepared_spells
     for spell in prepared_spells:
-        if SPELLS[spell]['circle'] > len(leftover_spell_slots):
+        if spells[spell]['circle'] > len(leftover_spell_slots):
             character['invalid_prepared_spells'] += prepared_spells[spell]['prepared']
             continue
-        leftover_spell_slots[SPELLS[spell]['circle'] - 1] -= prepared_spells[spell]['prepared']
+        leftover_spell_slots[spells[spell]['circle'] - 1] -= prepared_spells[spell]['prepared']
     debt_stack = []
     for i in range(len(leftover_spell_slots)):
         if leftover_spell_slots[i] < 0:
@@ -313,25 +469,26 @@ def _character_prayers(character):
     character['prayer_slots'] = list(prayer_slots[character['priest']])
     if character['priest'] > 0:
         character['prayer_slots'][-1] += character['wisdom_modifier']
-    for prayer in PRAYERS:
-        if PRAYERS[prayer]['sphere'] in spheres and \
-                PRAYERS[prayer]['circle'] <= len(character['prayer_slots']):
+    # the loop below runs over every prayer, look the catalog up once
+    prayers = catalogs()['prayers']
+    for prayer, entry in prayers.items():
+        if entry['sphere'] in spheres and \
+                entry['circle'] <= len(character['prayer_slots']):
             prayer_names.add(prayer)
     character['prayers'] = {}
     for prayer in prayer_names:
         prayer = prayer.lower()
-        if prayer in PRAYERS:
-            character['prayers'][prayer] = copy.deepcopy(PRAYERS[prayer])
-    character['invalid_prepared_prayers'] = character.get(
-        'invalid_prepared_prayers', 0)
+        if prayer in prayers:
+            character['prayers'][prayer] = prayers[prayer]
+    character['invalid_prepared_prayers'] = 0
     leftover_prayer_slots = copy.copy(character['prayer_slots'])
     prepared_prayers = character.get('prepared_prayers', {})
     character['prepared_prayers'] = prepared_prayers
     for prayer in prepared_prayers:
-        if PRAYERS[prayer]['circle'] > len(leftover_prayer_slots):
+        if prayers[prayer]['circle'] > len(leftover_prayer_slots):
             character['invalid_prepared_prayers'] += prepared_prayers[prayer]['prepared']
             continue
-        leftover_prayer_slots[PRAYERS[prayer]['circle'] - 1] -= prepared_prayers[prayer]['prepared']
+        leftover_prayer_slots[prayers[prayer]['circle'] - 1] -= prepared_prayers[prayer]['prepared']
     debt_stack = []
     for i in range(len(leftover_prayer_slots)):
         if leftover_prayer_slots[i] < 0:
@@ -375,18 +532,21 @@ def _character_money(character):
 
 def _character_inventory(character):
     character['inventory'] = character.get('inventory', {})
-    for item in character['inventory']:
-        character['inventory'][item]['description'] = markdown(escape(
-            character['inventory'][item]['description_unsafe']))
+    for item in character['inventory'].values():
+        digest = markdown_hash(item['description_unsafe'])
+        if item.get('description_hash') != digest:
+            item['description'] = render_markdown(
+                item['description_unsafe'], digest)
+            item['description_hash'] = digest
 
 def _character_equipment(character):
     character['weapons'] = character.get('weapons', [])
     character['armour'] = character.get('armour', [])
 
 def _character_background(character):
-    character['appearance_safe'] = markdown(escape(
-        character.get('appearance_unsafe', '')))
-    character['character_safe'] = markdown(escape(
-        character.get('character_unsafe', '')))
-    character['history_safe'] = markdown(escape(
-        character.get('history_unsafe', '')))
+    for field in BACKGROUND_FIELDS:
+        text = character.get('{}_unsafe'.format(field), '')
+        digest = markdown_hash(text)
+        if character.get('{}_hash'.format(field)) != digest or \
+                '{}_safe'.format(field) not in character:
+            character['{}_safe'.format(field)] = render_markdown(text, digest)
@@ -0,0 +1,120 @@
+"""Write-behind buffering of character edits."""
+import asyncio
+import logging
+
+LOGGER = logging.getLogger(__name__)
+
+class _Buffer:
+
+    def __init__(self, flush, opened_at):
+        self.flush = flush
+        self.opened_at = opened_at
+        self.items = []
+        self.futures = []
+
+class BufferFull(Exception):
+
+    """The buffer of a key holds as many items as it may."""
+
+class WriteCoalescer:
+
+    """
+    Flush items per key, collecting those that arrive during a flush.
+
+    `flush` is a coroutine function that takes the list of items and
+    returns one result per item, every submitter gets its own result.
+    An item is flushed at once if no flush of its key is in flight.
+    Otherwise it is collected with the other items that arrive meanwhile,
+    and they are flushed together as soon as the flush in flight is done,
+    so flushes of the same key never overlap and only items that overlap
+    are merged. A buffer takes at most `max_items` items, further ones are
+    rejected until it is flushed.
+    """
+
+    def __init__(self, max_items):
+        self.max_items = max_items
+        self.flushes = 0
+        self.items = 0
+        self.max_batch_size = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.rejected = 0
+        self._buffers = {}
+        self._writing = set()
+        self._tasks = set()
+
+    def is_open(self, key):
+        """Whether items for `key` are being collected right now."""
+        return key in self._writing
+
+    async def submit(self, key, item, flush):
+        """
+        Flush `item` with the other items of `key` that overlap it.
+
+        Waits for its result. Raises BufferFull if the buffer already holds
+        `max_items` items.
+        """
+        loop = asyncio.get_event_loop()
+        if key not in self._writing:
+            buffer = _Buffer(flush, loop.time())
+            self._writing.add(key)
+            self._start_flush(key, buffer)
+        else:
+            buffer = self._buffers.get(key)
+            if buffer is None:
+                buffer = self._buffers[key] = _Buffer(flush, loop.time())
+            elif len(buffer.items) >= self.max_items:
+                self.rejected += 1
+                raise BufferFull(key)
+        future = loop.create_future()
+        buffer.items.append(item)
+        buffer.futures.append(future)
+        return await future
+
+    def _start_flush(self, key, buffer):
+        # the loop only keeps a weak reference to tasks
+        task = asyncio.ensure_future(self._flush(key, buffer))
+        self._tasks.add(task)
+        task.add_done_callback(self._flush_done)
+
+    def _flush_done(self, task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            LOGGER.error(
+                "write buffer flush failed", exc_info=task.exception())
+
+    async def _flush(self, key, buffer):
+        latency = asyncio.get_event_loop().time() - buffer.opened_at
+        self.flushes += 1
+        self.items += len(buffer.items)
+        self.max_batch_size = max(self.max_batch_size, len(buffer.items))
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+        try:
+            results = await buffer.flush(buffer.items)
+        except Exception as error:  # pylint: disable=broad-except
+            LOGGER.exception(
+                "flushing %d edits of %s failed", len(buffer.items), key)
+            for future in buffer.futures:
+                if not future.done():
+                    future.set_exception(error)
+        else:
+            for future, result in zip(buffer.futures, results):
+                if not future.done():
+                    future.set_result(result)
+        finally:
+            following = self._buffers.pop(key, None)
+            if following is None:
+                self._writing.discard(key)
+            else:
+                self._start_flush(key, following)
+
+    @property
+    def mean_batch_size(self):
+        """Average number of items written per flush."""
+        return self.items / self.flushes if self.flushes else 0.0
+
+    @property
+    def mean_latency(self):
+        """Average seconds items waited for their flush to start."""
+        return self.total_latency / self.flushes if self.flushes else 0.0
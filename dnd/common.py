@@ -1,3 +1,12 @@
+"""Helpers shared by the views."""
+from pathlib import Path
+
+PACKAGE_PATH = Path(__file__).parent
+
+def resource_path(*parts):
+    """Path to a file that ships inside the dnd package."""
+    return PACKAGE_PATH.joinpath(*parts)
+
 def format_errors(errors):
     return "\n".join(["""
 <div class="alert alert-danger alert-dismissable fade in">
@@ -0,0 +1,226 @@
+"""Database connection."""
+import asyncio
+import logging
+from pymongo import ASCENDING
+from pymongo.errors import OperationFailure
+from motor.motor_asyncio import AsyncIOMotorClient
+
+LOGGER = logging.getLogger(__name__)
+
+# indexes the handlers depend on, (collection, keys, options); the
+# characters index also serves queries on user_id alone
+INDEXES = (
+    ('characters', [('user_id', ASCENDING), ('name', ASCENDING)],
+     {'unique': True}),
+    ('campaigns', [('user_id', ASCENDING)], {}),
+)
+
+def _milliseconds(seconds):
+    return int(seconds * 1000)
+
+def client_options(config, event_listeners=()):
+    """MongoClient options of `config`, for Motor and pymongo alike."""
+    database = config.database
+    options = {
+        'minPoolSize': database.min_pool_size,
+        'maxPoolSize': database.max_pool_size,
+        'serverSelectionTimeoutMS': _milliseconds(
+            database.server_selection_timeout),
+        'connectTimeoutMS': _milliseconds(database.connect_timeout),
+        'socketTimeoutMS': _milliseconds(database.socket_timeout) or None,
+        'readPreference': database.read_preference}
+    if database.compressors:
+        options['compressors'] = database.compressors
+    if len(event_listeners) > 0:
+        options['event_listeners'] = list(event_listeners)
+    return options
+
+def connect(config, event_listeners=()):
+    """Create the motor client and database for `config`."""
+    database = config.database
+    client = AsyncIOMotorClient(
+        database.uri, **client_options(config, event_listeners))
+    return client, client[database.name]
+
+async def ensure_indexes(db):
+    """
+    Create the indexes in INDEXES, existing ones are left alone.
+
+    An index that can not be built, a unique one over duplicate character
+    names for instance, is logged and skipped so the server still starts.
+    """
+    for collection_name, keys, options in INDEXES:
+        try:
+            await db[collection_name].create_index(keys, **options)
+        except OperationFailure as error:
+            LOGGER.error(
+                "could not create index %s on %s: %s",
+                keys, collection_name, error)
+
+async def ensure_indexes_on_startup(app):
+    """aiohttp startup hook."""
+    await ensure_indexes(app['db'])
+
+def run(coroutine):
+    """Run `coroutine` to completion, for command line tools."""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+# motor methods that cost one round trip to the server
+ROUND_TRIP_METHODS = frozenset([
+    'find_one',
+    'find_one_and_update',
+    'insert_one',
+    'insert_many',
+    'update_one',
+    'update_many',
+    'replace_one',
+    'delete_one',
+    'delete_many',
+    'bulk_write',
+    'count_documents'])
+
+class CountingCollection:
+
+    """Collection wrapper that counts round trips in request['db_round_trips']."""
+
+    def __init__(self, collection, request):
+        self._collection = collection
+        self._request = request
+
+    def __getattr__(self, name):
+        attribute = getattr(self._collection, name)
+        if name not in ROUND_TRIP_METHODS:
+            return attribute
+        async def counted(*args, **kwargs):
+            self._request['db_round_trips'] = \
+                self._request.get('db_round_trips', 0) + 1
+            return await attribute(*args, **kwargs)
+        return counted
+
+def collection(request, name):
+    """Collection `name`, counting round trips made for `request`."""
+    return CountingCollection(request.app['db'][name], request)
+
+def _overlap(path, other):
+    return path == other or path.startswith(other + '.') or \
+        other.startswith(path + '.')
+
+class Update:
+
+    """
+    Update document built from field level operators.
+
+    Validators return one to change a single counter or list item instead
+    of rewriting the whole field, so concurrent edits to other parts of
+    the field are kept. Values are taken as they are, the validator has
+    already applied the same change to the character in memory.
+    """
+
+    def __init__(self, fields=None):
+        self.operations = {}
+        self.array_filters = []
+        # fields that are written as a whole, from the character in memory
+        self._whole = set()
+        for field, value in (fields or {}).items():
+            self.set(field, value)
+
+    def set(self, path, value):
+        """Set `path` to `value`."""
+        self.operations.setdefault('$set', {})[path] = value
+        return self
+
+    def unset(self, path):
+        """Remove `path`."""
+        self.operations.setdefault('$unset', {})[path] = ""
+        return self
+
+    def inc(self, path, amount=1):
+        """Add `amount` to the number at `path`."""
+        self.operations.setdefault('$inc', {})[path] = amount
+        return self
+
+    def push(self, path, value):
+        """Append `value` to the list at `path`."""
+        self.operations.setdefault('$push', {})[path] = value
+        return self
+
+    def pull(self, path, condition):
+        """Remove the items matching `condition` from the list at `path`."""
+        self.operations.setdefault('$pull', {})[path] = condition
+        return self
+
+    def match(self, identifier, condition):
+        """Let `$[identifier]` in a path select the items matching `condition`."""
+        for key, value in condition.items():
+            self.array_filters.append(
+                {'{}.{}'.format(identifier, key): value})
+        return self
+
+    def paths(self):
+        """(operator, path) pairs of all operations."""
+        return [
+            (operator, path)
+            for operator, paths in self.operations.items()
+            for path in paths]
+
+    def fields(self):
+        """Top level fields that are changed."""
+        return {path.split('.')[0] for _, path in self.paths()}
+
+    def merge(self, other, document):
+        """
+        Add the operations of `other`.
+
+        Increments of the same path are summed. Other operations that
+        touch the same part of a field can not go into one update, the
+        field is then set as a whole from `document`, which has to hold
+        the result of both updates.
+        """
+        for operator, path in other.paths():
+            value = other.operations[operator][path]
+            field = path.split('.')[0]
+            if field in self._whole:
+                pass
+            elif operator == '$inc' and path in self.operations.get('$inc', {}):
+                self.operations['$inc'][path] += value
+            elif any(_overlap(path, existing) for _, existing in self.paths()):
+                self._set_whole(field)
+            else:
+                self.operations.setdefault(operator, {})[path] = value
+        for array_filter in other.array_filters:
+            if array_filter not in self.array_filters:
+                self.array_filters.append(array_filter)
+        self._prune_array_filters()
+        for field in self._whole:
+            self.operations['$set'][field] = document[field]
+        return self
+
+    def _set_whole(self, field):
+        for operator, path in self.paths():
+            if path.split('.')[0] == field:
+                del self.operations[operator][path]
+        self.operations = {
+            operator: paths
+            for operator, paths in self.operations.items() if paths}
+        self.operations.setdefault('$set', {})
+        self._whole.add(field)
+
+    def _prune_array_filters(self):
+        paths = [path for _, path in self.paths()]
+        self.array_filters = [
+            array_filter for array_filter in self.array_filters
+            if any(
+                '$[{}]'.format(key.split('.')[0]) in path
+                for key in array_filter for path in paths)]
+
+    def document(self):
+        """The update document for pymongo."""
+        return self.operations
+
+    def __len__(self):
+        return len(self.paths())
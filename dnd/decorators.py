@@ -3,7 +3,7 @@ from functools import wraps
 import aiohttp_login
 from aiohttp_jinja2 import template
 
-from dnd.character import calculate_stats
+from dnd.summaries import character_summaries
 
 def login_required(template_file):
     """
@@ -15,19 +15,8 @@ def login_required(template_file):
         @wraps(handler)
         async def inner_decorator(request):
             result = await handler(request)
-            characters = request.app['db'].characters
-            invalid_characters = await characters.find(
-                {'user._id': request['user']['_id']}).to_list(length=100)
-            for character in invalid_characters:
-                await characters.update_one(
-                    {'_id': character['_id']},
-                    {
-                        '$set': {'user_id': request['user']['_id']},
-                        '$unset': {'user': True}})
-            result['characters'] = await characters.find(
-                {'user_id': request['user']['_id']}).to_list(length=100)
-            for character in result['characters']:
-                calculate_stats(character)
+            result['characters'] = await character_summaries(
+                request.app, request['user']['_id'])
             campaigns = request.app['db'].campaigns
             result['campaigns'] = await campaigns.find(
                 {'user_id': request['user']['_id']}).to_list(length=100)
@@ -0,0 +1,94 @@
+"""Cached rendering of the HTML fragments returned by data_handler."""
+import hashlib
+import json
+from types import MappingProxyType
+from aiohttp_jinja2 import get_env
+
+# character fields read by each fragment template, includes included
+FRAGMENT_FIELDS = {
+    'character_class_form.html': ('_id', 'classes', 'level'),
+    'character_hp_form.html': (
+        '_id', 'classes', 'level', 'damage', 'hitpoints_per_level',
+        'temp_hp'),
+    'character_skills_display.html': ('skills', 'skill_checks'),
+    'character_spell_list.html': ('_id', 'spells'),
+    'character_spell_slots.html': (
+        'invalid_prepared_spells', 'leftover_spell_slots', 'spell_slots'),
+    'character_prepared_spells.html': ('_id', 'prepared_spells', 'spells'),
+    'character_prayer_list.html': ('_id', 'prayers'),
+    'character_prayer_slots.html': (
+        'invalid_prepared_prayers', 'leftover_prayer_slots', 'prayer_slots'),
+    'character_prepared_prayers.html': ('_id', 'prepared_prayers'),
+    'character_powers_display.html': ('powers',),
+    'character_armour_display.html': ('_id', 'armour'),
+    'character_weapons_display.html': ('_id', 'weapons'),
+    'character_inventory_display.html': ('_id', 'inventory'),
+    'character_coins.html': ('_id', 'coins'),
+}
+
+def _fingerprint(value):
+    if isinstance(value, MappingProxyType):
+        # frozen catalog entry, lives as long as the process
+        return ('catalog', id(value))
+    if isinstance(value, dict):
+        return tuple((key, _fingerprint(item)) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return tuple(_fingerprint(item) for item in value)
+    return value
+
+def fragment_digest(template_name, character):
+    """Digest of the character fields that `template_name` reads."""
+    return hashlib.sha1(repr(tuple(
+        _fingerprint(character.get(field))
+        for field in FRAGMENT_FIELDS[template_name])).encode()).hexdigest()
+
+def render_fragment(app, template_name, character, **context):
+    """
+    Render a fragment template for `character`.
+
+    `context` holds catalogs, which do not change while the process runs.
+    Rendered fragments are kept in app['fragment_cache'] if there is one.
+    """
+    cache = app.get('fragment_cache')
+    if cache is None:
+        return get_env(app).get_template(template_name).render(
+            character=character, **context)
+    key = (template_name, fragment_digest(template_name, character))
+    html = cache.get(key)
+    if html is None:
+        html = get_env(app).get_template(template_name).render(
+            character=character, **context)
+        cache.put(key, html)
+    return html
+
+def content_hash(data):
+    """Short hash of the markup sent for a selector."""
+    return hashlib.sha1(data.encode()).hexdigest()[:16]
+
+def known_hashes(request):
+    """Fragment hashes the client sent along in the X-Fragment-Hashes header."""
+    try:
+        hashes = json.loads(request.headers.get('X-Fragment-Hashes', '{}'))
+    except ValueError:
+        return {}
+    return hashes if isinstance(hashes, dict) else {}
+
+def strip_known_fragments(response, known):
+    """
+    Drop the markup the client already has from a data_handler response.
+
+    Every markup entry gets a hash, which the client stores per selector.
+    Entries whose hash matches the one the client sent keep only their
+    class and collapse changes, and are left out if nothing remains.
+    """
+    for selector in list(response):
+        entry = response[selector]
+        if not isinstance(entry, dict) or not isinstance(entry.get('data'), str):
+            continue
+        entry['hash'] = content_hash(entry['data'])
+        if known.get(selector) == entry['hash']:
+            del entry['data']
+            entry.pop('activateTooltip', None)
+            if list(entry) == ['hash']:
+                del response[selector]
+    return response
@@ -0,0 +1,84 @@
+"""Live updates of character pages over WebSockets."""
+import asyncio
+from dnd.fragments import strip_known_fragments
+
+class LiveSocket:
+
+    """
+    Open socket of a character page.
+
+    Keeps the hash of the markup it was sent per selector, so that it only
+    receives what changed. Messages are sent in order by `run`.
+    """
+
+    def __init__(self, websocket):
+        self.websocket = websocket
+        self.hashes = {}
+        self._queue = asyncio.Queue()
+
+    def delta(self, response):
+        """Copy of `response` without the markup this socket already has."""
+        response = {
+            selector: dict(entry) if isinstance(entry, dict) else entry
+            for selector, entry in response.items()}
+        strip_known_fragments(response, self.hashes)
+        for selector, entry in response.items():
+            if isinstance(entry, dict) and 'hash' in entry:
+                self.hashes[selector] = entry['hash']
+        return response
+
+    def reset(self, hashes):
+        """
+        Replace the hashes with those the client sent along with an edit.
+
+        The client forgets the hashes of the fragments it shows an error
+        in, so those are sent in full again.
+        """
+        self.hashes = {
+            selector: value for selector, value in hashes.items()
+            if isinstance(value, str)}
+
+    def send(self, message):
+        """Queue `message` for sending."""
+        self._queue.put_nowait(message)
+
+    async def run(self):
+        """Send queued messages until cancelled."""
+        while True:
+            message = await self._queue.get()
+            if self.websocket.closed:
+                return
+            await self.websocket.send_json(message)
+
+class LiveHub:
+
+    """
+    Sockets subscribed per character, in this process.
+
+    Every change to a character is published as the response data_handler
+    produced for it, each socket gets the part it does not have yet.
+    """
+
+    def __init__(self):
+        self._sockets = {}
+
+    def subscribe(self, character_id, socket):
+        """Send changes of `character_id` to `socket`."""
+        self._sockets.setdefault(str(character_id), set()).add(socket)
+
+    def unsubscribe(self, character_id, socket):
+        """Stop sending changes of `character_id` to `socket`."""
+        sockets = self._sockets.get(str(character_id), set())
+        sockets.discard(socket)
+        if len(sockets) == 0:
+            self._sockets.pop(str(character_id), None)
+
+    def publish(self, character_id, response):
+        """Send `response` to the sockets of `character_id`."""
+        for socket in self._sockets.get(str(character_id), ()):
+            data = socket.delta(response)
+            if len(data) > 0:
+                socket.send({'type': 'update', 'data': data})
+
+    def __len__(self):
+        return sum(len(sockets) for sockets in self._sockets.values())
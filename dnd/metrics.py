@@ -0,0 +1,338 @@
+"""
+Prometheus metrics of the running server.
+
+Enabled with the `metrics` configuration section, the metrics are served in
+the Prometheus text format at /metrics. Request latency is recorded per
+route and character attribute, Mongo commands through a pymongo command
+listener, and the time spent in the stats engine, in templates and waiting
+for the event loop separately, so a slow edit can be traced to its cause.
+"""
+import asyncio
+import threading
+from time import perf_counter
+from contextlib import contextmanager
+from aiohttp.web import Response, WebSocketResponse
+from pymongo import monitoring
+
+REQUEST_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+    10.0)
+# stats steps and fragments take microseconds to milliseconds
+FAST_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+    0.25)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace(
+        '"', r'\"')
+
+def _labels(pairs):
+    if len(pairs) == 0:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(name, _escape(value)) for name, value in pairs) + '}'
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+
+    """Count per combination of label values."""
+
+    kind = 'counter'
+
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self._values = {}
+        # pymongo calls listeners from other threads
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        """Add `amount` to the count of `label_values`."""
+        with self._lock:
+            self._values[label_values] = \
+                self._values.get(label_values, 0) + amount
+
+    def samples(self):
+        """(name, label pairs, value) per combination of label values."""
+        with self._lock:
+            values = sorted(self._values.items())
+        for label_values, value in values:
+            yield self.name, list(zip(self.labels, label_values)), value
+
+class Histogram:
+
+    """Distribution of observed values per combination of label values."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, doc, labels=(), buckets=REQUEST_BUCKETS):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self.buckets = tuple(buckets) + (float('inf'),)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        """Record `value` for `label_values`."""
+        with self._lock:
+            counts, total = self._values.get(
+                label_values, ([0] * len(self.buckets), 0.0))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            self._values[label_values] = (counts, total + value)
+
+    @contextmanager
+    def time(self, *label_values):
+        """Observe the seconds spent in the with block."""
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start, *label_values)
+
+    def samples(self):
+        """Cumulative buckets, sum and count per combination of label values."""
+        with self._lock:
+            values = sorted(
+                (label_values, (list(counts), total))
+                for label_values, (counts, total) in self._values.items())
+        for label_values, (counts, total) in values:
+            pairs = list(zip(self.labels, label_values))
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield (
+                    self.name + '_bucket',
+                    pairs + [('le', _number(bound))],
+                    cumulative)
+            yield self.name + '_sum', pairs, total
+            yield self.name + '_count', pairs, cumulative
+
+class Gauge:
+
+    """
+    Values read from the application when the metrics are scraped.
+
+    `read` returns {label values: value}. Statistics that only grow, such as
+    cache hits, are exported with `kind` 'counter'.
+    """
+
+    def __init__(self, name, doc, labels, read, kind='gauge'):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self.kind = kind
+        self._read = read
+
+    def samples(self):
+        """(name, label pairs, value) per combination of label values."""
+        for label_values, value in sorted(self._read().items()):
+            yield self.name, list(zip(self.labels, label_values)), value
+
+class Metrics:
+
+    """
+    The metrics of an app, kept in app['metrics'].
+
+    Requests are labelled with their character attribute if it is one of
+    `attributes`, and with 'other' if not, as the attribute comes from the
+    URL and any client could add time series otherwise.
+    """
+
+    def __init__(self, attributes=()):
+        self.attributes = frozenset(attributes)
+        self.requests = Histogram(
+            'dnd_request_duration_seconds',
+            "Time to answer requests, per route and character attribute.",
+            ('route', 'attribute'))
+        self.mongo = Histogram(
+            'dnd_mongo_command_duration_seconds',
+            "Time the server took for Mongo commands.",
+            ('command', 'collection'), FAST_BUCKETS)
+        self.mongo_failures = Counter(
+            'dnd_mongo_command_failures_total',
+            "Mongo commands that failed.",
+            ('command', 'collection'))
+        self.stats = Histogram(
+            'dnd_stats_duration_seconds',
+            "Time spent calculating character statistics.",
+            ('function',), FAST_BUCKETS)
+        self.templates = Histogram(
+            'dnd_template_render_duration_seconds',
+            "Time to render templates, includes are part of their parent.",
+            ('template',), FAST_BUCKETS)
+        self.loop_lag = Histogram(
+            'dnd_event_loop_lag_seconds',
+            "How late the event loop woke up a sleeping task.",
+            (), FAST_BUCKETS)
+        self._metrics = [
+            self.requests, self.mongo, self.mongo_failures, self.stats,
+            self.templates, self.loop_lag]
+
+    def add(self, metric):
+        """Export `metric` as well, returns it."""
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """All metrics in the Prometheus text format."""
+        lines = []
+        for metric in self._metrics:
+            lines.append('# HELP {} {}'.format(metric.name, metric.doc))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            for name, pairs, value in metric.samples():
+                lines.append('{}{} {}'.format(name, _labels(pairs), _number(value)))
+        return '\n'.join(lines) + '\n'
+
+class MongoListener(monitoring.CommandListener):
+
+    """Records the duration of every Mongo command in `metrics`."""
+
+    def __init__(self, metrics):
+        self._metrics = metrics
+        self._collections = {}
+
+    def started(self, event):
+        # most commands name their collection, the reply does not
+        collection = event.command.get(event.command_name)
+        self._collections[(event.connection_id, event.request_id)] = \
+            collection if isinstance(collection, str) else ''
+
+    def succeeded(self, event):
+        self._finish(event)
+
+    def failed(self, event):
+        collection = self._finish(event)
+        self._metrics.mongo_failures.inc(event.command_name, collection)
+
+    def _finish(self, event):
+        collection = self._collections.pop(
+            (event.connection_id, event.request_id), '')
+        self._metrics.mongo.observe(
+            event.duration_micros / 1e6, event.command_name, collection)
+        return collection
+
+def _route(request):
+    resource = request.match_info.route.resource
+    if resource is None:
+        return 'unmatched'
+    info = resource.get_info()
+    return info.get('formatter', info.get('path', info.get('prefix', '')))
+
+def _attribute(request, attributes):
+    attribute = request.match_info.get('attribute', '')
+    if attribute == '' or attribute in attributes:
+        return attribute
+    return 'other'
+
+async def metrics_middleware(app, handler):
+    """Time requests per route and character attribute."""
+    async def middleware(request):
+        start = perf_counter()
+        response = None
+        try:
+            response = await handler(request)
+            return response
+        finally:
+            # a live socket takes as long as the page is open
+            if not isinstance(response, WebSocketResponse):
+                metrics = app['metrics']
+                metrics.requests.observe(
+                    perf_counter() - start,
+                    _route(request),
+                    _attribute(request, metrics.attributes))
+    return middleware
+
+def stats_timer(app, function):
+    """Context manager timing the stats engine `function`, if enabled."""
+    metrics = app.get('metrics')
+    if metrics is None:
+        return _nothing()
+    return metrics.stats.time(function)
+
+@contextmanager
+def _nothing():
+    yield
+
+def instrument_templates(env, metrics):
+    """Time every render of a template loaded by the jinja2 `env`."""
+    class TimedTemplate(env.template_class):
+        def render(self, *args, **kwargs):
+            with metrics.templates.time(self.name):
+                return super().render(*args, **kwargs)
+    env.template_class = TimedTemplate
+
+def add_app_gauges(app, caches):
+    """Export the statistics of `caches` and of the write coalescer and hub."""
+    metrics = app['metrics']
+    def cache_statistic(name):
+        return lambda: {
+            (cache_name,): getattr(cache, name)
+            for cache_name, cache in caches.items() if cache is not None}
+    metrics.add(Gauge(
+        'dnd_cache_entries', "Entries in the in-process caches.",
+        ('cache',), lambda: {
+            (cache_name,): len(cache)
+            for cache_name, cache in caches.items() if cache is not None}))
+    metrics.add(Gauge(
+        'dnd_cache_hits_total', "Lookups that found an entry.",
+        ('cache',), cache_statistic('hits'), 'counter'))
+    metrics.add(Gauge(
+        'dnd_cache_misses_total', "Lookups that found no entry.",
+        ('cache',), cache_statistic('misses'), 'counter'))
+    coalescer = app.get('write_coalescer')
+    if coalescer is not None:
+        metrics.add(Gauge(
+            'dnd_write_flushes_total', "Buffered writes of character edits.",
+            (), lambda: {(): coalescer.flushes}, 'counter'))
+        metrics.add(Gauge(
+            'dnd_write_edits_total', "Character edits written by buffering.",
+            (), lambda: {(): coalescer.items}, 'counter'))
+        metrics.add(Gauge(
+            'dnd_write_buffered_seconds_total',
+            "Time edits spent in the write buffer, summed over flushes.",
+            (), lambda: {(): coalescer.total_latency}, 'counter'))
+        metrics.add(Gauge(
+            'dnd_write_batch_size_max', "Most edits written at once.",
+            (), lambda: {(): coalescer.max_batch_size}))
+        metrics.add(Gauge(
+            'dnd_write_rejected_total',
+            "Character edits dropped because their buffer was full.",
+            (), lambda: {(): coalescer.rejected}, 'counter'))
+    hub = app.get('live_hub')
+    if hub is not None:
+        metrics.add(Gauge(
+            'dnd_live_sockets', "Open live update sockets.",
+            (), lambda: {(): len(hub)}))
+
+async def _watch_loop_lag(metrics, interval):
+    loop = asyncio.get_event_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        metrics.loop_lag.observe(max(0.0, loop.time() - expected))
+
+def loop_lag_watcher(interval):
+    """aiohttp startup and cleanup hooks measuring event loop lag."""
+    async def start(app):
+        app['loop_lag_watcher'] = asyncio.ensure_future(
+            _watch_loop_lag(app['metrics'], interval))
+    async def stop(app):
+        app['loop_lag_watcher'].cancel()
+    return start, stop
+
+async def metrics_handler(request):
+    """Metrics in the Prometheus text format."""
+    return Response(
+        body=request.app['metrics'].render().encode(),
+        headers={'Content-Type': CONTENT_TYPE})
@@ -0,0 +1,101 @@
+"""
+Versioned schema migrations.
+
+Pending migrations are applied when the server starts, or with
+`dnd migrate`. Every applied migration is recorded in the `migrations`
+collection, the highest number is the schema version of the database.
+"""
+import sys
+import logging
+import argparse
+import datetime
+from pymongo import UpdateOne, DESCENDING
+
+BATCH_SIZE = 1000
+
+LOGGER = logging.getLogger(__name__)
+
+async def _bulk_update(collection, query, projection, make_update):
+    """Apply `make_update(document)` to every match, in batches."""
+    batch = []
+    modified = 0
+    async for document in collection.find(query, projection):
+        batch.append(UpdateOne({'_id': document['_id']}, make_update(document)))
+        if len(batch) == BATCH_SIZE:
+            result = await collection.bulk_write(batch, ordered=False)
+            modified += result.modified_count
+            batch = []
+    if len(batch) > 0:
+        result = await collection.bulk_write(batch, ordered=False)
+        modified += result.modified_count
+    return modified
+
+async def _character_user_id(db):
+    return await _bulk_update(
+        db.characters,
+        {'user._id': {'$exists': True}},
+        {'user._id': True},
+        lambda character: {
+            '$set': {'user_id': character['user']['_id']},
+            '$unset': {'user': True}})
+
+async def _character_version(db):
+    result = await db.characters.update_many(
+        {'version': {'$exists': False}}, {'$set': {'version': 0}})
+    return result.modified_count
+
+MIGRATIONS = [
+    (1, "move user._id of characters to user_id", _character_user_id),
+    (2, "start the version of characters at 0", _character_version),
+]
+
+async def schema_version(db):
+    """Number of the last migration applied to `db`, 0 if there is none."""
+    last = await db.migrations.find_one(sort=[('_id', DESCENDING)])
+    return 0 if last is None else last['_id']
+
+async def migrate(db):
+    """Apply pending migrations in order, return the applied ones."""
+    version = await schema_version(db)
+    applied = []
+    for number, description, migration in MIGRATIONS:
+        if number <= version:
+            continue
+        LOGGER.info("applying migration %d: %s", number, description)
+        modified = await migration(db)
+        await db.migrations.replace_one(
+            {'_id': number},
+            {
+                '_id': number,
+                'description': description,
+                'modified': modified,
+                'applied_at': datetime.datetime.now()},
+            upsert=True)
+        applied.append((number, description, modified))
+    return applied
+
+async def migrate_on_startup(app):
+    """aiohttp startup hook."""
+    await migrate(app['db'])
+
+def main():
+    """Apply pending schema migrations (`dnd migrate`)."""
+    from dnd import DndConfiguration
+    from dnd.database import connect, run
+    parser = argparse.ArgumentParser(
+        prog='dnd migrate', description="apply pending schema migrations")
+    parser.add_argument(
+        '--status', action='store_true',
+        help="show the schema version without migrating")
+    args, sys.argv[1:] = parser.parse_known_args()
+    config = DndConfiguration()
+    _, db = connect(config)
+    if args.status:
+        version = run(schema_version(db))
+        print("schema version {} of {}".format(version, MIGRATIONS[-1][0]))
+        return
+    applied = run(migrate(db))
+    for number, description, modified in applied:
+        print("{}: {} ({} documents)".format(number, description, modified))
+    if len(applied) == 0:
+        print("schema is up to date")
@@ -0,0 +1,151 @@
+"""
+Profiles of single requests, captured on demand.
+
+With the `profiling` configuration section enabled, a request that carries
+the configured token in the X-Profile header or the `profile` query
+parameter runs under cProfile. The statistics are stored as a pstats file
+next to a JSON file with the request details, `dnd profiles` lists and
+summarises them. cProfile sees everything the event loop runs meanwhile,
+so profile on a quiet server when you can.
+"""
+import os
+import sys
+import asyncio
+import hmac
+import json
+import uuid
+import pstats
+import cProfile
+import argparse
+import datetime
+from time import perf_counter
+from appdirs import AppDirs
+
+HEADER = 'X-Profile'
+PARAMETER = 'profile'
+
+def profile_directory(config):
+    """Directory for the profiles of the `profiling` configuration section."""
+    if config.directory:
+        return config.directory
+    return os.path.join(AppDirs('dnd', 'nihlaeth').user_cache_dir, 'profiles')
+
+def _requested(request, token):
+    supplied = request.headers.get(
+        HEADER, request.rel_url.query.get(PARAMETER))
+    return supplied is not None and \
+        hmac.compare_digest(supplied.encode(), token.encode())
+
+def _metadata(request, profile_id, started_at, seconds, response, error):
+    user = request.get('user')
+    return {
+        'id': profile_id,
+        'started_at': started_at.isoformat(),
+        'seconds': seconds,
+        'method': request.method,
+        'path': request.path,
+        'query': {
+            key: value for key, value in request.rel_url.query.items()
+            if key != PARAMETER},
+        'user_id': None if user is None else str(user['_id']),
+        'status': None if response is None else response.status,
+        'error': None if error is None else repr(error)}
+
+def _save(directory, keep, profiler, metadata):
+    os.makedirs(directory, exist_ok=True)
+    profiler.dump_stats(
+        os.path.join(directory, '{}.pstats'.format(metadata['id'])))
+    with open(os.path.join(directory, '{}.json'.format(
+            metadata['id'])), 'w', encoding='utf-8') as stream:
+        json.dump(metadata, stream, indent=1)
+    for profile_id in list_profiles(directory)[keep:]:
+        for extension in ('pstats', 'json'):
+            path = os.path.join(directory, '{}.{}'.format(profile_id, extension))
+            if os.path.exists(path):
+                os.remove(path)
+
+def profiling_middleware(directory, token, keep):
+    """Middleware profiling the requests that carry `token`."""
+    async def factory(_app, handler):
+        # one profiler at a time, it sees every task anyway
+        lock = asyncio.Lock()
+        async def middleware(request):
+            if lock.locked() or not _requested(request, token):
+                return await handler(request)
+            async with lock:
+                return await _profile(request, handler, directory, keep)
+        return middleware
+    return factory
+
+async def _profile(request, handler, directory, keep):
+    started_at = datetime.datetime.now()
+    profile_id = '{:%Y%m%d-%H%M%S-%f}-{}'.format(
+        started_at, uuid.uuid4().hex[:8])
+    response = error = None
+    profiler = cProfile.Profile()
+    start = perf_counter()
+    profiler.enable()
+    try:
+        response = await handler(request)
+    except Exception as exception:
+        error = exception
+        raise
+    finally:
+        profiler.disable()
+        metadata = _metadata(
+            request, profile_id, started_at, perf_counter() - start,
+            response, error)
+        # writing and removing files blocks, keep it off the event loop
+        await asyncio.get_event_loop().run_in_executor(
+            None, _save, directory, keep, profiler, metadata)
+    if not response.prepared:
+        response.headers['X-Profile-Id'] = profile_id
+    return response
+
+def list_profiles(directory):
+    """Ids of the profiles in `directory`, newest first."""
+    if not os.path.isdir(directory):
+        return []
+    return sorted((
+        name[:-len('.json')] for name in os.listdir(directory)
+        if name.endswith('.json')), reverse=True)
+
+def load_metadata(directory, profile_id):
+    """Request details stored with a profile."""
+    with open(os.path.join(
+            directory, '{}.json'.format(profile_id)), encoding='utf-8') as stream:
+        return json.load(stream)
+
+def main():
+    """List and summarise captured profiles (`dnd profiles`)."""
+    from dnd import DndConfiguration
+    parser = argparse.ArgumentParser(
+        prog='dnd profiles',
+        description="list captured request profiles, or summarise one")
+    parser.add_argument('--show', metavar='ID', help="profile to summarise")
+    parser.add_argument(
+        '--sort', default='cumulative',
+        choices=['cumulative', 'tottime', 'calls', 'name'],
+        help="order of the functions in a summary (default: cumulative)")
+    parser.add_argument(
+        '--limit', type=int, default=30,
+        help="number of functions in a summary (default: 30)")
+    args, sys.argv[1:] = parser.parse_known_args()
+    config = DndConfiguration()
+    directory = profile_directory(config.profiling)
+    if args.show is None:
+        profiles = list_profiles(directory)
+        for profile_id in profiles:
+            metadata = load_metadata(directory, profile_id)
+            print("{id}  {seconds:8.3f} s  {status!s:>4}  {method} {path}  "
+                  "user {user_id}".format(**metadata))
+        if len(profiles) == 0:
+            print("no profiles in {}".format(directory))
+        return
+    metadata = load_metadata(directory, args.show)
+    for key, value in metadata.items():
+        print("{}: {}".format(key, value))
+    stats = pstats.Stats(
+        os.path.join(directory, '{}.pstats'.format(args.show)),
+        stream=sys.stdout)
+    stats.strip_dirs().sort_stats(args.sort).print_stats(args.limit)
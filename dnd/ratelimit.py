@@ -0,0 +1,94 @@
+"""Rate limiting of character edits per user."""
+import time
+import math
+import datetime
+from pymongo import ASCENDING
+
+class TokenBucketLimiter:
+
+    """
+    In-memory token bucket per user, for single process deployments.
+
+    Every user may do `burst` actions at once, after that the bucket refills
+    with `rate` actions per second.
+    """
+
+    # forget full buckets once this many users are tracked
+    max_users = 10000
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._buckets = {}
+
+    async def setup(self):
+        """Nothing to prepare for in-memory buckets."""
+
+    async def allow(self, user_id, actions=1):
+        """Take `actions` tokens from the bucket of `user_id` if it has them."""
+        now = time.monotonic()
+        tokens, last = self._buckets.get(user_id, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        allowed = tokens >= actions
+        self._buckets[user_id] = (tokens - actions if allowed else tokens, now)
+        if len(self._buckets) > self.max_users:
+            self._prune(now)
+        return allowed
+
+    def _prune(self, now):
+        full_after = self.burst / self.rate
+        for user_id, (_, last) in list(self._buckets.items()):
+            if now - last >= full_after:
+                del self._buckets[user_id]
+
+class MongoSlidingWindowLimiter:
+
+    """
+    Sliding window per user in the `rate_limit` collection.
+
+    Uses wall clock time, so the limit holds across workers and restarts.
+    Actions are recorded before the window is counted and taken back if it
+    is over the limit, so concurrent requests can not all see room. Old
+    actions are removed by a TTL index.
+    """
+
+    def __init__(self, db, actions, window):
+        self.actions = actions
+        self.window = window
+        self._collection = db.rate_limit
+
+    async def setup(self):
+        """Create the indexes the limiter depends on."""
+        await self._collection.create_index(
+            [('user_id', ASCENDING), ('at', ASCENDING)])
+        await self._collection.create_index(
+            'at', expireAfterSeconds=max(1, math.ceil(self.window)))
+
+    async def allow(self, user_id, actions=1):
+        """Record `actions` for `user_id` if the window has room for them."""
+        now = datetime.datetime.utcnow()
+        result = await self._collection.insert_many(
+            [{'user_id': user_id, 'at': now} for _ in range(actions)])
+        # counts the actions of concurrent requests as well, if two of them
+        # take the last room both are refused, never both allowed
+        recent = await self._collection.count_documents({
+            'user_id': user_id,
+            'at': {'$gt': now - datetime.timedelta(seconds=self.window)}})
+        if recent > self.actions:
+            await self._collection.delete_many(
+                {'_id': {'$in': result.inserted_ids}})
+            return False
+        return True
+
+def create_rate_limiter(config, db):
+    """Rate limiter for the `rate_limit` configuration section."""
+    if config.backend == 'memory':
+        return TokenBucketLimiter(
+            config.actions / config.window, config.actions)
+    if config.backend == 'mongo':
+        return MongoSlidingWindowLimiter(db, config.actions, config.window)
+    raise ValueError("unknown rate limit backend: {}".format(config.backend))
+
+async def setup_rate_limiter(app):
+    """aiohttp startup hook."""
+    await app['rate_limiter'].setup()
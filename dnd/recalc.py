@@ -0,0 +1,289 @@
+"""
+Recalculation of every character, after the catalogs changed.
+
+`dnd recalc` streams the characters collection and calculates the
+statistics of each character in a pool of processes, reporting characters
+with fields of the wrong type, that refer to names the catalogs do not
+have or that spend more than they may. With `--write` the fields that
+calculating normalises and the stored statistics are written back. Running
+servers are not told, restart them afterwards, as they keep serving the
+characters they cached before. Characters reach the workers as raw BSON in
+batches and only a few batches are in flight at a time, so memory use does
+not grow with the collection.
+"""
+import sys
+import os
+import copy
+import time
+import argparse
+import resource
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import bson
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+from pymongo import UpdateOne
+from dnd.character import (
+    BACKGROUND_FIELDS,
+    RACES,
+    CLASSES,
+    SKILLS,
+    SPELLS,
+    PRAYERS,
+    PRAYER_SPHERES,
+    POWERS,
+    WEAPONS,
+    ARMOUR,
+    calculate_stats,
+    computed_stats)
+
+BATCH_SIZE = 500
+
+# fields that calculate_stats corrects, such as classes padded to the level
+NORMALISED_FIELDS = ['classes', 'hitpoints_per_level']
+
+# the background is only rendered, leave the text in the database
+PROJECTION = dict(
+    [('{}_unsafe'.format(field), False) for field in BACKGROUND_FIELDS] +
+    [('{}_safe'.format(field), False) for field in BACKGROUND_FIELDS])
+
+# fields that are looked up in the catalogs, by type, and the type of
+# their items or values
+LIST_FIELDS = {
+    'classes': str,
+    'skill_names': str,
+    'spell_names': str,
+    'prayer_names': str,
+    'prayer_spheres': str,
+    'power_names': str,
+    'weapons': dict,
+    'armour': dict}
+DICT_FIELDS = {
+    'prepared_spells': dict,
+    'prepared_prayers': dict,
+    'inventory': dict}
+
+def shape_problems(character):
+    """Fields of `character` that do not have the type the app expects."""
+    problems = []
+    if not isinstance(character.get('race_name', ''), str):
+        problems.append("race_name is not a string")
+    for field, item_type in LIST_FIELDS.items():
+        value = character.get(field, [])
+        if not isinstance(value, list):
+            problems.append("{} is not a list".format(field))
+        elif not all(isinstance(item, item_type) for item in value):
+            problems.append("{} holds an item that is not {}".format(
+                field, 'a string' if item_type is str else 'an object'))
+    for field, item_type in DICT_FIELDS.items():
+        value = character.get(field, {})
+        if not isinstance(value, dict):
+            problems.append("{} is not an object".format(field))
+        elif not all(isinstance(item, item_type) for item in value.values()):
+            problems.append("{} holds a value that is not an object".format(
+                field))
+    return problems
+
+def unknown_names(character):
+    """Names `character` uses that the catalogs lack, as (kind, name) pairs."""
+    anomalies = []
+    race_name = character.get('race_name', 'Truman')
+    if race_name not in RACES:
+        anomalies.append(('unknown race', race_name))
+    spheres = set(character.get('prayer_spheres', [])) - {'all'}
+    for kind, names, catalog in (
+            ('class', character.get('classes', []), CLASSES),
+            ('skill', character.get('skill_names', []), SKILLS),
+            ('spell', [
+                name.lower() for name in character.get('spell_names', [])] +
+             list(character.get('prepared_spells', {})), SPELLS),
+            ('prayer', list(character.get('prayer_names', [])) +
+             list(character.get('prepared_prayers', {})), PRAYERS),
+            ('prayer sphere', spheres, PRAYER_SPHERES),
+            ('power', character.get('power_names', []), POWERS),
+            ('weapon', [
+                weapon.get('name') for weapon in character.get('weapons', [])],
+             WEAPONS),
+            ('armour', [
+                armour.get('name') for armour in character.get('armour', [])],
+             ARMOUR)):
+        for name in names:
+            if name not in catalog:
+                anomalies.append(('unknown {}'.format(kind), name))
+    return anomalies
+
+def _overspent(character):
+    anomalies = []
+    for field in ('unspent_skill_slots', 'unspent_ability_points'):
+        if character[field] < 0:
+            anomalies.append(
+                ('negative {}'.format(field.replace('_', ' ')),
+                 character[field]))
+    for field in ('invalid_prepared_spells', 'invalid_prepared_prayers'):
+        if character[field] > 0:
+            anomalies.append((field.replace('_', ' '), character[field]))
+    return anomalies
+
+def _update(character, before):
+    changed = {
+        field: character[field] for field in NORMALISED_FIELDS
+        if character[field] != before[field]}
+    computed = computed_stats(character)
+    query = {'_id': character['_id'], 'version': character.get('version', 0)}
+    if len(changed) > 0:
+        # a new version, so an edit based on a copy a server cached before
+        # fails its conditional write and is retried on the stored character;
+        # the cached copy is still served until then, or the server restarts
+        changed['computed'] = computed
+        return UpdateOne(query, {'$set': changed, '$inc': {'version': 1}})
+    if computed != character.get('computed'):
+        return UpdateOne(query, {'$set': {'computed': computed}})
+    return None
+
+def _check(character, write):
+    """Anomalies of a character of the right shape, and its update or None."""
+    found = unknown_names(character)
+    before = {
+        field: copy.deepcopy(character.get(field))
+        for field in NORMALISED_FIELDS}
+    try:
+        calculate_stats(character)
+    except (
+            AttributeError, KeyError, IndexError, TypeError,
+            ValueError) as error:
+        found.append(('calculation failed', repr(error)))
+        return found, None
+    found.extend(_overspent(character))
+    return found, _update(character, before) if write else None
+
+def check_batch(documents, write):
+    """
+    Calculate the statistics of BSON encoded characters.
+
+    Returns the anomalies, (_id, name, kind, detail) tuples, and the
+    updates that write the normalised fields back if `write` is set.
+    Characters with fields of the wrong type are reported as such and
+    not calculated.
+    """
+    anomalies = []
+    updates = []
+    for document in documents:
+        character = bson.decode(document)
+        found = [
+            ('wrong shape', problem) for problem in shape_problems(character)]
+        if len(found) == 0:
+            found, update = _check(character, write)
+            if update is not None:
+                updates.append(update)
+        anomalies.extend(
+            (character['_id'], character.get('name'), kind, detail)
+            for kind, detail in found)
+    return anomalies, updates
+
+def _batches(cursor, batch_size):
+    batch = []
+    for document in cursor:
+        batch.append(document.raw)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+class Recalculation:
+
+    """Totals of a recalculation run, anomalies are reported as they come."""
+
+    def __init__(self, collection, batch_size, report):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.report = report
+        self.characters = 0
+        self.anomalies = Counter()
+        self.written = 0
+        self._updates = []
+
+    def add(self, size, anomalies, updates):
+        """Take in the results of a batch of `size` characters."""
+        self.characters += size
+        for anomaly in anomalies:
+            self.anomalies[anomaly[2]] += 1
+            self.report(anomaly)
+        self._updates.extend(updates)
+        if len(self._updates) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Write the pending updates."""
+        if len(self._updates) > 0:
+            result = self.collection.bulk_write(self._updates, ordered=False)
+            self.written += result.modified_count
+            self._updates = []
+
+def recalculate_all(collection, workers, batch_size=BATCH_SIZE, write=False,
+                    report=print):
+    """
+    Check every character in the pymongo `collection`, returns the totals.
+
+    `report` is called with every anomaly as soon as it is found.
+    """
+    raw = collection.with_options(
+        codec_options=CodecOptions(document_class=RawBSONDocument))
+    totals = Recalculation(collection, batch_size, report)
+    with ProcessPoolExecutor(workers) as pool:
+        pending = {}
+        for batch in _batches(
+                raw.find({}, PROJECTION, batch_size=batch_size), batch_size):
+            if len(pending) >= 2 * workers:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    totals.add(pending.pop(future), *future.result())
+            pending[pool.submit(check_batch, batch, write)] = len(batch)
+        for future in list(pending):
+            totals.add(pending.pop(future), *future.result())
+    totals.flush()
+    return totals
+
+def _megabytes(usage):
+    # ru_maxrss is in kilobytes on Linux
+    return usage.ru_maxrss / 1024
+
+def main():
+    """Recalculate and check every character (`dnd recalc`)."""
+    from pymongo import MongoClient
+    from dnd import DndConfiguration
+    from dnd.database import client_options
+    parser = argparse.ArgumentParser(
+        prog='dnd recalc',
+        description="recalculate every character and report anomalies")
+    parser.add_argument(
+        '--workers', type=int, default=os.cpu_count(),
+        help="processes to calculate in (default: one per CPU)")
+    parser.add_argument(
+        '--batch-size', type=int, default=BATCH_SIZE,
+        help="characters per batch and per bulk write (default: {})".format(
+            BATCH_SIZE))
+    parser.add_argument(
+        '--write', action='store_true',
+        help="write normalised classes, hit points and statistics back")
+    args, sys.argv[1:] = parser.parse_known_args()
+    config = DndConfiguration()
+    client = MongoClient(config.database.uri, **client_options(config))
+    collection = client[config.database.name].characters
+    start = time.perf_counter()
+    totals = recalculate_all(
+        collection, args.workers, args.batch_size, args.write,
+        lambda anomaly: print("{} {}: {} {}".format(*anomaly)))
+    seconds = time.perf_counter() - start
+    print("{} characters in {:.1f} s: {:.0f} characters/s with {} workers".format(
+        totals.characters, seconds, totals.characters / max(seconds, 1e-9),
+        args.workers))
+    for kind, count in totals.anomalies.most_common():
+        print("{:8d}  {}".format(count, kind))
+    if args.write:
+        print("{} characters written".format(totals.written))
+    print("peak memory: {:.1f} MiB here, {:.1f} MiB in the largest worker".format(
+        _megabytes(resource.getrusage(resource.RUSAGE_SELF)),
+        _megabytes(resource.getrusage(resource.RUSAGE_CHILDREN))))
+    if len(totals.anomalies) > 0:
+        sys.exit(1)
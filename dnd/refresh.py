@@ -0,0 +1,84 @@
+"""
+Recalculation of the statistics stored with characters.
+
+Characters store the statistics listings show in their `computed` field,
+stamped with the statistics engine and catalog version they were
+calculated with. After an upgrade changes either, the server recalculates
+the stale characters in the background, in batches, so listings read the
+stored statistics again without computing them per request.
+"""
+import asyncio
+import logging
+from pymongo import UpdateOne
+from dnd.character import calculate_stats, computed_stats, stats_stamp
+from dnd.recalc import PROJECTION
+
+LOGGER = logging.getLogger(__name__)
+
+async def refresh_batch(db, after=None, batch_size=100):
+    """
+    Recalculate the next `batch_size` stale characters with an _id after `after`.
+
+    A character is only written if its version did not change meanwhile,
+    an edit stores fresh statistics anyway. The background text is left
+    in the database, it does not count towards the statistics. Returns
+    the last _id seen, None when there are no stale characters left, and
+    the number written.
+    """
+    query = {'computed.stamp': {'$ne': stats_stamp()}}
+    if after is not None:
+        query['_id'] = {'$gt': after}
+    characters = await db.characters.find(query, PROJECTION).sort(
+        '_id', 1).to_list(length=batch_size)
+    requests = []
+    for character in characters:
+        # let requests in between characters
+        await asyncio.sleep(0)
+        try:
+            calculate_stats(character)
+        except (
+                AttributeError, KeyError, IndexError, TypeError,
+                ValueError):
+            LOGGER.exception(
+                "cannot calculate statistics of character %s",
+                character['_id'])
+            continue
+        requests.append(UpdateOne(
+            {'_id': character['_id'], 'version': character.get('version', 0)},
+            {'$set': {'computed': computed_stats(character)}}))
+    written = 0
+    if len(requests) > 0:
+        result = await db.characters.bulk_write(requests, ordered=False)
+        written = result.modified_count
+    last = characters[-1]['_id'] if len(characters) == batch_size else None
+    return last, written
+
+async def refresh_stale(db, batch_size, pause):
+    """Recalculate all stale characters, pausing `pause` seconds between batches."""
+    after = None
+    total = 0
+    while True:
+        after, written = await refresh_batch(db, after, batch_size)
+        total += written
+        if after is None:
+            break
+        await asyncio.sleep(pause)
+    if total > 0:
+        LOGGER.info("recalculated the statistics of %d characters", total)
+    return total
+
+def _refresher_done(task):
+    if not task.cancelled() and task.exception() is not None:
+        LOGGER.error(
+            "recalculating stale statistics stopped",
+            exc_info=task.exception())
+
+def stale_stats_refresher(batch_size, pause):
+    """aiohttp startup and cleanup hooks recalculating stale statistics."""
+    async def start(app):
+        app['stats_refresher'] = asyncio.ensure_future(
+            refresh_stale(app['db'], batch_size, pause))
+        app['stats_refresher'].add_done_callback(_refresher_done)
+    async def stop(app):
+        app['stats_refresher'].cancel()
+    return start, stop
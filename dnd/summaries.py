@@ -0,0 +1,24 @@
+"""Character summaries for listings such as the navigation bar."""
+from dnd.character import SUMMARY_FIELDS, calculate_summary
+
+SUMMARY_PROJECTION = {field: True for field in SUMMARY_FIELDS}
+
+async def character_summaries(app, user_id):
+    """Summaries of the characters of a user, cached until they are written."""
+    cache = app.get('summary_cache')
+    summaries = None if cache is None else cache.get(user_id)
+    if summaries is None:
+        summaries = await app['db'].characters.find(
+            {'user_id': user_id},
+            SUMMARY_PROJECTION).to_list(length=100)
+        for character in summaries:
+            calculate_summary(character)
+        if cache is not None:
+            cache.put(user_id, summaries)
+    return summaries
+
+def invalidate_summaries(app, user_id):
+    """Forget cached summaries after a character of `user_id` was written."""
+    cache = app.get('summary_cache')
+    if cache is not None:
+        cache.pop(user_id)
@@ -0,0 +1,257 @@
+"""
+Export and import of characters as newline delimited JSON.
+
+Every line is one character in MongoDB extended JSON, so ObjectIds and
+datetimes, such as the ids of weapons and armour, survive the round trip.
+Characters are exported as stored, without the rendered background and
+the statistics, which are calculated again on import. Both directions
+work a line or a batch at a time, so memory use does not depend on the
+number of characters.
+"""
+import re
+import sys
+import copy
+import argparse
+from bson import ObjectId, json_util
+from markupsafe import Markup, escape
+from pymongo.errors import BulkWriteError
+from dnd.character import BACKGROUND_FIELDS, calculate_stats, computed_stats
+from dnd.recalc import shape_problems, unknown_names
+
+CONTENT_TYPE = 'application/x-ndjson'
+
+IMPORT_BATCH_SIZE = 500
+
+# rendered HTML is never imported, it is rendered from the text instead
+DERIVED_FIELDS = ['computed'] + [
+    '{}_{}'.format(field, suffix)
+    for field in BACKGROUND_FIELDS for suffix in ('safe', 'hash')]
+
+# the same for the description of every inventory item
+DERIVED_ITEM_FIELDS = ['description', 'description_hash']
+
+EXPORT_PROJECTION = {field: False for field in DERIVED_FIELDS}
+
+# what the inventory validator keeps of item names, they become field paths
+ITEM_NAME_CHARACTERS = "[a-zA-Z0-9-_ ()]*"
+
+def _item_name(text):
+    return ''.join(re.findall(ITEM_NAME_CHARACTERS, text))
+
+def _normalise_names(character):
+    """
+    Escape the name and clean the inventory of `character` as edits do.
+
+    Names are stored escaped, so they are unescaped first and exported
+    names stay as they are. Returns the problems with names that can not
+    be stored.
+    """
+    problems = []
+    name = character.get('name')
+    if not isinstance(name, str):
+        problems.append("name is not a string")
+    else:
+        character['name'] = str(escape(Markup(name).unescape().strip()))
+        if len(character['name']) < 1 or len(character['name']) > 50:
+            problems.append(
+                "name should be between one and fifty characters long")
+    inventory = {}
+    for key, item in character.get('inventory', {}).items():
+        name = _item_name(key)
+        if name.strip() == '':
+            problems.append("inventory item {!r} has no valid name".format(key))
+        elif name in inventory:
+            problems.append(
+                "inventory item {!r} has the same name as another".format(key))
+        if isinstance(item.get('extra'), str):
+            item['extra'] = _item_name(item['extra'])
+        inventory[name] = item
+    if 'inventory' in character:
+        character['inventory'] = inventory
+    return problems
+
+def export_query(user_id=None, campaign_id=None):
+    """
+    Query for the characters of a user or of a campaign.
+
+    Characters do not link to campaigns yet, `campaign_id` matches
+    characters that carry a campaign_id field.
+    """
+    query = {}
+    if user_id is not None:
+        query['user_id'] = user_id
+    if campaign_id is not None:
+        query['campaign_id'] = campaign_id
+    return query
+
+def dumps(character):
+    """`character` as a line of extended JSON."""
+    return json_util.dumps(
+        character, json_options=json_util.RELAXED_JSON_OPTIONS) + '\n'
+
+def prepare_import(line, user_id=None, new_ids=False):
+    """
+    Character to insert for a `line` of an export, and its problems.
+
+    The character is checked against the catalogs, its name and inventory
+    are cleaned like edits clean them, its statistics are calculated and
+    its background and item descriptions rendered. With `user_id` it is
+    handed to that user, with `new_ids` it gets a new _id so it is
+    imported as a copy.
+    """
+    character = json_util.loads(line)
+    if not isinstance(character, dict):
+        return None, ["not a character, expected a JSON object"]
+    problems = shape_problems(character)
+    if len(problems) > 0:
+        return character, problems
+    problems = _normalise_names(character)
+    if len(problems) > 0:
+        return character, problems
+    for field in DERIVED_FIELDS:
+        character.pop(field, None)
+    inventory = character.get('inventory')
+    if isinstance(inventory, dict):
+        for item in inventory.values():
+            if isinstance(item, dict):
+                for field in DERIVED_ITEM_FIELDS:
+                    item.pop(field, None)
+    if user_id is not None:
+        character['user_id'] = user_id
+    if new_ids:
+        character.pop('_id', None)
+    character.setdefault('version', 0)
+    problems = [
+        '{} {}'.format(kind, name) for kind, name in unknown_names(character)]
+    if 'user_id' not in character:
+        problems.append("no user_id, pass --user")
+    calculated = copy.deepcopy(character)
+    try:
+        calculate_stats(calculated)
+    except (
+            AttributeError, KeyError, IndexError, TypeError,
+            ValueError) as error:
+        problems.append("statistics can not be calculated: {!r}".format(error))
+    else:
+        character['computed'] = computed_stats(calculated)
+        for field in BACKGROUND_FIELDS:
+            for suffix in ('safe', 'hash'):
+                key = '{}_{}'.format(field, suffix)
+                if key in calculated:
+                    character[key] = calculated[key]
+        if 'inventory' in character:
+            character['inventory'] = calculated['inventory']
+    return character, problems
+
+def _insert(collection, batch):
+    """Insert `batch` of (line number, character), returns the failures."""
+    try:
+        collection.insert_many(
+            [character for _, character in batch], ordered=False)
+    except BulkWriteError as error:
+        return [
+            (batch[write_error['index']][0], write_error['errmsg'])
+            for write_error in error.details['writeErrors']]
+    return []
+
+def import_characters(collection, lines, user_id=None, new_ids=False,
+                      batch_size=IMPORT_BATCH_SIZE):
+    """
+    Insert the characters of an export into the pymongo `collection`.
+
+    Returns the number inserted and (line number, problem) pairs of the
+    characters that were not.
+    """
+    inserted = 0
+    failures = []
+    batch = []
+    for number, line in enumerate(lines, 1):
+        if line.strip() == '':
+            continue
+        try:
+            character, problems = prepare_import(line, user_id, new_ids)
+        except ValueError as error:
+            failures.append((number, "invalid JSON: {}".format(error)))
+            continue
+        if len(problems) > 0:
+            failures.extend((number, problem) for problem in problems)
+            continue
+        batch.append((number, character))
+        if len(batch) == batch_size:
+            batch_failures = _insert(collection, batch)
+            inserted += len(batch) - len(batch_failures)
+            failures.extend(batch_failures)
+            batch = []
+    if len(batch) > 0:
+        batch_failures = _insert(collection, batch)
+        inserted += len(batch) - len(batch_failures)
+        failures.extend(batch_failures)
+    return inserted, failures
+
+def _user_id(db, user):
+    """_id of the user with _id or email address `user`."""
+    # ObjectId takes any 12 character string, so check for the hex form
+    if len(user) == 24 and ObjectId.is_valid(user):
+        return ObjectId(user)
+    found = db.users.find_one({'email': user}, {'_id': True})
+    if found is None:
+        raise SystemExit("no user with email address {}".format(user))
+    return found['_id']
+
+def _database():
+    from pymongo import MongoClient
+    from dnd import DndConfiguration
+    from dnd.database import client_options
+    config = DndConfiguration()
+    client = MongoClient(config.database.uri, **client_options(config))
+    return client[config.database.name]
+
+def export_main():
+    """Write characters as newline delimited JSON (`dnd export`)."""
+    parser = argparse.ArgumentParser(
+        prog='dnd export',
+        description="export characters as newline delimited JSON")
+    parser.add_argument('--user', help="_id or email address of the owner")
+    parser.add_argument('--campaign', help="_id of the campaign")
+    parser.add_argument(
+        '--output', type=argparse.FileType('w'), default=sys.stdout,
+        help="file to write to (default: standard output)")
+    args, sys.argv[1:] = parser.parse_known_args()
+    db = _database()
+    query = export_query(
+        None if args.user is None else _user_id(db, args.user),
+        None if args.campaign is None else ObjectId(args.campaign))
+    count = 0
+    for character in db.characters.find(query, EXPORT_PROJECTION):
+        args.output.write(dumps(character))
+        count += 1
+    args.output.flush()
+    print("exported {} characters".format(count), file=sys.stderr)
+
+def import_main():
+    """Insert characters from newline delimited JSON (`dnd import`)."""
+    parser = argparse.ArgumentParser(
+        prog='dnd import',
+        description="import characters from newline delimited JSON")
+    parser.add_argument(
+        'input', type=argparse.FileType('r'),
+        help="export to import, - for standard input")
+    parser.add_argument(
+        '--user', help="_id or email address of the new owner")
+    parser.add_argument(
+        '--new-ids', action='store_true',
+        help="import copies with new _ids instead of the exported ones")
+    parser.add_argument(
+        '--batch-size', type=int, default=IMPORT_BATCH_SIZE,
+        help="characters per insert (default: {})".format(IMPORT_BATCH_SIZE))
+    args, sys.argv[1:] = parser.parse_known_args()
+    db = _database()
+    inserted, failures = import_characters(
+        db.characters, args.input,
+        None if args.user is None else _user_id(db, args.user),
+        args.new_ids, args.batch_size)
+    for number, problem in sorted(failures):
+        print("line {}: {}".format(number, problem))
+    print("imported {} characters, {} problems".format(inserted, len(failures)))
+    if len(failures) > 0:
+        sys.exit(1)
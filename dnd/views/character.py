@@ -1,15 +1,26 @@
 """Character page."""
-import time
+import asyncio
 import datetime
+import json
+import logging
 import re
 from inspect import iscoroutinefunction
 from bson import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
 from aiohttp_login.decorators import restricted_api
-from aiohttp.web import json_response
+from aiohttp import WSMsgType
+from aiohttp.web import json_response, WebSocketResponse
+from multidict import MultiDict
 from markupsafe import escape
-from aiohttp_jinja2 import get_env
 from dnd.decorators import login_required
+from dnd.summaries import invalidate_summaries
 from dnd.common import format_errors
+from dnd.database import collection, Update
+from dnd.fragments import render_fragment, known_hashes, strip_known_fragments
+from dnd.coalesce import BufferFull
+from dnd.live import LiveSocket
+from dnd.metrics import stats_timer
 from dnd.character import (
     ABILITIES,
     RACES,
@@ -26,23 +37,41 @@ from dnd.character import (
     WEAPON_AGES,
     ARMOUR,
     ARMOUR_AGES,
+    BACKGROUND_FIELDS,
     convert_coins,
-    calculate_stats)
+    markdown_hash,
+    render_markdown,
+    calculate_stats,
+    computed_stats,
+    recalculate)
 
-async def get_character(request):
-    """Fetch character from database."""
+LOGGER = logging.getLogger(__name__)
+
+# tries to write an edit while other writes keep changing the character
+WRITE_ATTEMPTS = 3
+
+async def get_character(request, use_cache=True):
+    """Fetch character from the character cache or the database."""
     errors = []
     editing_privileges = False
-    characters = request.app['db'].characters
-    character = await characters.find_one(
-        {'_id': ObjectId(request.match_info['id'])})
+    cache = request.app.get('character_cache')
+    character = None
+    if cache is not None and use_cache:
+        character = cache.get(request.match_info['id'])
+    if character is None:
+        characters = collection(request, 'characters')
+        character = await characters.find_one(
+            {'_id': ObjectId(request.match_info['id'])})
+        if character is not None:
+            with stats_timer(request.app, 'calculate_stats'):
+                calculate_stats(character)
+            if cache is not None:
+                cache.put(character)
     if character is None:
         errors.append('character {} does not exist'.format(
             request.match_info['id']))
-    else:
-        if request['user']['_id'] == character['user_id']:
-            editing_privileges = True
-        calculate_stats(character)
+    elif request['user']['_id'] == character['user_id']:
+        editing_privileges = True
     return (errors, editing_privileges, character)
 
 @login_required(template_file='character.html')
@@ -69,76 +98,369 @@ async def character_handler(request):
         'character': character,
         'errors': errors}
 
+def _json_response(request, data, status=200):
+    return json_response(data, status=status, headers={
+        'X-Db-Round-Trips': str(request.get('db_round_trips', 0))})
+
+class _Operation:
+
+    """One operation of an edit, standing in for the request with its fields."""
+
+    def __init__(self, request, attribute, extra, fields):
+        self._request = request
+        self.match_info = {
+            'id': request.match_info['id'],
+            'attribute': attribute,
+            'extra': extra}
+        self.POST = MultiDict(
+            (key, str(value)) for key, value in fields.items())
+
+    def __getattr__(self, name):
+        return getattr(self._request, name)
+
+    def __getitem__(self, key):
+        return self._request[key]
+
+    def __setitem__(self, key, value):
+        self._request[key] = value
+
+async def _validate(operations, character, errors):
+    """
+    Validate `operations` in order and apply them to `character`.
+
+    Validators either return the fields to set or an Update with field
+    level operators, after applying it to the character themselves.
+    Returns the merged Update, the response factories to call and whether
+    the edit asked for the form to stay open.
+    """
+    changes = Update()
+    response_factories = []
+    close = True
+    for operation in operations:
+        attribute = operation.match_info['attribute']
+        if attribute not in ATTRIBUTE_FUNCTIONS:
+            errors.append("unknown attribute")
+            break
+        validator, response_factory = ATTRIBUTE_FUNCTIONS[attribute]
+        if iscoroutinefunction(validator):
+            validated_data = await validator(operation, character, errors)
+        else:
+            validated_data = validator(operation, character, errors)
+        if len(errors) > 0:
+            break
+        if not isinstance(validated_data, Update):
+            character.update(validated_data)
+            validated_data = Update(validated_data)
+        with stats_timer(operation.app, 'recalculate'):
+            recalculate(character, validated_data.fields())
+        changes.merge(validated_data, character)
+        if response_factory not in response_factories:
+            response_factories.append(response_factory)
+        if operation.POST.get('type') == 'action':
+            close = False
+    return changes, response_factories, close
+
+def _keep_stored(character, document, fields):
+    # take `fields` as stored, including concurrent changes to them
+    stale = set()
+    for field in fields:
+        if document.get(field) != character.get(field):
+            stale.add(field)
+        character[field] = document.get(field)
+    if len(stale) > 0:
+        recalculate(character, stale)
+
+async def _validate_edits(edits, responses, use_cache):
+    """
+    Load the character and validate `edits` that have no response yet.
+
+    Invalid edits, and edits whose validation raises, get their error
+    response in `responses`. Returns the errors that fail all edits, the
+    character, the merged changes and (index, response factories, close)
+    of every valid edit.
+    """
+    request = edits[0][0]
+    while True:
+        errors, editing_privileges, character = await get_character(
+            request, use_cache)
+        if not editing_privileges:
+            errors.append(
+                "you don't have the required privileges to alter this character")
+        changes = Update()
+        applied = []
+        for index, (_, operations) in enumerate(edits):
+            if len(errors) > 0:
+                break
+            if responses[index] is not None:
+                continue
+            edit_errors = []
+            try:
+                edit_changes, response_factories, close = await _validate(
+                    operations, character, edit_errors)
+            except Exception:  # pylint: disable=broad-except
+                LOGGER.exception(
+                    "validating an edit of %s failed", request.match_info['id'])
+                responses[index] = {'errors': format_errors(
+                    ["this edit could not be applied"])}
+                # it may have changed the character halfway, start over
+                break
+            if len(edit_errors) > 0:
+                responses[index] = {'errors': format_errors(edit_errors)}
+                if len(edit_changes) > 0:
+                    # part of the edit is applied already, start over
+                    break
+                continue
+            changes.merge(edit_changes, character)
+            applied.append((index, response_factories, close))
+        else:
+            return errors, character, changes, applied
+        if len(errors) > 0:
+            return errors, character, changes, applied
+
+def _too_many_edits():
+    return {'errors': format_errors([
+        "too many edits at once, wait a moment and try again"])}
+
+async def _apply_edits(edits):
+    """
+    Apply `edits`, pairs of a request and its operations, to one character.
+
+    The character is loaded once and each operation is validated against
+    the result of the ones before it, recalculating only the statistics
+    that depend on the validated fields. An edit with an invalid operation
+    is left out as a whole. The others are written, with the statistics
+    that character listings read, in a single find_one_and_update that
+    only matches the version of the character they were validated against.
+    If the character changed in the meantime, they are validated again
+    against the stored character. Returns the response data of each edit,
+    all showing the final state of the character, which is also published
+    to the live sockets of the character.
+    """
+    request = edits[0][0]
+    responses = [None] * len(edits)
+    cache = request.app.get('character_cache')
+    for attempt in range(WRITE_ATTEMPTS):
+        errors, character, changes, applied = await _validate_edits(
+            edits, responses, use_cache=attempt == 0)
+        if len(errors) > 0 or len(changes) == 0:
+            break
+        version = character['version']
+        changes.inc('version')
+        computed = computed_stats(character)
+        if computed != character.get('computed'):
+            changes.set('computed', computed)
+            character['computed'] = computed
+        try:
+            document = await collection(
+                request, 'characters').find_one_and_update(
+                    {'_id': character['_id'], 'version': version},
+                    changes.document(),
+                    array_filters=changes.array_filters or None,
+                    return_document=ReturnDocument.AFTER)
+        except DuplicateKeyError:
+            # renamed concurrently to a name that is taken by now
+            errors.append("you already have a character with this name")
+            break
+        if document is not None:
+            invalidate_summaries(request.app, character['user_id'])
+            _keep_stored(character, document, changes.fields())
+            if cache is not None:
+                cache.written(character)
+            break
+        # written meanwhile, by another process or request
+        if cache is not None:
+            cache.invalidate(character['_id'])
+    else:
+        errors.append("database error")
+    for edit_request, _ in edits:
+        edit_request['db_round_trips'] = request.get('db_round_trips', 0)
+    if len(errors) > 0:
+        return [
+            {'errors': format_errors(errors)} if response is None else response
+            for response in responses]
+    update = {}
+    for index, response_factories, close in applied:
+        response = {'close': close}
+        for response_factory in response_factories:
+            if iscoroutinefunction(response_factory):
+                await response_factory(response, character, request.app)
+            else:
+                response_factory(response, character, request.app)
+        responses[index] = response
+        update.update(response)
+    hub = request.app.get('live_hub')
+    if hub is not None and len(applied) > 0:
+        del update['close']
+        hub.publish(character['_id'], update)
+    return responses
+
+async def _submit(request, operations):
+    """
+    Apply `operations` to the character of `request`.
+
+    Returns the HTTP status and the response data. Every database write
+    counts towards the rate limit of the user. With a write coalescer,
+    edits of the same user to the same character that arrive while one
+    of them is being written are written together afterwards, so only
+    the edit that finds no write in flight is charged, and a limited
+    number of edits is collected during a write. Edits over either limit
+    are refused with status 429 and an error.
+    """
+    coalescer = request.app.get('write_coalescer')
+    key = (request.match_info['id'], request['user']['_id'])
+    if coalescer is None or not coalescer.is_open(key):
+        if not await request.app['rate_limiter'].allow(request['user']['_id']):
+            return 429, _too_many_edits()
+    if coalescer is None:
+        return 200, (await _apply_edits([(request, operations)]))[0]
+    try:
+        return 200, await coalescer.submit(
+            key, (request, operations), _apply_edits)
+    except BufferFull:
+        return 429, _too_many_edits()
+
+async def _edit(request, operations):
+    """
+    Apply `operations` and answer with JSON.
+
+    The number of database round trips is returned in the X-Db-Round-Trips
+    header and markup the client already has, according to the fragment
+    hashes it sends, is left out.
+    """
+    status, response = await _submit(request, operations)
+    return _json_response(
+        request,
+        strip_known_fragments(response, known_hashes(request)),
+        status=status)
+
+def _too_many_operations(request, body):
+    """Error if `body` holds more operations than one batch may, or None."""
+    limit = request.app['max_batch_operations']
+    if isinstance(body, list) and len(body) > limit:
+        return {'errors': format_errors([
+            "at most {} operations can be sent at once".format(limit)])}
+    return None
+
+def _parse_operations(request, body):
+    """Operations in `body`, None if it is not a list of operations."""
+    if not isinstance(body, list) or len(body) == 0:
+        return None
+    operations = []
+    for entry in body:
+        if not isinstance(entry, dict) or \
+                not isinstance(entry.get('attribute'), str) or \
+                not isinstance(entry.get('extra'), (str, type(None))) or \
+                not isinstance(entry.get('fields', {}), dict):
+            return None
+        operations.append(_Operation(
+            request,
+            entry.get('attribute'),
+            entry.get('extra'),
+            entry.get('fields', {})))
+    return operations
+
 @restricted_api
 async def data_handler(request):
     """Edit character attribute data."""
-    errors, editing_privileges, character = await get_character(request)
-    if not editing_privileges:
-        errors.append("you don't have the required privileges to alter this character")
-    user = await request.app['db'].users.find_one(
-        {'_id': ObjectId(request['user']['_id'])})
-    if 'last_action' in user and abs(user['last_action'] - time.perf_counter()) < 0.125:
-        return json_response({})
-    result = await request.app['db'].users.update_one(
-        {'_id': ObjectId(user['_id'])},
-        {'$set': {'last_action': time.perf_counter()}})
-    if not result.acknowledged:
-        errors.append("database error")
+    operation = _Operation(
+        request,
+        request.match_info['attribute'],
+        request.match_info.get('extra'),
+        await request.post())
+    return await _edit(request, [operation])
 
-    attribute = request.match_info['attribute']
-    attribute_functions = {
-        'ability': (_ability_validator, _ability_response_factory),
-        'xp': (_xp_validator, _xp_response_factory),
-        'hp': (_hp_validator, _hp_response_factory),
-        'race': (_race_validator, _race_response_factory),
-        'class': (_class_validator, _class_response_factory),
-        'skill': (_skill_validator, _skill_response_factory),
-        'spell': (_spell_validator, _spell_response_factory),
-        'prepare_spell': (_prepare_spell_validator, _prepare_spell_response_factory),
-        'prayer': (_prayer_validator, _prayer_response_factory),
-        'prepare_prayer': (_prepare_prayer_validator, _prepare_prayer_response_factory),
-        'power': (_power_validator, _power_response_factory),
-        'name': (_name_validator, _name_response_factory),
-        'background': (_background_validator, _background_response_factory),
-        'inventory': (_inventory_validator, _inventory_response_factory),
-        'armour': (_armour_validator, _armour_response_factory),
-        'weapon': (_weapon_validator, _weapon_response_factory),
-        'coin': (_coin_validator, _coin_response_factory),
-        'rest': (_rest_validator, _rest_response_factory),
-    }
-    if attribute not in attribute_functions:
-        errors.append("unknown attribute")
-    else:
-        validator, response_factory = attribute_functions[attribute]
-        await request.post()
-        if iscoroutinefunction(validator):
-            validated_data = await validator(request, errors)
+@restricted_api
+async def batch_handler(request):
+    """
+    Edit several character attributes at once.
+
+    The body is a JSON list of {"attribute", "extra", "fields"} objects,
+    applied in order as if they were posted to data_handler one by one.
+    A batch counts as one edit towards the rate limit. Malformed bodies
+    and batches of more than rate_limit.batch_operations operations are
+    refused with status 400.
+    """
+    try:
+        body = await request.json()
+    except ValueError:
+        body = None
+    too_many = _too_many_operations(request, body)
+    if too_many is not None:
+        return _json_response(request, too_many, status=400)
+    operations = _parse_operations(request, body)
+    if operations is None:
+        return _json_response(request, {'errors': format_errors([
+            'expected a list of {"attribute", "extra", "fields"} objects'])},
+            status=400)
+    return await _edit(request, operations)
+
+@restricted_api
+async def live_handler(request):
+    """
+    WebSocket with live updates of a character.
+
+    Every change to the character is pushed as the markup the socket does
+    not have yet. Edits can be sent as {"id", "operations"} messages, with
+    operations as in batch_handler, and the fragment hashes of the page in
+    "hashes". They are answered with a reply carrying the same id.
+    """
+    characters = collection(request, 'characters')
+    if await characters.find_one(
+            {'_id': ObjectId(request.match_info['id'])}, {'_id': 1}) is None:
+        return _json_response(request, {'errors': format_errors([
+            'character {} does not exist'.format(request.match_info['id'])])})
+    websocket = WebSocketResponse(heartbeat=30)
+    await websocket.prepare(request)
+    socket = LiveSocket(websocket)
+    hub = request.app['live_hub']
+    hub.subscribe(request.match_info['id'], socket)
+    tasks = {asyncio.ensure_future(socket.run())}
+    try:
+        async for message in websocket:
+            if message.type == WSMsgType.TEXT:
+                task = asyncio.ensure_future(
+                    _live_edit(request, socket, message.data))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+    finally:
+        hub.unsubscribe(request.match_info['id'], socket)
+        for task in tasks:
+            task.cancel()
+    return websocket
+
+async def _live_edit(request, socket, text):
+    try:
+        message = json.loads(text)
+    except ValueError:
+        message = None
+    if not isinstance(message, dict):
+        return
+    if isinstance(message.get('hashes'), dict):
+        socket.reset(message['hashes'])
+    response = _too_many_operations(request, message.get('operations'))
+    if response is None:
+        operations = _parse_operations(request, message.get('operations'))
+        if operations is None:
+            response = {'errors': format_errors([
+                'expected a list of {"attribute", "extra", "fields"} objects'])}
         else:
-            validated_data = validator(request, errors)
-    if len(errors) == 0:
-        characters = request.app['db'].characters
-        result = await characters.update_one(
-            {'_id': ObjectId(request.match_info['id'])},
-            {'$set': validated_data})
-        if not result.acknowledged:
-            errors.append("database error")
-    if len(errors) > 0:
-        return json_response({'errors': format_errors(errors)})
-    # no errors whatsoever, return data
-    character = await characters.find_one(
-        {'_id': ObjectId(request.match_info['id'])})
-    calculate_stats(character)
-    if 'type' in request.POST and request.POST['type'] == 'action':
-        response = {'close': False}
-    else:
-        response = {'close': True}
-    if iscoroutinefunction(response_factory):
-        await response_factory(response, character, request.app)
-    else:
-        response_factory(response, character, request.app)
-    return json_response(response)
+            try:
+                _, response = await _submit(request, operations)
+            except asyncio.CancelledError:
+                # an Exception before Python 3.8, the socket is closing
+                raise
+            except Exception:  # pylint: disable=broad-except
+                # the page waits for a reply to every edit
+                LOGGER.exception(
+                    "live edit of %s failed", request.match_info['id'])
+                response = {'errors': format_errors(
+                    ["this edit could not be applied"])}
+    socket.send({
+        'type': 'reply',
+        'id': message.get('id'),
+        'data': socket.delta(response)})
 
-def _ability_validator(request, errors):
+def _ability_validator(request, _character, errors):
     ability = request.match_info['extra']
     if ability not in ABILITIES:
         errors.append("invalid ability")
@@ -149,8 +471,10 @@ def _ability_validator(request, errors):
         temp = int(request.POST['temp-{}'.format(ability)])
     except ValueError:
         errors.append("invalid value: only integers allowed")
+        return {}
     except KeyError as error:
         errors.append("missing value: {}".format(error))
+        return {}
     return {
         ability + '_base': base,
         ability + '_level': level,
@@ -185,13 +509,15 @@ def _ability_response_factory(response, character, app):
     _prayer_response_factory(response, character, app)
     _hp_response_factory(response, character, app)
 
-def _xp_validator(request, errors):
+def _xp_validator(request, _character, errors):
     try:
         xp = int(request.POST['xp'])
     except ValueError:
         errors.append("invalid value: only integers allowed")
+        return {}
     except KeyError as error:
         errors.append("missing value: {}".format(error))
+        return {}
     return {'xp': xp}
 
 def _xp_response_factory(response, character, app):
@@ -201,14 +527,15 @@ def _xp_response_factory(response, character, app):
     _class_response_factory(response, character, app)
     _hp_response_factory(response, character, app)
 
-def _race_validator(request, errors):
+def _race_validator(request, _character, errors):
     try:
         race = request.POST['race'].strip()
     except KeyError as error:
         errors.append("missing value: {}".format(error))
-    else:
-        if race not in RACES:
-            errors.append("unknown race: {}".format(race))
+        return {}
+    if race not in RACES:
+        errors.append("unknown race: {}".format(race))
+        return {}
     return {'race_name': race}
 
 def _race_response_factory(response, character, app):
@@ -218,7 +545,7 @@ def _race_response_factory(response, character, app):
     _ability_response_factory(response, character, app)
     _skill_response_factory(response, character, app)
 
-def _class_validator(request, errors):
+def _class_validator(request, _character, errors):
     classes = []
     i = 1
     try:
@@ -252,16 +579,15 @@ def _class_response_factory(response, character, app):
     response['#powers-section'] = {
         'collapse': "show" if character['warlock'] > 0 else "hide"}
     response['#class-form-content'] = {
-        'data': get_env(app).get_template(
-            'character_class_form.html').render(
-                character=character, classes=CLASSES),
+        'data': render_fragment(
+            app, 'character_class_form.html', character, classes=CLASSES),
         'activateTooltip': True}
     _skill_response_factory(response, character, app)
     _spell_response_factory(response, character, app)
     _prayer_response_factory(response, character, app)
     _hp_response_factory(response, character, app)
 
-def _hp_validator(request, errors):
+def _hp_validator(request, _character, errors):
     per_level = []
     i = 1
     try:
@@ -269,7 +595,8 @@ def _hp_validator(request, errors):
             try:
                 hit_level = int(request.POST[str(i)])
             except ValueError:
-                errors.append("invalid value: {} (expected integer)".format(hit_level))
+                errors.append("invalid value: {} (expected integer)".format(
+                    escape(request.POST[str(i)])))
             else:
                 per_level.append(hit_level)
             i += 1
@@ -280,8 +607,12 @@ def _hp_validator(request, errors):
         damage = int(request.POST['damage'])
     except ValueError:
         errors.append("invalid value: only integers allowed")
+        return {}
     except KeyError as error:
         errors.append("missing value: {}".format(error))
+        return {}
+    if len(errors) != 0:
+        return {}
     return {
         'hitpoints_per_level': per_level,
         'temp_hp': temp_hp,
@@ -308,9 +639,8 @@ def _hp_response_factory(response, character, app):
         remove_classes.append('warning')
     rest_in_peace = "" if character['hp'] > -10 else "<span class=\"badge\">R.I.P</span>"
     response['#hp-form-content'] = {
-        'data': get_env(app).get_template(
-            'character_hp_form.html').render(
-                character=character, classes=CLASSES),
+        'data': render_fragment(
+            app, 'character_hp_form.html', character, classes=CLASSES),
         'activateTooltip': True}
     response['#hp-value'] = {'data': character['hp']}
     response['#alive'] = {'data': rest_in_peace}
@@ -318,7 +648,7 @@ def _hp_response_factory(response, character, app):
         'addClass': add_classes,
         'removeClass': remove_classes}
 
-def _skill_validator(request, _):
+def _skill_validator(request, _character, _):
     skills = []
     for skill in SKILLS:
         if skill in request.POST:
@@ -327,8 +657,8 @@ def _skill_validator(request, _):
 
 def _skill_response_factory(response, character, app):
     response['#skill-accordion'] = {
-        'data': get_env(app).get_template(
-            'character_skills_display.html').render(character=character),
+        'data': render_fragment(
+            app, 'character_skills_display.html', character),
         'activateTooltip': True}
     response['#skill-slots'] = {
         'data': character['unspent_skill_slots'],
@@ -337,7 +667,7 @@ def _skill_response_factory(response, character, app):
         'removeClass': ["label-danger"] if character[
             'unspent_skill_slots'] >= 0 else ["label-default"]}
 
-def _spell_validator(request, _):
+def _spell_validator(request, _character, _):
     spells = []
     for spell in SPELLS:
         if spell in request.POST:
@@ -345,16 +675,19 @@ def _spell_validator(request, _):
     return {'spell_names': spells}
 
 def _spell_response_factory(response, character, app):
-    response['#spell-accordion'] = {
-        'data': get_env(app).get_template(
-            'character_spells_display.html').render(
-                spells=SPELLS, character=character),
-        'activateTooltip': True}
+    # separate selectors, so a change in slots does not resend the list
+    response['#prepared-spells'] = {
+        'data': render_fragment(
+            app, 'character_prepared_spells.html', character, spells=SPELLS)}
     response['#spell-slots'] = {
-        'data': get_env(app).get_template(
-            'character_spell_slots.html').render(character=character)}
+        'data': render_fragment(
+            app, 'character_spell_slots.html', character)}
+    response['#spell-list'] = {
+        'data': render_fragment(
+            app, 'character_spell_list.html', character, spells=SPELLS),
+        'activateTooltip': True}
 
-async def _prepare_spell_validator(request, errors):
+def _prepare_spell_validator(request, character, errors):
     action = request.match_info['extra']
     if action not in ['prepare', 'cast', 'forget']:
         errors.append("invalid action")
@@ -363,17 +696,19 @@ async def _prepare_spell_validator(request, errors):
         name = request.POST['name']
     except KeyError as error:
         errors.append("missing value: {}".format(error))
-    more_errors, _, character = await get_character(request)
-    errors.extend(more_errors)
     if len(errors) != 0:
         return {}
+    update = Update()
+    path = 'prepared_spells.{}'.format(name)
     if action == 'prepare':
         if name not in character['spells']:
             errors.append('{} is unknown to character'.format(name))
+        elif name not in character['prepared_spells']:
+            character['prepared_spells'][name] = {'prepared': 1, 'cast': 0}
+            update.set(path, character['prepared_spells'][name])
         else:
-            if name not in character['prepared_spells']:
-                character['prepared_spells'][name] = {'prepared': 0, 'cast': 0}
             character['prepared_spells'][name]['prepared'] += 1
+            update.inc(path + '.prepared')
     elif action == 'cast':
         if name not in character['prepared_spells']:
             errors.append('{} is not a prepared spell'.format(name))
@@ -382,53 +717,61 @@ async def _prepare_spell_validator(request, errors):
             errors.append('not enough spells prepared')
         else:
             character['prepared_spells'][name]['cast'] += 1
+            update.inc(path + '.cast')
     elif action == 'forget':
         if name not in character['prepared_spells']:
             errors.append('{} is not a prepared spell'.format(name))
         else:
             character['prepared_spells'][name]['prepared'] -= 1
+            update.inc(path + '.prepared', -1)
             if character['prepared_spells'][name]['cast'] > \
                     character['prepared_spells'][name]['prepared']:
                 character['prepared_spells'][name]['cast'] = \
                         character['prepared_spells'][name]['prepared']
+                update.set(
+                    path + '.cast', character['prepared_spells'][name]['cast'])
             if character['prepared_spells'][name]['prepared'] == 0:
                 del character['prepared_spells'][name]
-    return {'prepared_spells': character['prepared_spells']}
+                update = Update().unset(path)
+    return update
 
 def _prepare_spell_response_factory(response, character, app):
     response['close'] = False
     response['#prepared-spells'] = {
-        'data': get_env(app).get_template(
-            'character_prepared_spells.html').render(
-                spells=SPELLS, character=character)}
+        'data': render_fragment(
+            app, 'character_prepared_spells.html', character, spells=SPELLS)}
     response['#spell-slots'] = {
-        'data': get_env(app).get_template(
-            'character_spell_slots.html').render(character=character)}
+        'data': render_fragment(
+            app, 'character_spell_slots.html', character)}
 
-def _prayer_validator(request, errors):
+def _prayer_validator(request, _character, errors):
     spheres = {'all'}
     for number in range(1, 4):
         try:
             sphere = request.POST[str(number)]
         except KeyError as error:
             errors.append("missing value: {}".format(error))
+            return {}
         if sphere not in PRAYER_SPHERES:
             errors.append("{} is not a valid prayer sphere".format(sphere))
-        else:
-            spheres.add(sphere)
+            return {}
+        spheres.add(sphere)
     return {'prayer_spheres': list(spheres)}
 
 def _prayer_response_factory(response, character, app):
-    response['#prayer-accordion'] = {
-        'data': get_env(app).get_template(
-            'character_prayers_display.html').render(
-                prayers=PRAYERS, character=character),
-        'activateTooltip': True}
+    # separate selectors, so a change in slots does not resend the list
+    response['#prepared-prayers'] = {
+        'data': render_fragment(
+            app, 'character_prepared_prayers.html', character, prayers=PRAYERS)}
     response['#prayer-slots'] = {
-        'data': get_env(app).get_template(
-            'character_prayer_slots.html').render(character=character)}
+        'data': render_fragment(
+            app, 'character_prayer_slots.html', character)}
+    response['#prayer-list'] = {
+        'data': render_fragment(
+            app, 'character_prayer_list.html', character, prayers=PRAYERS),
+        'activateTooltip': True}
 
-async def _prepare_prayer_validator(request, errors):
+def _prepare_prayer_validator(request, character, errors):
     action = request.match_info['extra']
     if action not in ['prepare', 'cast', 'forget']:
         errors.append("invalid action")
@@ -437,17 +780,19 @@ async def _prepare_prayer_validator(request, errors):
         name = request.POST['name']
     except KeyError as error:
         errors.append("missing value: {}".format(error))
-    more_errors, _, character = await get_character(request)
-    errors.extend(more_errors)
     if len(errors) != 0:
         return {}
+    update = Update()
+    path = 'prepared_prayers.{}'.format(name)
     if action == 'prepare':
         if name not in character['prayers']:
             errors.append('{} is unknown to character'.format(name))
+        elif name not in character['prepared_prayers']:
+            character['prepared_prayers'][name] = {'prepared': 1, 'cast': 0}
+            update.set(path, character['prepared_prayers'][name])
         else:
-            if name not in character['prepared_prayers']:
-                character['prepared_prayers'][name] = {'prepared': 0, 'cast': 0}
             character['prepared_prayers'][name]['prepared'] += 1
+            update.inc(path + '.prepared')
     elif action == 'cast':
         if name not in character['prepared_prayers']:
             errors.append('{} is not a prepared prayer'.format(name))
@@ -456,30 +801,34 @@ async def _prepare_prayer_validator(request, errors):
             errors.append('not enough prayers prepared')
         else:
             character['prepared_prayers'][name]['cast'] += 1
+            update.inc(path + '.cast')
     elif action == 'forget':
         if name not in character['prepared_prayers']:
             errors.append('{} is not a prepared prayer'.format(name))
         else:
             character['prepared_prayers'][name]['prepared'] -= 1
+            update.inc(path + '.prepared', -1)
             if character['prepared_prayers'][name]['cast'] > \
                     character['prepared_prayers'][name]['prepared']:
                 character['prepared_prayers'][name]['cast'] = \
                         character['prepared_prayers'][name]['prepared']
+                update.set(
+                    path + '.cast', character['prepared_prayers'][name]['cast'])
             if character['prepared_prayers'][name]['prepared'] == 0:
                 del character['prepared_prayers'][name]
-    return {'prepared_prayers': character['prepared_prayers']}
+                update = Update().unset(path)
+    return update
 
 def _prepare_prayer_response_factory(response, character, app):
     response['close'] = False
     response['#prepared-prayers'] = {
-        'data': get_env(app).get_template(
-            'character_prepared_prayers.html').render(
-                prayers=PRAYERS, character=character)}
+        'data': render_fragment(
+            app, 'character_prepared_prayers.html', character, prayers=PRAYERS)}
     response['#prayer-slots'] = {
-        'data': get_env(app).get_template(
-            'character_prayer_slots.html').render(character=character)}
+        'data': render_fragment(
+            app, 'character_prayer_slots.html', character)}
 
-def _power_validator(request, _):
+def _power_validator(request, _character, _):
     powers = []
     for power in POWERS:
         if power in request.POST:
@@ -488,13 +837,12 @@ def _power_validator(request, _):
 
 def _power_response_factory(response, character, app):
     response['#power-accordion'] = {
-        'data': get_env(app).get_template(
-            'character_powers_display.html').render(
-                character=character, powers=POWERS),
+        'data': render_fragment(
+            app, 'character_powers_display.html', character, powers=POWERS),
         'activateTooltip': True}
     _skill_response_factory(response, character, app)
 
-async def _armour_validator(request, errors):
+def _armour_validator(request, character, errors):
     action = request.match_info['extra']
     if action not in ['add', 'equip', 'unequip', 'remove']:
         errors.append("invalid action")
@@ -512,8 +860,6 @@ async def _armour_validator(request, errors):
         if time_period not in ARMOUR[name]['time_period']:
             errors.append("{} is not a time period that {} was made in".format(
                 time_period, name))
-    more_errors, _, character = await get_character(request)
-    errors.extend(more_errors)
     if action != "add":
         try:
             id_ = request.POST['id']
@@ -530,30 +876,30 @@ async def _armour_validator(request, errors):
             'equipped': False}
         armour.update(ARMOUR[name]['time_period'][time_period])
         character['armour'].append(armour)
-    else:
-        match_index = None
-        for i, armour in enumerate(character['armour']):
-            if str(armour['id']) == id_:
-                match_index = i
-        if match_index is None:
-            errors.append(
-                "no armour with ID {} in your inventory".format(id_))
-        elif action == "equip":
-            character['armour'][match_index]['equipped'] = True
-        elif action == "unequip":
-            character['armour'][match_index]['equipped'] = False
-        elif action == "remove":
-            del character['armour'][match_index]
-    return {'armour': character['armour']}
+        return Update().push('armour', armour)
+    match_index = None
+    for i, armour in enumerate(character['armour']):
+        if str(armour['id']) == id_:
+            match_index = i
+    if match_index is None:
+        errors.append(
+            "no armour with ID {} in your inventory".format(id_))
+        return {}
+    armour = character['armour'][match_index]
+    if action == "remove":
+        del character['armour'][match_index]
+        return Update().pull('armour', {'id': armour['id']})
+    armour['equipped'] = action == "equip"
+    return Update().set('armour.$[armour].equipped', armour['equipped']).match(
+        'armour', {'id': armour['id']})
 
 def _armour_response_factory(response, character, app):
     response['#armour-accordion'] = {
-        'data': get_env(app).get_template(
-            'character_armour_display.html').render(
-                character=character,),
+        'data': render_fragment(
+            app, 'character_armour_display.html', character),
         'activateTooltip': True}
 
-async def _weapon_validator(request, errors):
+def _weapon_validator(request, character, errors):
     action = request.match_info['extra']
     if action not in ['add', 'equip', 'unequip', 'remove']:
         errors.append("invalid action")
@@ -575,8 +921,6 @@ async def _weapon_validator(request, errors):
         elif time_period not in WEAPONS[name]['size'][size]['time_period']:
             errors.append("{} is not a time period that {} was made in".format(
                 time_period, name))
-    more_errors, _, character = await get_character(request)
-    errors.extend(more_errors)
     if action != "add":
         try:
             id_ = request.POST['id']
@@ -598,30 +942,30 @@ async def _weapon_validator(request, errors):
         weapon.update(
             WEAPONS[name]['size'][size]['time_period'][time_period])
         character['weapons'].append(weapon)
-    else:
-        match_index = None
-        for i, weapon in enumerate(character['weapons']):
-            if str(weapon['id']) == id_:
-                match_index = i
-        if match_index is None:
-            errors.append(
-                "no weapon with ID {} in your inventory".format(id_))
-        elif action == "equip":
-            character['weapons'][match_index]['equipped'] = True
-        elif action == "unequip":
-            character['weapons'][match_index]['equipped'] = False
-        elif action == "remove":
-            del character['weapons'][match_index]
-    return {'weapons': character['weapons']}
+        return Update().push('weapons', weapon)
+    match_index = None
+    for i, weapon in enumerate(character['weapons']):
+        if str(weapon['id']) == id_:
+            match_index = i
+    if match_index is None:
+        errors.append(
+            "no weapon with ID {} in your inventory".format(id_))
+        return {}
+    weapon = character['weapons'][match_index]
+    if action == "remove":
+        del character['weapons'][match_index]
+        return Update().pull('weapons', {'id': weapon['id']})
+    weapon['equipped'] = action == "equip"
+    return Update().set('weapons.$[weapon].equipped', weapon['equipped']).match(
+        'weapon', {'id': weapon['id']})
 
 def _weapon_response_factory(response, character, app):
     response['#weapons-accordion'] = {
-        'data': get_env(app).get_template(
-            'character_weapons_display.html').render(
-                character=character,),
+        'data': render_fragment(
+            app, 'character_weapons_display.html', character),
         'activateTooltip': True}
 
-async def _inventory_validator(request, errors):
+def _inventory_validator(request, character, errors):
     action = request.match_info['extra']
     if action not in ['add', 'edit', 'increment', 'decrement', 'remove']:
         errors.append("invalid action")
@@ -641,54 +985,68 @@ async def _inventory_validator(request, errors):
         errors.append("missing value: {}".format(error))
     except ValueError:
         errors.append("invalid value: only integers allowed")
-    more_errors, _, character = await get_character(request)
-    errors.extend(more_errors)
     if len(errors) != 0:
         return {}
-    if action == 'add' and name in character['inventory']:
+    # the name becomes part of a field path, which may not end in a dot
+    if name.strip() == '' or (action == 'edit' and new_name.strip() == ''):
+        errors.append(
+            "invalid name: use letters, digits, spaces, hyphens, "
+            "underscores or parentheses")
+    elif action == 'add' and name in character['inventory']:
         errors.append("inventory item with that name already exists")
     elif action != 'add' and name not in character['inventory']:
         errors.append("no inventory item with name {}".format(name))
     if len(errors) != 0:
         return {}
-    if action == 'add':
-        character['inventory'][name] = {
+    if action in ['add', 'edit']:
+        digest = markdown_hash(description)
+        item = {
             'amount': amount,
             'extra': extra,
-            'description_unsafe': description}
+            'description_unsafe': description,
+            'description': render_markdown(description, digest),
+            'description_hash': digest}
+    update = Update()
+    path = 'inventory.{}'.format(name)
+    if action == 'add':
+        character['inventory'][name] = item
+        update.set(path, item)
     elif action == 'increment':
         character['inventory'][name]['amount'] += 1
+        update.inc(path + '.amount')
     elif action == 'decrement':
         if character['inventory'][name]['amount'] < 1:
             errors.append("you cannot have less then zero items")
         else:
             character['inventory'][name]['amount'] -= 1
+            update.inc(path + '.amount', -1)
     elif action == 'remove':
         del character['inventory'][name]
+        update.unset(path)
     elif action == 'edit':
         del character['inventory'][name]
-        character['inventory'][new_name] = {
-            'amount': amount,
-            'extra': extra,
-            'description_unsafe': description}
-    return {'inventory': character['inventory']}
+        character['inventory'][new_name] = item
+        if new_name != name:
+            update.unset(path)
+        update.set('inventory.{}'.format(new_name), item)
+    return update
 
 def _inventory_response_factory(response, character, app):
     response['#inventory-accordion'] = {
-        'data': get_env(app).get_template(
-            'character_inventory_display.html').render(character=character)}
+        'data': render_fragment(
+            app, 'character_inventory_display.html', character)}
 
-async def _coin_validator(request, errors):
+def _coin_validator(request, character, errors):
     coins = {}
     try:
         for coin in COINS:
             coins[coin] = int(request.POST[coin])
     except ValueError:
         errors.append("invalid value: only integers allowed")
+        return {}
     except KeyError as error:
         errors.append("missing value: {}".format(error))
-    more_errors, _, character = await get_character(request)
-    errors.extend(more_errors)
+        return {}
     oros = convert_coins(coins)
     if character['oros'] + oros < 0:
         errors.append("you can't spend money you don't have")
@@ -698,18 +1056,20 @@ def _coin_response_factory(response, character, app):
     for coin in COINS:
         response['#{}-tooltip'.format(coin)] = {'activateTooltip': True}
     response['#coins'] = {
-        'data': get_env(app).get_template(
-            'character_coins.html').render(character=character, coins=COINS)}
+        'data': render_fragment(
+            app, 'character_coins.html', character, coins=COINS)}
 
-async def _name_validator(request, errors):
+async def _name_validator(request, _character, errors):
     try:
         name = escape(request.POST['name'].strip())
     except KeyError as error:
         errors.append("missing value: {}".format(error))
-    if name is not None and (len(name) < 1 or len(name) > 50):
+        return {}
+    if len(name) < 1 or len(name) > 50:
         errors.append("length should be between one and fifty characters")
+        return {}
     if len(errors) == 0:
-        characters = request.app['db'].characters
+        characters = collection(request, 'characters')
         if await characters.find_one(
                 {'user_id': request['user']['_id'], 'name': name}) is not None:
             errors.append("you already have a character with this name")
@@ -719,11 +1079,7 @@ def _name_response_factory(response, character, _):
     response['#name-value'] = {'data': character['name']}
     response['title'] = {'data': "Dnd | {}".format(character['name'])}
 
-async def _rest_validator(request, errors):
-    more_errors, _, character = await get_character(request)
-    errors.extend(more_errors)
-    if len(errors) != 0:
-        return {}
+def _rest_validator(_request, character, _):
     for prayer in character['prepared_prayers']:
         character['prepared_prayers'][prayer]['cast'] = 0
     for spell in character['prepared_spells']:
@@ -737,18 +1093,43 @@ def _rest_response_factory(response, character, app):
     _prepare_spell_response_factory(response, character, app)
     _prepare_prayer_response_factory(response, character, app)
 
-def _background_validator(request, errors):
+def _background_validator(request, _character, errors):
     field = request.match_info['extra']
-    if field not in ['appearance', 'character', 'history']:
+    if field not in BACKGROUND_FIELDS:
         errors.append('unknown field {}'.format(field))
     try:
         text = request.POST['text']
     except KeyError as error:
         errors.append("missing value: {}".format(error))
         return {}
-    return {'{}_unsafe'.format(field): text}
+    digest = markdown_hash(text)
+    return {
+        '{}_unsafe'.format(field): text,
+        '{}_safe'.format(field): render_markdown(text, digest),
+        '{}_hash'.format(field): digest}
 
 def _background_response_factory(response, character, _):
     response['#appearance-value'] = {'data': character['appearance_safe']}
     response['#character-value'] = {'data': character['character_safe']}
     response['#history-value'] = {'data': character['history_safe']}
+
+ATTRIBUTE_FUNCTIONS = {
+    'ability': (_ability_validator, _ability_response_factory),
+    'xp': (_xp_validator, _xp_response_factory),
+    'hp': (_hp_validator, _hp_response_factory),
+    'race': (_race_validator, _race_response_factory),
+    'class': (_class_validator, _class_response_factory),
+    'skill': (_skill_validator, _skill_response_factory),
+    'spell': (_spell_validator, _spell_response_factory),
+    'prepare_spell': (_prepare_spell_validator, _prepare_spell_response_factory),
+    'prayer': (_prayer_validator, _prayer_response_factory),
+    'prepare_prayer': (_prepare_prayer_validator, _prepare_prayer_response_factory),
+    'power': (_power_validator, _power_response_factory),
+    'name': (_name_validator, _name_response_factory),
+    'background': (_background_validator, _background_response_factory),
+    'inventory': (_inventory_validator, _inventory_response_factory),
+    'armour': (_armour_validator, _armour_response_factory),
+    'weapon': (_weapon_validator, _weapon_response_factory),
+    'coin': (_coin_validator, _coin_response_factory),
+    'rest': (_rest_validator, _rest_response_factory),
+}
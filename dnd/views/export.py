@@ -0,0 +1,55 @@
+"""Character export."""
+from bson import ObjectId
+from bson.errors import InvalidId
+from aiohttp_login.decorators import restricted_api
+from aiohttp.web import json_response, StreamResponse
+from dnd.common import format_errors
+from dnd.transfer import CONTENT_TYPE, EXPORT_PROJECTION, export_query, dumps
+
+# bytes to collect before writing a chunk of the response
+CHUNK_SIZE = 64 * 1024
+
+@restricted_api
+async def export_handler(request):
+    """
+    Stream the characters of the user as newline delimited JSON.
+
+    With a `campaign` query parameter, the characters in a campaign the
+    user runs are exported instead.
+    """
+    user_id = request['user']['_id']
+    campaign = request.rel_url.query.get('campaign')
+    if campaign is None:
+        query = export_query(user_id=user_id)
+        file_name = 'characters.ndjson'
+    else:
+        try:
+            campaign_id = ObjectId(campaign)
+        except InvalidId:
+            campaign_id = None
+        if campaign_id is None or await request.app['db'].campaigns.find_one(
+                {'_id': campaign_id, 'user_id': user_id}) is None:
+            return json_response({'errors': format_errors([
+                "campaign {} does not exist".format(campaign)])})
+        query = export_query(campaign_id=campaign_id)
+        file_name = 'campaign-{}.ndjson'.format(campaign_id)
+    response = StreamResponse(headers={
+        'Content-Type': CONTENT_TYPE,
+        'Content-Disposition': 'attachment; filename="{}"'.format(file_name)})
+    response.enable_chunked_encoding()
+    await response.prepare(request)
+    chunk = []
+    size = 0
+    async for character in request.app['db'].characters.find(
+            query, EXPORT_PROJECTION):
+        line = dumps(character).encode()
+        chunk.append(line)
+        size += len(line)
+        if size >= CHUNK_SIZE:
+            await response.write(b''.join(chunk))
+            chunk = []
+            size = 0
+    if len(chunk) > 0:
+        await response.write(b''.join(chunk))
+    await response.write_eof()
+    return response
@@ -1,10 +1,13 @@
 """Index page."""
 from datetime  import datetime
 from markupsafe import escape
+from pymongo.errors import DuplicateKeyError
 from aiohttp_login.decorators import restricted_api
 from aiohttp.web import json_response
 from dnd.decorators import login_required
+from dnd.summaries import invalidate_summaries
 from dnd.common import format_errors
+from dnd.character import calculate_stats, computed_stats
 
 @login_required(template_file='index.html')
 async def index_handler(request):
@@ -19,9 +22,9 @@ async def index_handler(request):
 async def new_character_data_handler(request):
     """Create new character."""
     errors = []
-    await request.post()
+    fields = await request.post()
     try:
-        name = escape(request.POST['name'].strip())
+        name = escape(fields['name'].strip())
     except KeyError as error:
         errors.append("missing value: {}".format(error))
     if name is not None and (len(name) < 1 or len(name) > 50):
@@ -32,12 +35,23 @@ async def new_character_data_handler(request):
                 {'user_id': request['user']['_id'], 'name': name}) is not None:
             errors.append("you already have a character with this name")
         else:
-            result = await characters.insert_one({
+            document = {
                 'user_id': request['user']['_id'],
                 'name': name,
                 'xp': 0,
                 'hp': 0,
-                'created_at': datetime.now()})
+                'version': 0,
+                'created_at': datetime.now()}
+            character = dict(document)
+            calculate_stats(character)
+            document['computed'] = computed_stats(character)
+            try:
+                result = await characters.insert_one(document)
+            except DuplicateKeyError:
+                # created concurrently, the unique index caught it
+                return json_response({'errors': format_errors([
+                    "you already have a character with this name"])})
+            invalidate_summaries(request.app, request['user']['_id'])
             if result.acknowledged:
                 character = await characters.find_one({
                     '_id': result.inserted_id})
@@ -23,9 +23,10 @@ setup(
         'aiodns',
         'aiohttp-login',
         'pyyaml',
+        'appdirs',
         'uvloop',
         'roman'],
     entry_points={
-        'console_scripts': ['dnd = dnd:start']},
+        'console_scripts': ['dnd = dnd:main']},
     package_data={'dnd': ['static/*', 'templates/*', 'config/*']},
     )
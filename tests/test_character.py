@@ -0,0 +1,165 @@
+"""Tests for recalculating the statistics of a character after an edit."""
+import datetime
+import pytest
+from dnd.character import calculate_stats, recalculate
+
+def _character():
+    character = {
+        'name': 'Robert',
+        'xp': 2800,
+        'race_name': 'Bastard',
+        'classes': ['wizard', 'priest', 'wizard', 'wizard'],
+        'hitpoints_per_level': [6, 3, 2, 4],
+        'temp_hp': 0,
+        'damage': 2,
+        'wisdom_base': 12,
+        'wisdom_level': 1,
+        'wisdom_temp': 0,
+        'constitution_base': 10,
+        'constitution_level': 0,
+        'constitution_temp': 0,
+        'skill_names': ['alertness'],
+        'spell_names': ['alarm', 'magic missile'],
+        'prepared_spells': {'alarm': {'prepared': 1, 'cast': 1}},
+        'prayer_spheres': ['war', 'light'],
+        'prayer_names': [],
+        'prepared_prayers': {'aid': {'prepared': 1, 'cast': 0}},
+        'power_names': [],
+        'oros': 500,
+        'history_unsafe': '# Early years',
+        'inventory': {'rope': {
+            'amount': 1, 'extra': '', 'description_unsafe': 'fifty feet'}},
+        'weapons': [],
+        'armour': []}
+    calculate_stats(character)
+    return character
+
+def _gain_xp(character):
+    character['xp'] = 6000
+    return {'xp'}
+
+def _lose_xp(character):
+    character['xp'] = 0
+    return {'xp'}
+
+def _change_classes(character):
+    character['classes'] = ['priest', 'priest', 'wizard', 'warlock', 'priest']
+    return {'classes'}
+
+def _change_ability(character):
+    character['wisdom_base'] = 16
+    character['constitution_temp'] = -4
+    return {'wisdom_base', 'constitution_temp'}
+
+def _change_race(character):
+    character['race_name'] = 'Trollborn'
+    return {'race_name'}
+
+def _learn_skill(character):
+    character['skill_names'] = character['skill_names'] + ['ambidexterity']
+    return {'skill_names'}
+
+def _learn_spell(character):
+    character['spell_names'] = character['spell_names'] + ['bulwark']
+    return {'spell_names'}
+
+def _prepare_spell(character):
+    character['prepared_spells']['magic missile'] = {'prepared': 2, 'cast': 0}
+    return {'prepared_spells'}
+
+def _cast_spell(character):
+    character['prepared_spells']['alarm']['cast'] += 1
+    return {'prepared_spells'}
+
+def _change_spheres(character):
+    character['prayer_spheres'] = ['harvest', 'dark']
+    return {'prayer_spheres'}
+
+def _prepare_prayer(character):
+    character['prepared_prayers']['abjure'] = {'prepared': 1, 'cast': 0}
+    return {'prepared_prayers'}
+
+def _learn_power(character):
+    character['power_names'] = ['adaptation']
+    return {'power_names'}
+
+def _take_damage(character):
+    character['damage'] = 9
+    character['temp_hp'] = 3
+    return {'damage', 'temp_hp'}
+
+def _change_hit_points(character):
+    character['hitpoints_per_level'] = [6, 1, 1, 1]
+    return {'hitpoints_per_level'}
+
+def _write_background(character):
+    character['history_unsafe'] = '# Later years\n\n*quiet*'
+    return {'history_unsafe'}
+
+def _add_item(character):
+    character['inventory']['lamp'] = {
+        'amount': 2, 'extra': 'oil', 'description_unsafe': '**bright**'}
+    return {'inventory'}
+
+def _spend_coins(character):
+    character['oros'] = 17
+    return {'oros'}
+
+def _add_weapon(character):
+    character['weapons'].append({
+        'id': datetime.datetime(2020, 1, 1), 'name': 'axe', 'size': 'small',
+        'equipped': True})
+    return {'weapons'}
+
+def _add_armour(character):
+    character['armour'].append({
+        'id': datetime.datetime(2020, 1, 1), 'name': 'light',
+        'equipped': True})
+    return {'armour'}
+
+EDITS = [
+    _gain_xp,
+    _lose_xp,
+    _change_classes,
+    _change_ability,
+    _change_race,
+    _learn_skill,
+    _learn_spell,
+    _prepare_spell,
+    _cast_spell,
+    _change_spheres,
+    _prepare_prayer,
+    _learn_power,
+    _take_damage,
+    _change_hit_points,
+    _write_background,
+    _add_item,
+    _spend_coins,
+    _add_weapon,
+    _add_armour]
+
+@pytest.mark.parametrize('edit', EDITS, ids=[edit.__name__[1:] for edit in EDITS])
+def test_recalculate_matches_calculate_stats(edit):
+    character = _character()
+    recalculate(character, edit(character))
+    expected = _character()
+    edit(expected)
+    calculate_stats(expected)
+    assert character == expected
+
+def test_recalculate_reports_derived_changes():
+    character = _character()
+    changed = recalculate(character, _gain_xp(character))
+    assert {'xp', 'level', 'classes', 'wizard', 'hitpoints_per_level'} <= changed
+    assert 'oros' not in changed
+
+def test_recalculate_after_several_edits():
+    edits = (_change_race, _learn_spell, _gain_xp, _change_ability)
+    character = _character()
+    for edit in edits:
+        recalculate(character, edit(character))
+    expected = _character()
+    for edit in edits:
+        edit(expected)
+    calculate_stats(expected)
+    assert character == expected
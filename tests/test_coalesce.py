@@ -0,0 +1,62 @@
+"""Tests for the buffering of character edits."""
+import asyncio
+from dnd.coalesce import BufferFull, WriteCoalescer
+
+class _Flush:
+
+    """Flush that records its batches and holds them until released."""
+
+    def __init__(self):
+        self.batches = []
+        self.release = asyncio.Event()
+
+    async def __call__(self, items):
+        self.batches.append(list(items))
+        await self.release.wait()
+        return [item.upper() for item in items]
+
+def test_lone_item_is_flushed_at_once():
+    async def submit():
+        coalescer = WriteCoalescer(max_items=8)
+        flush = _Flush()
+        task = asyncio.ensure_future(coalescer.submit('key', 'a', flush))
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        batches = list(flush.batches)
+        flush.release.set()
+        return batches, await task
+    assert asyncio.run(submit()) == ([['a']], 'A')
+
+def test_items_that_overlap_a_flush_are_flushed_together():
+    async def submit():
+        coalescer = WriteCoalescer(max_items=8)
+        flush = _Flush()
+        first = asyncio.ensure_future(coalescer.submit('key', 'a', flush))
+        await asyncio.sleep(0)
+        following = [
+            asyncio.ensure_future(coalescer.submit('key', item, flush))
+            for item in 'bc']
+        await asyncio.sleep(0)
+        flush.release.set()
+        results = await asyncio.gather(first, *following)
+        return flush.batches, results, coalescer.is_open('key')
+    assert asyncio.run(submit()) == (
+        [['a'], ['b', 'c']], ['A', 'B', 'C'], False)
+
+def test_full_buffer_rejects_items():
+    async def submit():
+        coalescer = WriteCoalescer(max_items=1)
+        flush = _Flush()
+        first = asyncio.ensure_future(coalescer.submit('key', 'a', flush))
+        second = asyncio.ensure_future(coalescer.submit('key', 'b', flush))
+        await asyncio.sleep(0)
+        try:
+            await coalescer.submit('key', 'c', flush)
+        except BufferFull:
+            rejected = True
+        else:
+            rejected = False
+        flush.release.set()
+        await asyncio.gather(first, second)
+        return rejected, coalescer.rejected
+    assert asyncio.run(submit()) == (True, 1)
@@ -0,0 +1,91 @@
+"""Tests for merging field level updates."""
+from dnd.database import Update
+
+def test_increments_of_the_same_path_are_summed():
+    update = Update().inc('prepared_spells.alarm.cast')
+    update.merge(Update().inc('prepared_spells.alarm.cast', 2), {})
+    assert update.document() == {'$inc': {'prepared_spells.alarm.cast': 3}}
+
+def test_operations_on_separate_paths_are_kept():
+    update = Update().inc('prepared_spells.alarm.cast')
+    update.merge(Update().inc('prepared_spells.bulwark.cast'), {})
+    update.merge(Update().set('xp', 100), {})
+    assert update.document() == {
+        '$inc': {
+            'prepared_spells.alarm.cast': 1,
+            'prepared_spells.bulwark.cast': 1},
+        '$set': {'xp': 100}}
+
+def test_set_and_increment_of_the_same_path_set_the_field():
+    document = {'inventory': {'rope': {'amount': 4}, 'lamp': {'amount': 1}}}
+    update = Update().set('inventory.rope.amount', 3)
+    update.merge(Update().inc('inventory.rope.amount'), document)
+    assert update.document() == {'$set': {'inventory': document['inventory']}}
+
+def test_child_after_parent_sets_the_field():
+    document = {'inventory': {'rope': {'amount': 2}}}
+    update = Update().set('inventory.rope', {'amount': 1})
+    update.merge(Update().inc('inventory.rope.amount'), document)
+    assert update.document() == {'$set': {'inventory': document['inventory']}}
+
+def test_parent_after_child_sets_the_field():
+    document = {'inventory': {}}
+    update = Update().inc('inventory.rope.amount').inc('oros', -5)
+    update.merge(Update().unset('inventory.rope'), document)
+    assert update.document() == {
+        '$inc': {'oros': -5},
+        '$set': {'inventory': {}}}
+
+def test_later_operations_on_a_field_set_as_a_whole_are_dropped():
+    document = {'inventory': {'rope': {'amount': 7}}}
+    update = Update().set('inventory.rope.amount', 5)
+    update.merge(Update().inc('inventory.rope.amount'), document)
+    update.merge(Update().inc('inventory.rope.amount'), document)
+    assert update.document() == {'$set': {'inventory': document['inventory']}}
+
+def test_fields_of_the_same_prefix_do_not_overlap():
+    update = Update().inc('damage')
+    update.merge(Update().set('damage_type', 'slashing'), {})
+    assert update.document() == {
+        '$inc': {'damage': 1}, '$set': {'damage_type': 'slashing'}}
+
+def test_array_filters_of_both_updates_are_kept():
+    update = Update().set('armour.$[armour].equipped', True).match(
+        'armour', {'id': 1})
+    update.merge(
+        Update().set('weapons.$[weapon].equipped', False).match(
+            'weapon', {'id': 2}),
+        {})
+    assert update.document() == {'$set': {
+        'armour.$[armour].equipped': True,
+        'weapons.$[weapon].equipped': False}}
+    assert update.array_filters == [{'armour.id': 1}, {'weapon.id': 2}]
+
+def test_equal_array_filters_are_not_repeated():
+    update = Update().set('weapons.$[weapon].equipped', True).match(
+        'weapon', {'id': 2})
+    update.merge(
+        Update().set('weapons.$[weapon].name', 'axe').match(
+            'weapon', {'id': 2}),
+        {})
+    assert update.document() == {'$set': {
+        'weapons.$[weapon].equipped': True,
+        'weapons.$[weapon].name': 'axe'}}
+    assert update.array_filters == [{'weapon.id': 2}]
+
+def test_array_filters_of_a_field_set_as_a_whole_are_dropped():
+    document = {
+        'weapons': [{'id': 2, 'equipped': False}],
+        'armour': [{'id': 1, 'equipped': True}]}
+    update = Update().set('weapons.$[weapon].equipped', True).match(
+        'weapon', {'id': 2})
+    update.set('armour.$[armour].equipped', True).match('armour', {'id': 1})
+    update.merge(Update().pull('weapons', {'id': 2}), document)
+    assert update.document() == {'$set': {
+        'armour.$[armour].equipped': True,
+        'weapons': document['weapons']}}
+    assert update.array_filters == [{'armour.id': 1}]
+
+def test_fields_are_the_top_level_fields():
+    update = Update({'xp': 5}).inc('prepared_spells.alarm.cast')
+    assert update.fields() == {'xp', 'prepared_spells'}
@@ -0,0 +1,26 @@
+"""Tests for the fragment hashes kept per live socket."""
+from dnd.live import LiveSocket
+
+def test_known_markup_is_left_out():
+    socket = LiveSocket(None)
+    socket.delta({'#hp-form-content': {'data': '<form></form>'}})
+    assert socket.delta({'#hp-form-content': {'data': '<form></form>'}}) == {}
+
+def test_markup_the_client_forgot_is_sent_again():
+    socket = LiveSocket(None)
+    socket.delta({
+        '#hp-form-content': {'data': '<form></form>'},
+        '#hp-value': {'data': '12'}})
+    hashes = dict(socket.hashes)
+    del hashes['#hp-form-content']
+    socket.reset(hashes)
+    response = socket.delta({
+        '#hp-form-content': {'data': '<form></form>'},
+        '#hp-value': {'data': '12'}})
+    assert list(response) == ['#hp-form-content']
+    assert response['#hp-form-content']['data'] == '<form></form>'
+
+def test_hashes_that_are_not_strings_are_ignored():
+    socket = LiveSocket(None)
+    socket.reset({'#hp-value': 3, '#xp-value': 'abc'})
+    assert socket.hashes == {'#xp-value': 'abc'}
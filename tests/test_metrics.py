@@ -0,0 +1,33 @@
+"""Tests for the request metrics."""
+import asyncio
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+from dnd.metrics import Metrics, metrics_middleware
+
+async def _ok(_request):
+    return web.Response(text='ok')
+
+async def _request_paths(paths):
+    app = web.Application(middlewares=[metrics_middleware])
+    app['metrics'] = Metrics(['hp', 'coin'])
+    app.router.add_post('/api/{id}/{attribute}/', _ok)
+    app.router.add_get('/', _ok)
+    client = TestClient(TestServer(app))
+    await client.start_server()
+    try:
+        for method, path in paths:
+            await client.request(method, path)
+    finally:
+        await client.close()
+    return app['metrics'].render()
+
+def test_unknown_attributes_share_one_label():
+    rendered = asyncio.run(_request_paths([
+        ('POST', '/api/1/hp/'),
+        ('POST', '/api/1/zz1/'),
+        ('POST', '/api/1/zz2/'),
+        ('GET', '/')]))
+    assert 'attribute="hp"' in rendered
+    assert 'attribute="other"' in rendered
+    assert 'zz1' not in rendered and 'zz2' not in rendered
+    assert 'attribute=""' in rendered
@@ -0,0 +1,60 @@
+"""Tests for the rate limiters."""
+import asyncio
+import itertools
+from types import SimpleNamespace
+from dnd.ratelimit import TokenBucketLimiter, MongoSlidingWindowLimiter
+
+def test_every_action_takes_a_token():
+    limiter = TokenBucketLimiter(rate=1e-9, burst=8)
+    async def take():
+        return [await limiter.allow('user', actions) for actions in (5, 4, 3, 1)]
+    assert asyncio.run(take()) == [True, False, True, False]
+
+def test_buckets_are_per_user():
+    limiter = TokenBucketLimiter(rate=1e-9, burst=2)
+    async def take():
+        return [await limiter.allow(user, 2) for user in ('a', 'a', 'b')]
+    assert asyncio.run(take()) == [True, False, True]
+
+class _Collection:
+
+    """The part of a Motor collection the sliding window uses."""
+
+    def __init__(self):
+        self.documents = {}
+        self._ids = itertools.count()
+
+    async def insert_many(self, documents):
+        ids = []
+        for document in documents:
+            ids.append(next(self._ids))
+            self.documents[ids[-1]] = document
+        # let concurrent requests in, as a round trip would
+        await asyncio.sleep(0)
+        return SimpleNamespace(inserted_ids=ids)
+
+    async def count_documents(self, query):
+        await asyncio.sleep(0)
+        return sum(
+            1 for document in self.documents.values()
+            if document['user_id'] == query['user_id'] and
+            document['at'] > query['at']['$gt'])
+
+    async def delete_many(self, query):
+        for id_ in query['_id']['$in']:
+            del self.documents[id_]
+
+def test_sliding_window_holds_for_concurrent_requests():
+    limiter = MongoSlidingWindowLimiter(
+        SimpleNamespace(rate_limit=_Collection()), actions=2, window=60)
+    async def take():
+        return await asyncio.gather(
+            *[limiter.allow('user') for _ in range(4)])
+    assert sum(asyncio.run(take())) <= 2
+
+def test_sliding_window_takes_refused_actions_back():
+    limiter = MongoSlidingWindowLimiter(
+        SimpleNamespace(rate_limit=_Collection()), actions=2, window=60)
+    async def take():
+        return [await limiter.allow('user', actions) for actions in (3, 2, 1)]
+    assert asyncio.run(take()) == [False, True, False]
@@ -0,0 +1,20 @@
+"""Tests for the recalculation of every character."""
+import bson
+from bson import ObjectId
+from dnd.recalc import check_batch
+
+BAD_ID = ObjectId('5f0000000000000000000002')
+
+def _document(**fields):
+    character = {'_id': ObjectId(), 'name': 'Stored'}
+    character.update(fields)
+    return bson.encode(character)
+
+def test_character_of_the_wrong_shape_does_not_stop_a_run():
+    documents = [_document(_id=BAD_ID, weapons=['sword']), _document()]
+    anomalies, updates = check_batch(documents, write=True)
+    assert [
+        (kind, detail) for id_, _, kind, detail in anomalies
+        if id_ == BAD_ID] == [
+            ('wrong shape', "weapons holds an item that is not an object")]
+    assert len(updates) == 1
@@ -0,0 +1,107 @@
+"""Tests for the import of exported characters."""
+import json
+import pytest
+from bson import ObjectId
+from dnd.character import markdown_hash
+from dnd.transfer import import_characters, prepare_import
+
+USER_ID = ObjectId('5f0000000000000000000001')
+
+SCRIPT = '<script>alert(1)</script>'
+
+def _line(**fields):
+    character = {'name': 'Imported', 'user_id': {'$oid': str(USER_ID)}}
+    character.update(fields)
+    return json.dumps(character)
+
+def test_crafted_item_description_is_rendered_again():
+    # the hash matches the text, so only a fresh render drops the script
+    line = _line(inventory={'rope': {
+        'amount': 1,
+        'extra': '',
+        'description_unsafe': 'fifty feet',
+        'description': SCRIPT,
+        'description_hash': markdown_hash('fifty feet')}})
+    character, problems = prepare_import(line)
+    assert problems == []
+    item = character['inventory']['rope']
+    assert SCRIPT not in item['description']
+    assert 'fifty feet' in item['description']
+    assert item['description_hash'] == markdown_hash('fifty feet')
+
+def test_item_description_markup_is_escaped():
+    line = _line(inventory={'rope': {
+        'amount': 1, 'extra': '', 'description_unsafe': SCRIPT}})
+    character, problems = prepare_import(line)
+    assert problems == []
+    assert '<script>' not in character['inventory']['rope']['description']
+
+def test_crafted_background_is_rendered_again():
+    line = _line(
+        history_unsafe='a quiet life',
+        history_safe=SCRIPT,
+        history_hash=markdown_hash('a quiet life'))
+    character, problems = prepare_import(line)
+    assert problems == []
+    assert SCRIPT not in character['history_safe']
+    assert 'a quiet life' in character['history_safe']
+
+def test_computed_statistics_are_not_taken_from_the_line():
+    line = _line(computed={'stamp': 'forged', 'level': 20})
+    character, _ = prepare_import(line)
+    assert character['computed']['stamp'] != 'forged'
+    assert character['computed']['level'] == 1
+
+@pytest.mark.parametrize('line', ['[1, 2]', '"text"', '3', 'null'])
+def test_line_that_is_not_an_object_is_a_problem(line):
+    character, problems = prepare_import(line)
+    assert character is None
+    assert problems == ["not a character, expected a JSON object"]
+
+@pytest.mark.parametrize('fields, problem', [
+    ({'weapons': [1]}, "weapons holds an item that is not an object"),
+    ({'armour': {'name': 'light'}}, "armour is not a list"),
+    ({'spell_names': [['alarm']]},
+     "spell_names holds an item that is not a string"),
+    ({'inventory': {'rope': 'fifty feet'}},
+     "inventory holds a value that is not an object"),
+    ({'race_name': ['Bastard']}, "race_name is not a string")])
+def test_fields_of_the_wrong_shape_are_problems(fields, problem):
+    _, problems = prepare_import(_line(**fields))
+    assert problems == [problem]
+
+def test_bad_lines_do_not_stop_an_import():
+    class Collection:
+        def __init__(self):
+            self.inserted = []
+        def insert_many(self, characters, ordered):
+            self.inserted.extend(characters)
+    collection = Collection()
+    inserted, failures = import_characters(
+        collection, ['[1, 2]\n', _line(weapons=[1]) + '\n', _line() + '\n'])
+    assert inserted == 1
+    assert [number for number, _ in failures] == [1, 2]
+
+def test_names_are_cleaned_like_edits_clean_them():
+    line = _line(name='<b>x</b>', inventory={'a.b': {
+        'amount': 1,
+        'extra': 'coil.',
+        'description_unsafe': 'rope'}})
+    character, problems = prepare_import(line)
+    assert problems == []
+    assert character['name'] == '&lt;b&gt;x&lt;/b&gt;'
+    assert list(character['inventory']) == ['ab']
+    assert character['inventory']['ab']['extra'] == 'coil'
+
+def test_exported_names_are_not_escaped_twice():
+    character, _ = prepare_import(_line(name='Tom &amp; Jerry'))
+    assert character['name'] == 'Tom &amp; Jerry'
+
+@pytest.mark.parametrize('fields, problem', [
+    ({'name': ''}, "name should be between one and fifty characters long"),
+    ({'name': 1}, "name is not a string"),
+    ({'inventory': {'...': {'amount': 1}}},
+     "inventory item '...' has no valid name")])
+def test_names_that_can_not_be_stored_are_problems(fields, problem):
+    _, problems = prepare_import(_line(**fields))
+    assert problems == [problem]